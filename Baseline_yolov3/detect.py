@@ -76,6 +76,7 @@ if __name__ == "__main__":
         with torch.no_grad():
             detections = model(input_imgs)
             detections = non_max_suppression(detections, opt.conf_thres, opt.nms_thres)
+            detections = [d if d is None else d.cpu() for d in detections]  # for plotting
 
         # Log progress
         current_time = time.time()
@@ -7,6 +7,10 @@ from utils.parse_config import *
 
 import os
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # repository root, for the store
+from EfficientObjectDetection.dataset.detection_store import DetectionStore
+from EfficientObjectDetection.constants import num_windows
+
 import time
 import datetime
 import argparse
@@ -21,7 +25,7 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 
-def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, save_dir='data/800/base_dir_detections_fd'):
+def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, save_dir='data/800/base_dir_detections_fd', store=None):
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
         print(save_dir)
@@ -56,7 +60,7 @@ def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, bat
         for sample_i in range(len(outputs)):
             if outputs[sample_i] is None:
                 continue
-            output = outputs[sample_i]
+            output = outputs[sample_i].cpu()
             dummy_arr = np.zeros((len(output), 7))
             dummy_arr[:, :4] = output[:, :4]
             dummy_arr[:, 4] = output[:, 4]
@@ -70,17 +74,20 @@ def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, bat
 
         fname = _[0].split('/')[-1]
         filename = fname[:fname.find('.')]
-        window_num = filename[-1:]
-        filename = filename[:-2]
-        row = int(window_num) // 2
-        col = int(window_num) % 2
+        filename, window_num = filename.rsplit('_', 1)  # <image>_<window>, window row-major in the num_windows grid
+        row, col = divmod(int(window_num), num_windows)
+
+        if store is not None:  # one file for all windows
+            store.append(filename, int(window_num), detections=arr)
+            continue
 
         final_name = filename+'_{}_{}.npy'.format(row, col)
         final_dir = os.path.join(save_dir, final_name)
         np.save(final_dir, arr)
 
-
-
+    if store is not None:
+        store.flush()
+        print("{} windows of {} images in {}".format(len(dataset), len(store), store.file))
 
     return
 
@@ -133,6 +140,7 @@ if __name__ == "__main__":
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--save_dir", type=str, default='/home/cutz/SAR_OD/EfficientObjectDetection/data/')
+    parser.add_argument("--store", type=str, default='', help="DetectionStore file to append to instead of --save_dir")
     opt = parser.parse_args()
     print(opt)
 
@@ -171,7 +179,8 @@ if __name__ == "__main__":
         nms_thres=opt.nms_thres,
         img_size=opt.img_size,
         batch_size=1,
-        save_dir=opt.save_dir
+        save_dir=opt.save_dir,
+        store=DetectionStore(opt.store) if opt.store else None,
     )
 
     # print("Average Precisions:")
@@ -7,6 +7,10 @@ from utils.parse_config import *
 
 import os
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # repository root, for the store
+from EfficientObjectDetection.dataset.detection_store import DetectionStore
+from EfficientObjectDetection.constants import num_windows
+
 import time
 import datetime
 import argparse
@@ -21,7 +25,7 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 
-def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, save_dir='data/800/base_dir_metric_fd'):
+def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, save_dir='data/800/base_dir_metric_fd', store=None):
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
         print(save_dir)
@@ -67,12 +71,14 @@ def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, bat
         
         fname = _[0].split('/')[-1]
         filename = fname[:fname.find('.')]
-        window_num = filename[-1:]
-        filename = filename[:-2]
-        row = int(window_num) // 2
-        col = int(window_num) % 2
+        filename, window_num = filename.rsplit('_', 1)  # <image>_<window>, window row-major in the num_windows grid
+        row, col = divmod(int(window_num), num_windows)
+
+        if store is not None:  # one file for all windows
+            store.append(filename, int(window_num), ap=np.mean(recall), objects=len(labels))
+            continue
 
-        ap_mat = np.zeros((2, 2))
+        ap_mat = np.zeros((num_windows, num_windows))
         save_name = os.path.join(save_dir, filename+'.npy')
         if os.path.isfile(save_name):
             ap_mat = np.load(save_name)
@@ -85,8 +91,9 @@ def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, bat
         print(ap_mat)
         print("{} saved".format(filename))
 
-
-
+    if store is not None:
+        store.flush()
+        print("{} windows of {} images in {}".format(len(dataset), len(store), store.file))
 
     return
 
@@ -139,6 +146,7 @@ if __name__ == "__main__":
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--save_dir", type=str, default='/home/cutz/SAR_OD/EfficientObjectDetection/data/')
+    parser.add_argument("--store", type=str, default='', help="DetectionStore file to append to instead of --save_dir")
     opt = parser.parse_args()
     print(opt)
 
@@ -177,7 +185,8 @@ if __name__ == "__main__":
         nms_thres=opt.nms_thres,
         img_size=opt.img_size,
         batch_size=1,
-        save_dir=opt.save_dir
+        save_dir=opt.save_dir,
+        store=DetectionStore(opt.store) if opt.store else None,
     )
 
     # print("Average Precisions:")
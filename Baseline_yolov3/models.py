@@ -7,7 +7,7 @@ from torch.autograd import Variable
 import numpy as np
 
 from utils.parse_config import *
-from utils.utils import build_targets, to_cpu, non_max_suppression
+from utils.utils import build_targets, non_max_suppression
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -107,6 +107,9 @@ class EmptyLayer(nn.Module):
 class YOLOLayer(nn.Module):
     """Detection layer"""
 
+    metric_names = ["loss", "x", "y", "w", "h", "conf", "cls", "cls_acc", "recall50", "recall75", "precision",
+                    "conf_obj", "conf_noobj"]
+
     def __init__(self, anchors, num_classes, img_dim=416):
         super(YOLOLayer, self).__init__()
         self.anchors = anchors
@@ -117,7 +120,9 @@ class YOLOLayer(nn.Module):
         self.bce_loss = nn.BCELoss()
         self.obj_scale = 1
         self.noobj_scale = 100
-        self.metrics = {}
+        self.metrics = {}  # means of the last logging interval, see Darknet.log_metrics()
+        self.track_metrics = False  # accumulate metrics in training forwards, opt-in
+        self.metric_sum, self.metric_count = None, 0
         self.img_dim = img_dim
         self.grid_size = 0  # grid size
 
@@ -199,34 +204,24 @@ class YOLOLayer(nn.Module):
             loss_cls = self.bce_loss(pred_cls[obj_mask], tcls[obj_mask])
             total_loss = loss_x + loss_y + loss_w + loss_h + loss_conf + loss_cls
 
-            # Metrics
-            cls_acc = 100 * class_mask[obj_mask].mean()
-            conf_obj = pred_conf[obj_mask].mean()
-            conf_noobj = pred_conf[noobj_mask].mean()
-            conf50 = (pred_conf > 0.5).float()
-            iou50 = (iou_scores > 0.5).float()
-            iou75 = (iou_scores > 0.75).float()
-            detected_mask = conf50 * class_mask * tconf
-            precision = torch.sum(iou50 * detected_mask) / (conf50.sum() + 1e-16)
-            recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
-            recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
-
-            self.metrics = {
-                "loss": to_cpu(total_loss).item(),
-                "x": to_cpu(loss_x).item(),
-                "y": to_cpu(loss_y).item(),
-                "w": to_cpu(loss_w).item(),
-                "h": to_cpu(loss_h).item(),
-                "conf": to_cpu(loss_conf).item(),
-                "cls": to_cpu(loss_cls).item(),
-                "cls_acc": to_cpu(cls_acc).item(),
-                "recall50": to_cpu(recall50).item(),
-                "recall75": to_cpu(recall75).item(),
-                "precision": to_cpu(precision).item(),
-                "conf_obj": to_cpu(conf_obj).item(),
-                "conf_noobj": to_cpu(conf_noobj).item(),
-                "grid_size": grid_size,
-            }
+            # Metrics, accumulated on the device (no sync) until Darknet.log_metrics()
+            if self.track_metrics:
+                with torch.no_grad():
+                    cls_acc = 100 * class_mask[obj_mask].mean()
+                    conf_obj = pred_conf[obj_mask].mean()
+                    conf_noobj = pred_conf[noobj_mask].mean()
+                    conf50 = (pred_conf > 0.5).float()
+                    iou50 = (iou_scores > 0.5).float()
+                    iou75 = (iou_scores > 0.75).float()
+                    detected_mask = conf50 * class_mask * tconf
+                    precision = torch.sum(iou50 * detected_mask) / (conf50.sum() + 1e-16)
+                    recall50 = torch.sum(iou50 * detected_mask) / (obj_mask.sum() + 1e-16)
+                    recall75 = torch.sum(iou75 * detected_mask) / (obj_mask.sum() + 1e-16)
+
+                    metrics = torch.stack((total_loss, loss_x, loss_y, loss_w, loss_h, loss_conf, loss_cls, cls_acc,
+                                           recall50, recall75, precision, conf_obj, conf_noobj)).float()
+                    self.metric_sum = metrics if self.metric_sum is None else self.metric_sum + metrics
+                    self.metric_count += 1
 
             return output, total_loss
 
@@ -260,9 +255,28 @@ class Darknet(nn.Module):
                 loss += layer_loss
                 yolo_outputs.append(x)
             layer_outputs.append(x)
-        yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
+        yolo_outputs = torch.cat(yolo_outputs, 1)  # on the device of x
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
+    def track_metrics(self, enabled=True):
+        """Accumulates the YOLO layer metrics of every training forward (off by default)"""
+        for yolo in self.yolo_layers:
+            yolo.track_metrics = enabled
+            yolo.metric_sum, yolo.metric_count = None, 0
+
+    def log_metrics(self):
+        """
+        Means of the YOLO layer metrics since the last call, copied to the host at once (one sync), stored in
+        yolo.metrics and returned as one dict per YOLO layer
+        """
+        layers = [yolo for yolo in self.yolo_layers if yolo.metric_count]
+        if layers:
+            means = torch.stack([yolo.metric_sum / yolo.metric_count for yolo in layers]).tolist()
+            for yolo, m in zip(layers, means):
+                yolo.metrics = dict(zip(yolo.metric_names, m), grid_size=yolo.grid_size)
+                yolo.metric_sum, yolo.metric_count = None, 0
+        return [yolo.metrics for yolo in self.yolo_layers]
+
     def load_darknet_weights(self, weights_path):
         """Parses and loads the weights stored in 'weights_path'"""
 
@@ -7,6 +7,9 @@ from utils.parse_config import *
 
 import os
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))  # repository root, for the grid
+from EfficientObjectDetection.constants import num_windows
+
 import time
 import datetime
 import argparse
@@ -58,12 +61,10 @@ def evaluate_window(model, path, iou_thres, conf_thres, nms_thres, img_size, bat
         
         fname = _[0].split('/')[-1]
         filename = fname[:fname.find('.')]
-        window_num = filename[-1:]
-        filename = filename[:-2]
-        row = int(window_num) // 2
-        col = int(window_num) % 2
+        filename, window_num = filename.rsplit('_', 1)  # <image>_<window>, window row-major in the num_windows grid
+        row, col = divmod(int(window_num), num_windows)
 
-        ap_mat = np.zeros((2, 2))
+        ap_mat = np.zeros((num_windows, num_windows))
         save_name = os.path.join(save_dir, filename+'.npy')
         if os.path.isfile(save_name):
             ap_mat = np.load(save_name)
@@ -41,6 +41,9 @@ if __name__ == "__main__":
     parser.add_argument("--evaluation_interval", type=int, default=1, help="interval evaluations on validation set")
     parser.add_argument("--compute_map", default=False, help="if True computes mAP every tenth batch")
     parser.add_argument("--multiscale_training", default=True, help="allow for multi-scale training")
+    parser.add_argument("--log_metrics", type=int, default=0, help="accumulate and print the YOLO layer metrics of each epoch")
+    parser.add_argument("--log_interval", type=int, default=10, help="batches between progress bar loss updates")
+    parser.add_argument("--uint8_loader", type=int, default=0, help="load uint8 images, pad and resize them on the device")
     opt = parser.parse_args()
     print(opt)
 
@@ -69,7 +72,7 @@ if __name__ == "__main__":
             model.load_darknet_weights(opt.pretrained_weights)
 
     # Get dataloader
-    dataset = ListDataset(train_path, augment=True, multiscale=opt.multiscale_training)
+    dataset = ListDataset(train_path, augment=True, multiscale=opt.multiscale_training, uint8=bool(opt.uint8_loader))
     dataloader = torch.utils.data.DataLoader(
         dataset,
         batch_size=opt.batch_size,
@@ -80,6 +83,7 @@ if __name__ == "__main__":
     )
 
     optimizer = torch.optim.Adam(model.parameters())
+    model.track_metrics(bool(opt.log_metrics))  # on the device, one sync per epoch in model.log_metrics()
 
     metrics = [
         "grid_size",
@@ -106,7 +110,7 @@ if __name__ == "__main__":
         for batch_i, (_, imgs, targets) in enumerate(dataloader):
             batches_done = len(dataloader) * epoch + batch_i
 
-            imgs = Variable(imgs.to(device))
+            imgs = pad_resize_batch(*imgs, device) if opt.uint8_loader else Variable(imgs.to(device))
             targets = Variable(targets.to(device), requires_grad=False)
 
             loss, outputs = model(imgs, targets)
@@ -120,13 +124,15 @@ if __name__ == "__main__":
             # ----------------
             #   Log progress
             # ----------------
-            bar.set_description("[Epoch %d/%d, Batch %d/%d] Total loss: %f" % (epoch, opt.epochs, batch_i, len(dataloader), loss.item()))
+            if batch_i % opt.log_interval == 0:  # loss.item() syncs the device
+                bar.set_description("[Epoch %d/%d, Batch %d/%d] Total loss: %f" % (epoch, opt.epochs, batch_i, len(dataloader), loss.item()))
             bar.update()
         bar.close()
 
         log_str = "\n---- [Epoch %d/%d, Batch %d/%d] ----\n" % (epoch, opt.epochs, batch_i, len(dataloader))
 
         metric_table = [["Metrics", *[f"YOLO Layer {i}" for i in range(len(model.yolo_layers))]]]
+        model.log_metrics()  # epoch means
 
         # Log metrics at each YOLO layer
         for i, metric in enumerate(metrics):
@@ -145,7 +151,8 @@ if __name__ == "__main__":
             # tensorboard_log += [("loss", loss.item())]
             # logger.list_of_scalars_summary(tensorboard_log, batches_done)
 
-        log_str += AsciiTable(metric_table).table
+        if opt.log_metrics:  # not accumulated otherwise
+            log_str += AsciiTable(metric_table).table
         log_str += f"\nTotal loss {loss.item()}"
 
         # Determine approximate time left for epoch
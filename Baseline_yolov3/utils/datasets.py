@@ -12,13 +12,17 @@ from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 
 
-def pad_to_square(img, pad_value):
-    c, h, w = img.shape
+def square_pad(h, w):
     dim_diff = np.abs(h - w)
     # (upper / left) padding and (lower / right) padding
     pad1, pad2 = dim_diff // 2, dim_diff - dim_diff // 2
     # Determine padding
-    pad = (0, 0, pad1, pad2) if h <= w else (pad1, pad2, 0, 0)
+    return (0, 0, pad1, pad2) if h <= w else (pad1, pad2, 0, 0)
+
+
+def pad_to_square(img, pad_value):
+    c, h, w = img.shape
+    pad = square_pad(h, w)
     # Add padding
     img = F.pad(img, pad, "constant", value=pad_value)
 
@@ -30,6 +34,22 @@ def resize(image, size):
     return image
 
 
+def pad_resize_batch(imgs, pads, img_size, device):
+    """Pads to square, resizes and normalizes a ListDataset(uint8=True) batch on the device, one op per image shape
+
+    Same result as ToTensor(), pad_to_square(img, 0) and resize(img, img_size) of every image
+    """
+    batch = torch.zeros((len(imgs), 3, img_size, img_size), device=device)
+    shapes = {}
+    for i, img in enumerate(imgs):
+        shapes.setdefault((tuple(img.shape), tuple(pads[i].tolist())), []).append(i)
+    for (_, pad), i in shapes.items():
+        x = torch.stack([imgs[j] for j in i]).to(device, non_blocking=True)
+        x = x.permute(0, 3, 1, 2).float() / 255
+        batch[i] = F.interpolate(F.pad(x, pad, "constant", value=0), size=img_size, mode="nearest")
+    return batch
+
+
 def random_resize(images, min_size=288, max_size=448):
     new_size = random.sample(list(range(min_size, max_size + 1, 32)), 1)[0]
     images = F.interpolate(images, size=new_size, mode="nearest")
@@ -57,7 +77,7 @@ class ImageFolder(Dataset):
 
 
 class ListDataset(Dataset):
-    def __init__(self, list_path, img_size=416, augment=True, multiscale=True, normalized_labels=True):
+    def __init__(self, list_path, img_size=416, augment=True, multiscale=True, normalized_labels=True, uint8=False):
         with open(list_path, "r") as file:
             self.img_files = file.readlines()
 
@@ -70,6 +90,7 @@ class ListDataset(Dataset):
         self.augment = augment
         self.multiscale = multiscale
         self.normalized_labels = normalized_labels
+        self.uint8 = uint8  # return uint8 HWC images, padded and resized on the device by pad_resize_batch()
         self.min_size = self.img_size - 3 * 32
         self.max_size = self.img_size + 3 * 32
         self.batch_count = 0
@@ -82,19 +103,26 @@ class ListDataset(Dataset):
 
         img_path = self.img_files[index % len(self.img_files)].rstrip()
 
-        # Extract image as PyTorch tensor
-        img = transforms.ToTensor()(Image.open(img_path).convert('RGB'))
-
-        # Handle images with less than three channels
-        if len(img.shape) != 3:
-            img = img.unsqueeze(0)
-            img = img.expand((3, img.shape[1:]))
-
-        _, h, w = img.shape
+        if self.uint8:
+            # Extract image as uint8 HWC array, padding deferred to pad_resize_batch()
+            img = np.array(Image.open(img_path).convert('RGB'))
+            h, w, _ = img.shape
+            pad = square_pad(h, w)
+            padded_h, padded_w = h + pad[2] + pad[3], w + pad[0] + pad[1]
+        else:
+            # Extract image as PyTorch tensor
+            img = transforms.ToTensor()(Image.open(img_path).convert('RGB'))
+
+            # Handle images with less than three channels
+            if len(img.shape) != 3:
+                img = img.unsqueeze(0)
+                img = img.expand((3, img.shape[1:]))
+
+            _, h, w = img.shape
+            # Pad to square resolution
+            img, pad = pad_to_square(img, 0)
+            _, padded_h, padded_w = img.shape
         h_factor, w_factor = (h, w) if self.normalized_labels else (1, 1)
-        # Pad to square resolution
-        img, pad = pad_to_square(img, 0)
-        _, padded_h, padded_w = img.shape
 
         # ---------
         #  Label
@@ -127,8 +155,15 @@ class ListDataset(Dataset):
         # Apply augmentations
         if self.augment:
             if np.random.random() < 0.5:
-                img, targets = horisontal_flip(img, targets)
-
+                if self.uint8:
+                    # Flip before padding: swap the left and right padding
+                    img, pad = np.ascontiguousarray(img[:, ::-1]), (pad[1], pad[0], pad[2], pad[3])
+                    targets[:, 2] = 1 - targets[:, 2]
+                else:
+                    img, targets = horisontal_flip(img, targets)
+
+        if self.uint8:
+            return img_path, (torch.from_numpy(img), torch.tensor(pad)), targets
         return img_path, img, targets
 
     def collate_fn(self, batch):
@@ -142,8 +177,13 @@ class ListDataset(Dataset):
         # Selects new image size every tenth batch
         if self.multiscale and self.batch_count % 10 == 0:
             self.img_size = random.choice(range(self.min_size, self.max_size + 1, 32))
-        # Resize images to input shape
-        imgs = torch.stack([resize(img, self.img_size) for img in imgs])
+        if self.uint8:
+            # uint8 images, (left, right, top, bottom) padding and input shape for pad_resize_batch()
+            imgs, pads = list(zip(*imgs))
+            imgs = (list(imgs), torch.stack(pads), self.img_size)
+        else:
+            # Resize images to input shape
+            imgs = torch.stack([resize(img, self.img_size) for img in imgs])
         self.batch_count += 1
         return paths, imgs, targets
 
@@ -5,11 +5,14 @@ import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torchvision
 from torch.autograd import Variable
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
+from utils.matching import match_predictions
+
 
 def to_cpu(tensor):
     return tensor.detach().cpu()
@@ -143,42 +146,22 @@ def compute_ap(recall, precision):
 
 
 def get_batch_statistics(outputs, targets, iou_threshold):
-    """ Compute true positives, predicted scores and predicted labels per sample """
-    batch_metrics = []
-    for sample_i in range(len(outputs)):
-
-        if outputs[sample_i] is None:
-            continue
-
-        output = outputs[sample_i]
-        pred_boxes = output[:, :4]
-        pred_scores = output[:, 4]
-        pred_labels = output[:, -1]
-
-        true_positives = np.zeros(pred_boxes.shape[0])
-
-        annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
-        if len(annotations):
-            detected_boxes = []
-            target_boxes = annotations[:, 1:]
-
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
-
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
-
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
-
-                iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores, pred_labels])
-    return batch_metrics
+    """ Compute true positives, predicted scores and predicted labels per sample, all samples matched at once """
+    samples = [i for i, output in enumerate(outputs) if output is not None]
+    if not samples:
+        return []
+    pred = torch.cat([outputs[i] for i in samples], 0)
+    n, m = [len(outputs[i]) for i in samples], len(targets)
+    sample = torch.repeat_interleave(torch.tensor(samples, device=pred.device), torch.tensor(n, device=pred.device))
+    targets = targets.to(pred.device)
+
+    # Any class target of the sample, for predictions of one of the sample target labels (IoU >= iou_threshold)
+    iou = bbox_iou(pred[:, :4].repeat_interleave(m, 0), targets[:, 2:].repeat(len(pred), 1)).view(len(pred), m)
+    true_positives = match_predictions(iou, sample, pred[:, -1], targets[:, 0], targets[:, 1],
+                                       torch.tensor([iou_threshold]), class_aware=False, inclusive=True)[:, 0]
+    true_positives = np.split(true_positives.cpu().numpy().astype(np.float64), np.cumsum(n)[:-1])
+    scores = pred[:, [4, -1]].cpu().split(n)  # scores and labels on the host, one copy per batch
+    return [[tp, x[:, 0], x[:, 1]] for tp, x in zip(true_positives, scores)]
 
 
 def bbox_wh_iou(wh1, wh2):
@@ -226,40 +209,68 @@ def bbox_iou(box1, box2, x1y1x2y2=True):
 def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4):
     """
     Removes detections with lower object confidence score than 'conf_thres' and performs
-    Non-Maximum Suppression to further filter detections.
+    Non-Maximum Suppression to further filter detections, all images of the batch at once.
+    Every kept box is the object confidence weighted mean of the boxes it suppresses (and itself).
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, class_score, class_pred)
     """
-
-    # From (center x, center y, width, height) to (x1, y1, x2, y2)
-    prediction[..., :4] = xywh2xyxy(prediction[..., :4])
     output = [None for _ in range(len(prediction))]
-    for image_i, image_pred in enumerate(prediction):
-        # Filter out confidence scores below threshold
-        image_pred = image_pred[image_pred[:, 4] >= conf_thres]
-        # If none are remaining => process next image
-        if not image_pred.size(0):
+    # Filter out confidence scores below threshold
+    image_i, anchor_i = (prediction[..., 4] >= conf_thres).nonzero(as_tuple=True)
+    if not len(image_i):
+        return output
+    image_pred = prediction[image_i, anchor_i]
+    # From (center x, center y, width, height) to (x1, y1, x2, y2), prediction is left unchanged
+    class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
+    detections = torch.cat((xywh2xyxy(image_pred[:, :4]), image_pred[:, 4:5], class_confs.float(),
+                            class_preds.float()), 1)
+    # Object confidence times class confidence
+    score = image_pred[:, 4] * class_confs[:, 0]
+
+    # Perform non-maximum suppression per image and class, kept boxes by decreasing score
+    group = image_i * (prediction.shape[-1] - 5) + class_preds[:, 0]
+    pixels = detections[:, :4] + detections.new_tensor([0, 0, 1, 1])  # bbox_iou() areas are (x2 - x1 + 1) * (...)
+    keep = torchvision.ops.batched_nms(pixels, score, group, nms_thres)
+
+    # Merge overlapping bboxes: every box into the first kept box (by score) of its image and class that it overlaps.
+    # IoU > nms_thres needs x1 - (1 - nms_thres) * w' < x1' < x1 + (1 - nms_thres) * w and w' < w / nms_thres (w, w'
+    # widths): the candidates of a box are a window of the kept boxes sorted by (group, x1), boxes are matched in chunks
+    # of similar window size
+    x1 = pixels[:, 0].double() - float(pixels[:, 0].min())
+    w = (1 - nms_thres) * (pixels[:, 2].double() - pixels[:, 0].double())
+    w_keep = float(w[keep].max())
+    key = group.double() * (float(x1.max() + w.max()) + w_keep + 2) + x1  # groups do not interleave
+    kkey, order = key[keep].sort()
+    lo = torch.searchsorted(kkey, key - (w / max(nms_thres, 1E-6)).clamp(max=w_keep) - 1)
+    hi = torch.searchsorted(kkey, key + w + 1)
+    b = torch.cat((pixels, (pixels[:, 2:] - pixels[:, :2]).prod(1, keepdim=True)), 1)  # x1, y1, x2, y2, area
+    kb = b[keep[order]].t().contiguous()  # sorted kept boxes
+    owner = torch.full_like(hi, len(keep))
+    r, index = (hi - lo).sort()
+    level = (r + 1).double().log2().ceil()  # chunks of about 4M candidates, at most 2x padding
+    chunks = torch.cat((torch.searchsorted(r.cumsum(0), torch.arange(1, int(r.sum()) // 2 ** 22 + 1,
+                                                                      device=r.device) * 2 ** 22),
+                        (level[1:] != level[:-1]).nonzero(as_tuple=False).view(-1) + 1)).unique().cpu()
+    for j in index.tensor_split(chunks):
+        if not len(j) or not hi[j[-1]] > lo[j[-1]]:
             continue
-        # Object confidence times class confidence
-        score = image_pred[:, 4] * image_pred[:, 5:].max(1)[0]
-        # Sort by it
-        image_pred = image_pred[(-score).argsort()]
-        class_confs, class_preds = image_pred[:, 5:].max(1, keepdim=True)
-        detections = torch.cat((image_pred[:, :5], class_confs.float(), class_preds.float()), 1)
-        # Perform non-maximum suppression
-        keep_boxes = []
-        while detections.size(0):
-            large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
-            label_match = detections[0, -1] == detections[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 4:5]
-            # Merge overlapping bboxes by order of confidence
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]
-        if keep_boxes:
-            output[image_i] = torch.stack(keep_boxes)
+        c = lo[j, None] + torch.arange(int(hi[j[-1]] - lo[j[-1]]), device=lo.device)  # (box, sorted kept box)
+        valid = c < hi[j, None]
+        c = c.clamp(max=len(keep) - 1)
+        bj, bk = b[j].t()[..., None], kb.index_select(1, c.view(-1)).view(5, *c.shape)
+        inter = (torch.min(bj[2], bk[2]) - torch.max(bj[0], bk[0])).clamp(min=0) * \
+                (torch.min(bj[3], bk[3]) - torch.max(bj[1], bk[1])).clamp(min=0)
+        overlap = valid & (inter > nms_thres * (bj[4] + bk[4] - inter))  # IoU > nms_thres
+        owner[j] = torch.where(overlap, order[c], torch.full_like(c, len(keep))).min(1)[0]  # first kept by score
+    weights = detections[:, 4] * (owner < len(keep))
+    owner = owner.clamp(max=len(keep) - 1)
+    merged = detections[keep]
+    merged[:, :4] = merged.new_zeros(len(keep), 4).index_add_(0, owner, weights[:, None] * detections[:, :4]) / \
+                    merged.new_zeros(len(keep)).index_add_(0, owner, weights)[:, None]
+
+    keep_image = image_i[keep]
+    for i in keep_image.unique().tolist():
+        output[i] = merged[keep_image == i]
 
     return output
 
@@ -0,0 +1,138 @@
+# The SAROD cascade (agent, patch routing, both detectors, NMS and scene merging) as one traceable module
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision
+
+from yolov5.utils.utils import scene_nms
+from EfficientObjectDetection.utils import utils_ete
+
+
+def resize(x, size, k=1):
+    # Exportable stand-in for cv2.INTER_AREA/PIL downsampling: average pool by the integer factor k, then bilinear
+    if k > 1:
+        x = F.avg_pool2d(x, k)
+    return F.interpolate(x, size=size, mode='bilinear', align_corners=False)
+
+
+def xywh2xyxy(x):
+    # as yolov5.utils.utils.xywh2xyxy, without in-place writes
+    return torch.stack((x[:, 0] - x[:, 2] / 2, x[:, 1] - x[:, 3] / 2, x[:, 0] + x[:, 2] / 2, x[:, 1] + x[:, 3] / 2), 1)
+
+
+class SARODCascade(nn.Module):
+    """Agent, patch routing, both detectors and NMS of a SARODEngine in one module, for TorchScript and ONNX export
+
+    Input: one scene, uint8 BGR [H, W, 3] tensor of the scene_shape given at construction.
+    Output: detections [n, 6] (x1, y1, x2, y2, conf, cls) in scene pixels, by decreasing conf, and the policy
+    [num_actions] (1 fine, 0 coarse). The routed patches go through the detectors as dynamic batches (empty ones
+    included), so the graph has no data-dependent Python control flow. Resizing runs on the tensor, detections match
+    SARODEngine up to interpolation differences. NMS is best class only (non_max_suppression_batched for nc=1), per
+    patch and then across the patch seams (scene_nms).
+    """
+    def __init__(self, engine, scene_shape=(800, 800)):
+        super(SARODCascade, self).__init__()
+        assert engine.gate is None, 'confidence-gated routing is not exported'
+        self.agent = engine.agent
+        self.coarse, self.fine = (m for m, _ in engine.detectors)
+        self.features = engine.features
+        self.nc = self.fine.model[-1].nc  # number of classes
+        self.half = engine.half
+        self.conf_thres, self.iou_thres = engine.conf_thres, engine.iou_thres
+        self.seam = engine.seam
+        self.max_det = 300  # per patch, as non_max_suppression_batched
+        g = self.grid = engine.grid
+        self.na = g ** 2
+        h, w = self.scene_shape = tuple(scene_shape)
+        self.tile_shape = th, tw = h // g, w // g
+
+        # Agent input: transforms.Scale (shorter side) then CenterCrop, as utils_ete.get_transforms test
+        s = engine.transform.transforms[0].size
+        s = s if isinstance(s, int) else s[0]
+        self.agent_resize = (s, int(s * w / h)) if h <= w else (int(s * h / w), s)
+        self.agent_crop = (int(round((self.agent_resize[0] - s) / 2)), int(round((self.agent_resize[1] - s) / 2)), s)
+        self.agent_k = min(h // self.agent_resize[0], w // self.agent_resize[1])
+        self.register_buffer('mean', torch.tensor(utils_ete.imagenet_mean).view(1, 3, 1, 1) * 255)
+        self.register_buffer('std', torch.tensor(utils_ete.imagenet_std).view(1, 3, 1, 1) * 255)
+
+        # Detector inputs: resize and letterbox as SARODEngine.patch_tensor, and the gain/pad of scale_coords back
+        self.letterbox = []  # per action: resized hw, pool factor, (left, right, top, bottom) padding
+        pads, gains = [], []  # per action: scale_coords pad and gain back to tile pixels
+        for _, size in engine.detectors:
+            r = size / max(th, tw)
+            nh, nw = (int(th * r), int(tw * r)) if r != 1 else (th, tw)
+            dw, dh = (size - nw) / 2, (size - nh) / 2
+            self.letterbox.append(((nh, nw), min(th // nh, tw // nw),
+                                   (int(round(dw - 0.1)), int(round(dw + 0.1)), int(round(dh - 0.1)), int(round(dh + 0.1)))))
+            gain = min(size / th, size / tw)
+            pw, ph = (size - tw * gain) / 2, (size - th * gain) / 2
+            pads.append([pw, ph, pw, ph])
+            gains.append([gain])
+        self.register_buffer('pads', torch.tensor(pads))
+        self.register_buffer('gains', torch.tensor(gains))
+        self.register_buffer('limits', torch.tensor([tw, th, tw, th]).float())  # clip_coords
+        self.register_buffer('offsets', torch.tensor([[c * tw, r * th] * 2 for r in range(g) for c in range(g)]).float())
+        self.register_buffer('rects', self.offsets + torch.tensor([0., 0., tw, th]))  # tiles xyxy in the scene
+
+    def tiles(self, x):
+        # [1, 3, H, W] scene to [na, 3, th, tw] tiles, row-major patch index
+        g, (th, tw) = self.grid, self.tile_shape
+        x = x[:, :, :g * th, :g * tw].reshape(3, g, th, g, tw)
+        return x.permute(1, 3, 0, 2, 4).reshape(g * g, 3, th, tw)
+
+    def detect(self, action, tiles, index, features=False):
+        # candidates of detector action on tiles[index]: boxes in letterboxed pixels [n, 4], conf [n], cls [n],
+        # patch index [n] (and the pooled Detect() input features per tile)
+        model = (self.coarse, self.fine)[action]
+        hw, k, padding = self.letterbox[action]
+        img = F.pad(resize(tiles.index_select(0, index), hw, k), padding, value=114.) / 255.0
+        img = img.half() if self.half else img
+        if features:
+            (inf_out, _), feats = model(img, features=True)
+            feats = torch.cat([f.float().mean((2, 3)) for f in feats], 1)
+        else:
+            inf_out, feats = model(img)[0], None
+        inf_out = inf_out.float()
+
+        # Best class of every anchor above conf_thres (objectness first, as non_max_suppression_batched)
+        conf, j = (inf_out[..., 5:] * inf_out[..., 4:5]).max(2)
+        keep = (inf_out[..., 4] > self.conf_thres) & (conf > self.conf_thres)
+        b, a = keep.nonzero(as_tuple=True)
+        return xywh2xyxy(inf_out[b, a, :4]), conf[b, a], j[b, a].float(), index[b], feats
+
+    def forward(self, scene):
+        x = scene.permute(2, 0, 1).unsqueeze(0).float()[:, [2, 1, 0]]  # BGR HWC uint8 to RGB [1, 3, H, W] float
+        tiles = self.tiles(x)
+        everything = torch.arange(self.na, device=x.device)
+
+        if self.features:
+            # Coarse pass over every patch, the agent routes on its features
+            coarse = self.detect(0, tiles, everything, features=True)
+            policy = (torch.sigmoid(self.agent(coarse[4].view(1, self.na, -1))) >= 0.5).view(-1)
+            kept = ~policy[coarse[3]]  # coarse candidates of the patches left coarse
+            coarse = [c[kept] for c in coarse[:4]]
+        else:
+            # Agent on the resized, center cropped and normalized scene
+            top, left, s = self.agent_crop
+            a = resize(x, self.agent_resize, self.agent_k)[:, :, top:top + s, left:left + s]
+            a = (a - self.mean) / self.std
+            policy = (torch.sigmoid(self.agent(a)) >= 0.5).view(-1)
+            coarse = self.detect(0, tiles, everything[~policy])[:4]
+        fine = self.detect(1, tiles, everything[policy])[:4]
+
+        # NMS per patch (loop unrolled over the constant number of patches) and class, in letterboxed pixels, then
+        # scale_coords to tile pixels and offset to the scene, then NMS across the patch seams
+        boxes, conf, cls, patch = (torch.cat(x, 0) for x in zip(coarse, fine))
+        action = torch.cat((torch.zeros_like(coarse[3]), torch.ones_like(fine[3])))
+        output, rects = [], []
+        for k in range(self.na):
+            m = (patch == k).nonzero(as_tuple=True)[0]
+            i = m[torchvision.ops.nms(boxes[m] + cls[m, None] * 4096, conf[m], self.iou_thres)[:self.max_det]]
+            a = action[i]
+            b = torch.min(((boxes[i] - self.pads[a]) / self.gains[a]).clamp(min=0), self.limits) + self.offsets[k]
+            output.append(torch.cat((b, conf[i, None], cls[i, None]), 1))
+            rects.append(self.rects[k] + torch.zeros_like(b))
+        det = torch.cat(output, 0)
+        det = scene_nms(det, torch.zeros_like(det[:, 0]).long(), torch.cat(rects, 0), 1, self.iou_thres,
+                        seam=self.seam)[0]
+        return det, policy.long()
@@ -0,0 +1,101 @@
+# Agent inputs preprocessed once into a uint8 memory-mapped array, normalized on the device (utils_ete.normalize_inputs)
+import argparse
+import glob
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from EfficientObjectDetection.utils import utils_ete
+from yolov5.utils.datasets_rl import load_scene
+
+
+class AgentInputStore:
+    """Resized and cropped agent inputs of a set of scenes, uint8 RGB CHW [n, 3, img_size, img_size]
+
+    Files: <root>/agent_<img_size>.npy (memory-mapped array) and <root>/agent_<img_size>.json (absolute scene path
+    of every row). update() preprocesses the scenes not stored yet with the test transform minus ToTensor/Normalize,
+    so rows equal the former PIL pipeline up to the final float normalization.
+    """
+    def __init__(self, root='save/agent_inputs', img_size=480):
+        self.img_size = img_size
+        self.file = os.path.join(root, 'agent_%g' % img_size)
+        self.transform = utils_ete.get_transforms(img_size)[1].transforms[:2]  # Scale, CenterCrop
+        self.images = None  # opened on first access (also in DataLoader workers)
+        self.index = {}
+        if os.path.isfile(self.file + '.json') and os.path.isfile(self.file + '.npy'):
+            with open(self.file + '.json') as f:
+                self.index = {p: i for i, p in enumerate(json.load(f))}
+
+    def __getstate__(self):
+        return {k: (None if k == 'images' else v) for k, v in self.__dict__.items()}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.index
+
+    def __getitem__(self, path):
+        # uint8 tensor [3, img_size, img_size] of a scene
+        if self.images is None:
+            self.images = np.load(self.file + '.npy', mmap_mode='r')
+        return torch.from_numpy(np.array(self.images[self.index[os.path.abspath(path)]]))  # copy of the row
+
+    def preprocess(self, path):
+        if path.endswith('.npy'):  # memory-mapped BGR scene
+            img = Image.fromarray(np.ascontiguousarray(load_scene(path)[:, :, ::-1]))
+        else:
+            img = Image.open(path).convert('RGB')
+        for t in self.transform:
+            img = t(img)
+        return np.asarray(img).transpose(2, 0, 1)  # HWC to CHW
+
+    def update(self, paths):
+        # Preprocess the scenes not stored yet, then rewrite the array with the stored rows first
+        new = [p for p in dict.fromkeys(os.path.abspath(p) for p in paths) if p not in self.index]
+        if not new:
+            return self
+        n, s = len(self.index), self.img_size
+        root = os.path.dirname(self.file) or '.'
+        os.makedirs(root, exist_ok=True)
+        # unique temporary files replaced atomically: concurrent updates of the same store never leave a partial
+        # array or index, and the array (stored rows unchanged) is replaced before the index that refers to it
+        with tempfile.NamedTemporaryFile(dir=root, prefix=os.path.basename(self.file), suffix='.tmp.npy',
+                                         delete=False) as f:
+            tmp = f.name
+        images = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(n + len(new), 3, s, s))
+        if n:
+            images[:n] = np.load(self.file + '.npy', mmap_mode='r')
+        for i, p in enumerate(tqdm(new, desc='Preprocessing agent inputs (%g new)' % len(new))):
+            images[n + i] = self.preprocess(p)
+        images.flush()
+        del images
+        self.images = None  # release the memory map before replacing the file
+        os.chmod(tmp, 0o644)  # readable like the former array, not 0600 as created
+        os.replace(tmp, self.file + '.npy')
+        self.index.update({p: n + i for i, p in enumerate(new)})
+        with tempfile.NamedTemporaryFile('w', dir=root, prefix=os.path.basename(self.file), suffix='.tmp.json',
+                                         delete=False) as f:
+            json.dump(sorted(self.index, key=self.index.get), f)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, self.file + '.json')
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', nargs='+', required=True, help='scene directories or files')
+    parser.add_argument('--root', default='save/agent_inputs', help='store directory')
+    parser.add_argument('--img_size', type=int, default=480, help='agent input size')
+    opt = parser.parse_args()
+
+    files = []
+    for s in opt.source:
+        files += sorted(glob.glob(os.path.join(s, '*.*'))) if os.path.isdir(s) else [s]
+    store = AgentInputStore(opt.root, opt.img_size).update(files)
+    print('%g scenes in %s.npy' % (len(store), store.file))
@@ -2,15 +2,21 @@ import pandas as pd
 import numpy as np
 import warnings
 import os
+import torch
 
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataloader import default_collate
 from PIL import Image
 
+from EfficientObjectDetection.constants import num_actions
+from yolov5.utils.datasets_rl import load_scene, patch_key, scene_path
+
 Image.MAX_IMAGE_PIXELS = None
 warnings.simplefilter('ignore', Image.DecompressionBombWarning)
 
 class CustomDatasetFromImages(Dataset):
-    def __init__(self, fine_data, coarse_data, transform):
+    def __init__(self, fine_data, coarse_data, transform, num_actions=num_actions, image_cache=None, image_size=480,
+                 store=None, features=False):
         """
         Args:
             fine_data (list): list of fine evaluation results [source img name, patch path, precision, recall,
@@ -18,19 +24,31 @@ class CustomDatasetFromImages(Dataset):
             coarse_data (list): list of coarse evaluation results [source img name, patch path, precision, recall,
             average precision, mean of loss, counts of object]
             transform: pytorch transforms for transforms and tensor conversion
+            num_actions (int): number of windows (patches) per source image
+            image_cache (ImageCache): shared cache of decoded source images, read at image_size
+            store (AgentInputStore): preprocessed uint8 source images, returned instead of transformed ones
+            features (bool): return the pooled coarse-detector features of the windows [num_actions, channels]
+            (last element of the coarse results) instead of the source image
         """
         # Transforms
         self.transforms = transform
+        self.num_actions = num_actions
+        self.image_cache = image_cache
+        self.image_size = image_size
+        self.store = store
+        self.features = features
 
         # [source img name, patch path, precision, recall, average precision, mean of loss, counts of object]
-        self.fine_data = fine_data
-        self.fine_data.sort(key=lambda element: element[1])
-        self.coarse_data = coarse_data
-        self.coarse_data.sort(key=lambda element: element[1])
+        # joined per source image by patch index, scenes missing a patch in either result list are dropped
+        self.fine_data = index_results(fine_data, self.num_actions)
+        self.coarse_data = index_results(coarse_data, self.num_actions)
+        self.scenes = [s for s, x in self.fine_data.items()
+                       if None not in x and None not in self.coarse_data.get(s, [None])]
+        if store is not None and not features:
+            store.update(self.scenes)
 
         # Calculate len
-        if len(self.fine_data) == len(self.coarse_data):
-            self.data_len = len(self.fine_data) / 4
+        self.data_len = len(self.scenes)
 
         # Second column is the image paths
         # self.image_arr = np.asarray(data_info.iloc[:, 1])
@@ -38,65 +56,58 @@ class CustomDatasetFromImages(Dataset):
         # self.label_arr = np.asarray(data_info.iloc[:, 0])
 
     def __getitem__(self, index):
-        index = index * 4
-        source_path = os.sep.join(self.fine_data[index][1].split(os.sep)[:-4])
-        source_path = os.path.join(source_path, self.fine_data[index][1].split(os.sep)[-3], 'images', self.fine_data[index][0]) + '.jpg'
+        source_path = self.scenes[index]
         # print('\ncomplete_source_path', source_path)
 
-        img_as_img = Image.open(source_path)
-
-        # Transform the image
-        img_as_tensor = self.transforms(img_as_img)
+        if self.features:  # input of the feature agent, no image decode
+            img_as_tensor = torch.stack([x[8] for x in self.coarse_data[source_path]]).float()
+        elif self.store is not None:  # preprocessed uint8, normalized on the device by utils_ete.normalize_inputs
+            img_as_tensor = self.store[source_path]
+        else:
+            cached = self.image_cache.get(source_path, self.image_size) if self.image_cache is not None else None
+            if cached is not None:  # decoded and resized once, shared with the detectors
+                img_as_img = Image.fromarray(np.ascontiguousarray(cached[0][:, :, ::-1]))
+            elif source_path.endswith('.npy'):  # memory-mapped BGR scene
+                img_as_img = Image.fromarray(np.ascontiguousarray(load_scene(source_path)[:, :, ::-1]))
+            else:
+                img_as_img = Image.open(source_path)
+
+            # Transform the image
+            img_as_tensor = self.transforms(img_as_img)
 
         # Get label(class) of the image based on the cropped pandas column
         # single_image_label = self.label_arr[index]
 
-        f_p, c_p = [], []
-        f_r, c_r = [], []
-        f_ap, c_ap = [], []
-        f_loss, c_loss = [], []
-        f_ob, c_ob = [], []
-        f_stats, c_stats = [], []
-
+        # Per-window results of the fine and coarse detectors
         target_dict = dict()
+        fine, coarse = self.fine_data[source_path], self.coarse_data[source_path]
+        for key, j in (('p', 2), ('r', 3), ('ap', 4), ('loss', 5), ('ob', 6), ('stats', 7)):
+            target_dict['f_' + key] = [x[j] for x in fine]
+            target_dict['c_' + key] = [x[j] for x in coarse]
 
-        for i in range(4):
-
-            f_p.append(self.fine_data[index+i][2])
-            c_p.append(self.coarse_data[index + i][2])
-
-            f_r.append(self.fine_data[index + i][3])
-            c_r.append(self.coarse_data[index + i][3])
-
-            f_ap.append(self.fine_data[index + i][4])
-            c_ap.append(self.coarse_data[index + i][4])
+        return img_as_tensor, target_dict
 
-            f_loss.append(self.fine_data[index + i][5])
-            c_loss.append(self.coarse_data[index + i][5])
+    def __len__(self):
+        return int(self.data_len)
 
-            f_ob.append(self.fine_data[index + i][6])
-            c_ob.append(self.coarse_data[index + i][6])
 
-            f_stats.append(self.fine_data[index+i][7])
-            c_stats.append(self.coarse_data[index+i][7])
+def collate_per_sample_stats(batch):
+    # default collation, except the variable-length detector stats: a list of batch_size per-sample
+    # [num_actions][stats] lists, as ReplayBuffer.push() takes them
+    stats = {k: [t[k] for _, t in batch] for k in ('f_stats', 'c_stats')}
+    inputs, targets = default_collate([(x, {k: v for k, v in t.items() if k not in stats}) for x, t in batch])
+    targets.update(stats)
+    return inputs, targets
 
-        target_dict['f_p'] = f_p
-        target_dict['c_p'] = c_p
-        target_dict['f_r'] = f_r
-        target_dict['c_r'] = c_r
-        target_dict['f_ap'] = f_ap
-        target_dict['c_ap'] = c_ap
-        target_dict['f_loss'] = f_loss
-        target_dict['c_loss'] = c_loss
-        target_dict['f_ob'] = f_ob
-        target_dict['c_ob'] = c_ob
-        target_dict['f_stats'] = f_stats
-        target_dict['c_stats'] = c_stats
 
-        return img_as_tensor, target_dict
-
-    def __len__(self):
-        return int(self.data_len)
+def index_results(data, num_actions):
+    # {source image path: [result of window 0, ..., result of window num_actions - 1]} of per-patch results
+    index = {}
+    for x in data:
+        i = patch_key(x[1])[1]
+        if 0 <= i < num_actions:
+            index.setdefault(scene_path(x[1]), [None] * num_actions)[i] = x
+    return index
 
 
 class CustomDatasetFromImages_test(Dataset):
@@ -0,0 +1,166 @@
+# Per-window detections, AP and object counts of a detector in one memory-mapped file (make_detect_info, make_map)
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from EfficientObjectDetection.constants import num_windows
+
+
+def image_key(image_id):
+    # 'data/test/images/P0001.jpg', 'P0001.npy' and 'P0001' are the same image
+    return os.path.splitext(os.path.basename(str(image_id)))[0]
+
+
+class DetectionStore:
+    """Detections [n, 7] (x1, y1, x2, y2, conf, cls_conf, cls), AP and object count of every window of a set of images
+
+    One file: a header, the chunks written by flush() (columns image, window, ap, objects, count and the concatenated
+    detections of the chunk, 64-byte aligned), then a JSON footer (image ids, chunk offsets and sizes) and a trailer
+    with the footer offset. The file is memory-mapped (copy-on-write): read() returns views of the stored detections.
+    A field appended again for a window replaces the former value; unset fields read as AP NaN, objects -1 and
+    detections None. flush() writes the pending records over the former footer, an interrupted flush leaves the file
+    unreadable.
+    """
+    magic = b'SARODDS1'
+    align = 64
+    columns = (('image', np.int32), ('window', np.int32), ('ap', np.float32), ('objects', np.int32),
+               ('count', np.int32))
+
+    def __init__(self, file, windows=num_windows ** 2, flush_every=4096):
+        self.file, self.windows, self.flush_every = file, windows, flush_every
+        self.ids, self.chunks, self.end = [], [], self.align  # footer: image ids and chunks, end of the chunks
+        self.pending = []  # appended records not flushed yet
+        self.data = None  # memory map and resolved index, opened on first read (also in DataLoader workers)
+        if os.path.isfile(file):
+            with open(file, 'rb') as f:
+                f.seek(-24, os.SEEK_END)
+                offset, size = np.frombuffer(f.read(16), '<u8')
+                assert f.read(8) == self.magic, '%s is not a detection store' % file
+                f.seek(int(offset))
+                footer = json.loads(f.read(int(size)).decode())
+            assert footer['windows'] == windows, '%s has %g windows per image' % (file, footer['windows'])
+            self.ids, self.chunks, self.end = footer['images'], footer['chunks'], int(offset)
+        self.images = {k: i for i, k in enumerate(self.ids)}
+
+    def __getstate__(self):
+        return {k: (None if k == 'data' else v) for k, v in self.__dict__.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, image_id):
+        return image_key(image_id) in self.images
+
+    @classmethod
+    def layout(cls, rows, detections):
+        # byte offsets of the columns of a chunk (from the chunk offset), and the chunk size
+        offsets, size = {}, 0
+        for name, dtype, n in [c + (rows,) for c in cls.columns] + [('detections', np.float32, detections * 7)]:
+            offsets[name] = (size, dtype, n)
+            size += -(-n * np.dtype(dtype).itemsize // cls.align) * cls.align
+        return offsets, size
+
+    def append(self, image_id, window, detections=None, ap=None, objects=None):
+        """Adds the detections [n, 7], AP and/or object count of a window, written by the next flush()"""
+        assert 0 <= window < self.windows, 'window %g out of range' % window
+        if detections is not None:
+            detections = np.asarray(detections, dtype=np.float32).reshape(-1, 7)
+        self.pending.append((image_key(image_id), int(window), detections, np.nan if ap is None else float(ap),
+                             -1 if objects is None else int(objects)))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+        return self
+
+    def flush(self):
+        """Writes the pending records as one chunk, then the footer"""
+        if not self.pending:
+            return self
+        for k, *_ in self.pending:
+            if k not in self.images:
+                self.images[k] = len(self.ids)
+                self.ids.append(k)
+        key, window, det, ap, objects = zip(*self.pending)
+        det = [np.zeros((0, 7), np.float32) if d is None else d for d in det]
+        columns = {'image': [self.images[k] for k in key], 'window': window, 'ap': ap, 'objects': objects,
+                   'count': [-1 if r[2] is None else len(r[2]) for r in self.pending],
+                   'detections': np.concatenate(det, 0)}
+        offsets, size = self.layout(len(key), len(columns['detections']))
+
+        os.makedirs(os.path.dirname(self.file) or '.', exist_ok=True)
+        self.data = None  # release the memory map before writing
+        with open(self.file, 'r+b' if os.path.isfile(self.file) else 'w+b') as f:
+            if not self.chunks:
+                f.write(self.magic.ljust(self.align, b'\0'))
+            for name, (o, dtype, _) in offsets.items():
+                f.seek(self.end + o)
+                f.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            self.chunks.append({'offset': self.end, 'rows': len(key), 'detections': len(columns['detections'])})
+            self.end += size
+            footer = json.dumps({'windows': self.windows, 'images': self.ids, 'chunks': self.chunks}).encode()
+            f.seek(self.end)
+            f.write(footer + np.array([self.end, len(footer)], '<u8').tobytes() + self.magic)
+            f.truncate()
+        self.pending = []
+        return self
+
+    def open(self):
+        # memory map of the file and the latest value of every field of every window
+        data = np.memmap(self.file, mode='c') if self.chunks else np.zeros(0, np.uint8)
+        n, w = len(self.ids), self.windows
+        ap, objects = np.full((n, w), np.nan, np.float32), np.full((n, w), -1, np.int32)
+        chunk, start, count = np.zeros((n, w), np.int32), np.zeros((n, w), np.int64), np.full((n, w), -1, np.int32)
+        detections = []
+        for c, x in enumerate(self.chunks):
+            offsets, _ = self.layout(x['rows'], x['detections'])
+            col = {name: data[x['offset'] + o:x['offset'] + o + k * np.dtype(dtype).itemsize].view(dtype)
+                   for name, (o, dtype, k) in offsets.items()}
+            detections.append(col.pop('detections').reshape(-1, 7))
+            i = col['image'] * w + col['window']
+            m = ~np.isnan(col['ap'])
+            ap.flat[i[m]] = col['ap'][m]
+            m = col['objects'] >= 0
+            objects.flat[i[m]] = col['objects'][m]
+            m = col['count'] >= 0
+            chunk.flat[i[m]] = c
+            start.flat[i[m]] = (np.cumsum(col['count'].clip(0)) - col['count'].clip(0))[m]
+            count.flat[i[m]] = col['count'][m]
+        self.data = {'map': data, 'ap': ap, 'objects': objects, 'chunk': chunk, 'start': start, 'count': count,
+                     'detections': detections}
+        return self.data
+
+    def read(self, image_ids):
+        """
+        Returns:
+            ap: float32 [len(image_ids), windows], NaN if not stored
+            objects: int32 [len(image_ids), windows], -1 if not stored
+            detections: per image, per window float32 [n, 7] view of the file or None if not stored
+        """
+        self.flush()
+        data = self.data or self.open()
+        rows = np.array([self.images[image_key(i)] for i in image_ids], dtype=np.int64)
+        detections = [[None if n < 0 else data['detections'][c][s:s + n] for c, s, n in zip(*x)]
+                      for x in zip(data['chunk'][rows], data['start'][rows], data['count'][rows])]
+        return {'ap': data['ap'][rows], 'objects': data['objects'][rows], 'detections': detections}
+
+
+if __name__ == '__main__':
+    # Converts the per-window .npy files of make_detect_info.py (<image>_<row>_<col>.npy) and make_map.py (<image>.npy,
+    # [num_windows, num_windows] AP) into a store
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--detections', default='', help='directory of the per-window detections')
+    parser.add_argument('--metrics', default='', help='directory of the per-image window AP')
+    parser.add_argument('--file', required=True, help='store file')
+    opt = parser.parse_args()
+
+    store = DetectionStore(opt.file)
+    for f in sorted(glob.glob(os.path.join(opt.detections, '*.npy'))) if opt.detections else []:
+        image_id, row, col = image_key(f).rsplit('_', 2)
+        store.append(image_id, int(row) * num_windows + int(col), detections=np.load(f))
+    for f in sorted(glob.glob(os.path.join(opt.metrics, '*.npy'))) if opt.metrics else []:
+        for k, ap in enumerate(np.load(f).flatten()):
+            store.append(f, k, ap=ap)
+    store.flush()
+    print('%g images in %s' % (len(store), store.file))
@@ -0,0 +1,182 @@
+import os
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from EfficientObjectDetection.utils import utils_ete
+from EfficientObjectDetection.constants import num_windows, img_size_fd, img_size_cd
+from yolov5.models.experimental import attempt_load
+from yolov5.utils.datasets_rl import letterbox
+from yolov5.utils.utils import non_max_suppression_batched, merge_scene_detections, scale_coords, box_iou, xywh2xyxy
+from yolov5.utils.torch_utils import inference_mode, prepare_model, warmup
+from yolov5.utils.matching import match_predictions
+
+
+class SARODEngine():
+    """Agent and both detectors loaded once for batched scene inference
+
+    The agent chooses fine (1) or coarse (0) for every patch of a batch of scenes, then the patches routed to each
+    detector go through one forward pass and one NMS. Patch detections are mapped back to scene pixels and merged
+    across the patch seams (merge_scene_detections).
+    A feature agent (utils_ete.FeaturePolicy) routes on the pooled features of a coarse pass over every patch instead
+    of the scene image: the coarse detections are kept for the patches it leaves coarse. A gate (utils_ete.gate_policy)
+    routes on the uncertainty of these coarse detections instead, without any agent pass.
+    """
+    def __init__(self, agent, fine_model, coarse_model, img_size=480, fine_size=img_size_fd, coarse_size=img_size_cd,
+                 grid=num_windows, conf_thres=0.001, iou_thres=0.6, device=None, half=None, channels_last=None,
+                 fuse=False, seam=4., gate=None):
+        self.device = device or next((agent or coarse_model).parameters()).device
+        self.agent = agent.to(self.device).eval() if agent is not None else None
+        self.features = isinstance(agent, utils_ete.FeaturePolicy)
+        self.gate = gate  # utils_ete.gate_policy() kwargs, routing on the coarse detections instead of the agent
+        assert agent is not None or gate is not None, 'an agent or a gate routes the patches'
+        self.detectors = []  # (model, img_size) indexed by action
+        for model, size in ((coarse_model, coarse_size), (fine_model, fine_size)):
+            # fp16 on CUDA, channels_last on CPU unless set
+            model, self.half, self.channels_last = prepare_model(model, self.device, half, channels_last, fuse)
+            self.detectors.append((model, size))
+        if self.channels_last and not self.features and self.agent is not None:
+            self.agent.to(memory_format=torch.channels_last)
+        self.transform = utils_ete.get_transforms(img_size)[1]
+        self.grid = grid
+        self.conf_thres, self.iou_thres = conf_thres, iou_thres
+        self.seam = seam  # (pixels) boxes cut by a patch border are fused by merge_scene_detections()
+
+        # Warm up
+        for model, size in self.detectors:
+            warmup(model, (1, 3, size, size), self.device, self.half, self.channels_last)
+
+    @classmethod
+    def from_weights(cls, agent_weights, fine_weights, coarse_weights, device, grid=num_windows, features=False,
+                     **kwargs):
+        fine_model = attempt_load(fine_weights, map_location=device)
+        coarse_model = attempt_load(coarse_weights, map_location=device)
+        if agent_weights is None:  # routed by a gate
+            agent = None
+        elif features:
+            agent = utils_ete.get_feature_model(sum(coarse_model.feature_channels()), grid ** 2)
+        else:
+            agent = utils_ete.get_model(grid ** 2)
+        if agent is not None:
+            agent.load_state_dict(torch.load(agent_weights, map_location=device)['agent'])
+        kwargs.setdefault('fuse', True)  # own copies of the detectors
+        return cls(agent, fine_model, coarse_model, grid=grid, device=device, **kwargs)
+
+    def tiles(self, scene):
+        # grid x grid tiles of a scene (row-major, as the patch index) and their (x, y) offsets
+        h, w = scene.shape[0] // self.grid, scene.shape[1] // self.grid
+        offsets = [(c * w, r * h) for r in range(self.grid) for c in range(self.grid)]
+        return [scene[y:y + h, x:x + w] for x, y in offsets], offsets
+
+    @staticmethod
+    def patch_tensor(tile, size):
+        # resize and letterbox a BGR tile like the detector dataloaders, to a 3 x size x size RGB uint8 tensor
+        h0, w0 = tile.shape[:2]
+        r = size / max(h0, w0)
+        if r != 1:
+            tile = cv2.resize(tile, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR)
+        img = letterbox(tile, size, auto=False, scaleup=False)[0]
+        return torch.from_numpy(np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1)))
+
+    def detect(self, action, index, tiles, features=False):
+        # One forward pass and one NMS of detector action over the tiles index [(scene, patch), ...], detections in
+        # tile pixels (and the pooled Detect() input features per tile)
+        model, size = self.detectors[action]
+        img = torch.stack([self.patch_tensor(tiles[b][0][k], size) for b, k in index]).to(self.device)
+        img = img.half() if self.half else img.float()  # uint8 to fp16/32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        img = img.contiguous(memory_format=torch.channels_last) if self.channels_last else img
+        if features:
+            (inf_out, _), feats = model(img, features=True)
+            feats = torch.cat([x.float().mean((2, 3)) for x in feats], 1)
+        else:
+            inf_out, feats = model(img)[0], None
+        output = non_max_suppression_batched(inf_out, conf_thres=self.conf_thres, iou_thres=self.iou_thres)
+        for (b, k), pred in zip(index, output):
+            if pred is not None:
+                pred[:, :4] = scale_coords(img.shape[2:], pred[:, :4], tiles[b][0][k].shape[:2])  # to tile
+        return output, feats
+
+    def __call__(self, scenes):
+        """
+        Args:
+            scenes: list of scene image paths or BGR arrays
+        Returns:
+            per scene: detections (n, 6) in scene pixels, list of patch detections (n, 6) in tile pixels or None,
+            policy (num_actions,)
+        """
+        scenes = [cv2.imread(s) if isinstance(s, str) else s for s in scenes]
+        tiles = [self.tiles(s) for s in scenes]
+        na = self.grid ** 2
+        patches = [[None] * na for _ in scenes]
+        with inference_mode():
+            if self.features or self.gate is not None:
+                # Coarse pass over every patch, the agent routes on its features or the gate on its detections, only
+                # fine patches run again
+                index = [(b, k) for b in range(len(scenes)) for k in range(na)]
+                output, feats = self.detect(0, index, tiles, features=self.gate is None)
+                for (b, k), pred in zip(index, output):
+                    patches[b][k] = pred
+                if self.gate is not None:
+                    confs = [None if pred is None else pred[:, 4] for pred in output]
+                    policy = utils_ete.gate_policy(confs, **self.gate).long().view(len(scenes), na)
+                else:
+                    policy = (torch.sigmoid(self.agent(feats.view(len(scenes), na, -1))) >= 0.5).long().cpu()
+                actions = (1,)
+            else:
+                # Actions by the Policy Network for the whole batch
+                inputs = torch.stack([self.transform(Image.fromarray(s[:, :, ::-1])) for s in scenes]).to(self.device)
+                inputs = inputs.contiguous(memory_format=torch.channels_last) if self.channels_last else inputs
+                policy = (torch.sigmoid(self.agent(inputs)) >= 0.5).long().cpu()
+                actions = (0, 1)
+
+            # One forward pass and one NMS per detector over the patches routed to it
+            for action in actions:
+                index = (policy == action).nonzero(as_tuple=False).tolist()
+                if not index:
+                    continue
+                for (b, k), pred in zip(index, self.detect(action, index, tiles)[0]):
+                    patches[b][k] = pred
+
+        # Patch detections (in tile pixels already) to scene pixels, NMS across the patch seams
+        shapes = [(tile.shape[:2], ((1., 1.), (0., 0.))) for t, _ in tiles for tile in t]
+        dets = merge_scene_detections([x for pred in patches for x in pred], shapes, grid=self.grid,
+                                      iou_thres=self.iou_thres, seam=self.seam)
+        return [(det.to(self.device), pred, p) for det, pred, p in zip(dets, patches, policy)]
+
+
+def patch_statistics(pred, labels, iouv):
+    """
+    Args:
+        pred: tensor, shape [n, 6] (x1, y1, x2, y2, conf, cls) or None
+        labels: tensor, shape [m, 5] (cls, x1, y1, x2, y2) in the pixels of pred
+        iouv: tensor, IoU thresholds
+    Returns:
+        list of (correct, conf, pcls, tcls) as appended by test_rl, empty if there is nothing to count
+    """
+    nl, niou = len(labels), iouv.numel()
+    tcls = labels[:, 0].tolist() if nl else []  # target class
+    if pred is None:
+        return [(torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls)] if nl else []
+
+    # Match the predictions to the targets (one patch)
+    labels = labels.to(pred.device)
+    correct = match_predictions(box_iou(pred[:, :4], labels[:, 1:5]), pred.new_zeros(len(pred)), pred[:, 5],
+                                labels.new_zeros(nl), labels[:, 0], iouv)
+
+    # Append statistics (correct, conf, pcls, tcls)
+    return [(correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls)]
+
+
+def load_patch_labels(label_path, ind, shape):
+    # labels of patch ind of a scene (rl_ver label file) as (cls, x1, y1, x2, y2) in tile pixels
+    f = label_path.replace('data/', 'data/rl_ver/').replace('.txt', '_' + str(ind) + '.txt')
+    l = np.zeros((0, 5), dtype=np.float32)
+    if os.path.isfile(f):
+        with open(f, 'r') as fi:
+            l = np.array([x.split() for x in fi.read().splitlines()], dtype=np.float32).reshape(-1, 5)
+    labels = torch.from_numpy(l)
+    labels[:, 1:5] = xywh2xyxy(labels[:, 1:5]) * torch.Tensor([shape[1], shape[0], shape[1], shape[0]])
+    return labels
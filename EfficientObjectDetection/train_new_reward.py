@@ -4,10 +4,10 @@ import torch.utils.data as torchdata
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+import cv2
 import tqdm
 import torch.optim as optim
 import torch.backends.cudnn as cudnn
-from collections import deque
 import pickle
 import pylab
 cudnn.benchmark = True
@@ -15,13 +15,17 @@ import argparse
 from torch.autograd import Variable
 # from tensorboard_logger import configure, log_value
 from torch.distributions import Bernoulli
-from collections import deque
-import random
 
 from EfficientObjectDetection.utils import utils_ete, utils_detector
+from EfficientObjectDetection.utils.replay_buffer import ReplayBuffer
+from EfficientObjectDetection.dataset.dataloader_ete import collate_per_sample_stats
+from EfficientObjectDetection.utils.ap_accumulator import APAccumulator, to_numpy
+from EfficientObjectDetection.dataset.agent_store import AgentInputStore
+from EfficientObjectDetection.engine import SARODEngine, patch_statistics, load_patch_labels
 from EfficientObjectDetection.constants import base_dir_metric_cd, base_dir_metric_fd
 from EfficientObjectDetection.constants import num_actions
 import yolov5.utils.utils as yoloutil
+from yolov5.utils.torch_utils import select_device, inference_mode, warmup, autocast, grad_scaler
 
 import warnings
 warnings.simplefilter("ignore")
@@ -34,36 +38,69 @@ class EfficientOD():
         self.result_fine = None
         self.result_coarse = None
         self.epoch = None
+        self.sarod_engine = None
         gpu_id = self.opt.gpu_id
-        self.buffer = deque(maxlen=20000)
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(gpu_id)
-        use_cuda = torch.cuda.is_available()
-        print("GPU device for EfficientOD: ", use_cuda)
+        self.device = select_device(str(gpu_id))  # 'cpu' runs the whole agent on CPU
+        print("Device for EfficientOD: ", self.device)
+
+        # Agent inputs: pooled coarse-detector features, images preprocessed once to uint8 (normalized on the device)
+        # or images transformed per item
+        self.features = self.opt.get('agent', 'resnet34') == 'features'
+        self.store = AgentInputStore(self.opt.agent_store, self.opt.img_size) \
+            if self.opt.get('agent_store') and not self.features else None
+        self.buffer = ReplayBuffer(self.opt.get('buffer_size', 20000), num_actions,
+                                   image_dtype=torch.float16 if self.store is None else torch.uint8,
+                                   pin_memory=self.device.type != 'cpu')
 
         if not os.path.exists(self.opt.cv_dir):
             print(self.opt.cv_dir)
             os.makedirs(self.opt.cv_dir)
         # utils_ete.save_args(__file__, self.opt)
 
-        self.agent = utils_ete.get_model(num_actions)
-        self.critic = utils_ete.critic_model(1)
+        if self.features:  # policy head on the features of the coarse detector pass
+            self.agent = utils_ete.get_feature_model(self.opt.feature_channels, num_actions)
+            self.critic = utils_ete.get_feature_model(self.opt.feature_channels, 1, scene_output=True)
+        else:
+            self.agent = utils_ete.get_model(num_actions)
+            self.critic = utils_ete.critic_model(1)
 
         # ---- Load the pre-trained model ----------------------
         if self.opt.load is not None:
             path = os.path.join('weights', self.opt.load)
-            checkpoint = torch.load(path)
+            checkpoint = torch.load(path, map_location=self.device)
             self.agent.load_state_dict(checkpoint['agent'])
             print('loaded agent from %s' % opt.load)
 
         # Parallelize the models if multiple GPUs available - Important for Large Batch Size to Reduce Variance
         if self.opt.parallel:
             agent = nn.DataParallel(self.agent)
-        self.agent.cuda()
-        self.critic.cuda()
+        self.agent.to(self.device)
+        self.critic.to(self.device)
+
+        # Image agents in channels_last on CPU unless set, warm-up pass
+        self.channels_last = self.opt.get('channels_last')
+        if self.channels_last is None:
+            self.channels_last = self.device.type == 'cpu'
+        self.channels_last = self.channels_last and not self.features
+        if self.channels_last:
+            self.agent.to(memory_format=torch.channels_last)
+            self.critic.to(memory_format=torch.channels_last)
+        self.agent.eval()
+        warmup(self.agent, (1, num_actions, self.opt.feature_channels) if self.features else
+               (1, 3, self.opt.img_size, self.opt.img_size), self.device, channels_last=self.channels_last)
 
         # Update the parameters of the policy network
         self.optimizer_agent = optim.Adam(self.agent.parameters(), lr=self.opt.lr)
-        self.optimizer_critic = optim.Adam(self.agent.parameters(), lr=self.opt.lr)
+        self.optimizer_critic = optim.Adam(self.critic.parameters(), lr=self.opt.lr)
+
+        # Mixed precision: 'fp16' (scaled losses) or 'bf16' autocast, also on CPU
+        self.precision = self.opt.get('precision', 'fp32')
+        self.scaler = grad_scaler(self.device, self.precision)
+
+        # Test time routing: the agent, or a gate on the uncertainty of the coarse detections (no agent pass)
+        self.routing = self.opt.get('routing', 'agent')
+        self.gate = {'gate': self.opt.get('gate', 'band'), 'band': tuple(self.opt.get('gate_band', (0.1, 0.5))),
+                     'thres': self.opt.get('gate_thres', 1.)}
 
     def train(self, epoch, result_fine, result_coarse):
         # Start training and testing
@@ -71,121 +108,98 @@ class EfficientOD():
         self.result_fine = result_fine
         self.result_coarse = result_coarse
 
-        trainset = utils_ete.get_dataset(self.opt.img_size, self.result_fine, self.result_coarse, 'train')
+        trainset = utils_ete.get_dataset(self.opt.img_size, self.result_fine, self.result_coarse, 'train',
+                                        image_cache=self.opt.get('image_cache'), store=self.store,
+                                        features=self.features)
         trainloader = torchdata.DataLoader(trainset, batch_size=self.opt.batch_size, shuffle=True,
-                                           num_workers=self.opt.num_workers)
+                                           num_workers=self.opt.num_workers, collate_fn=collate_per_sample_stats)
 
         p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
         for epoch in range(self.epoch, self.epoch + 1):
             self.agent.train()
-            rewards, rewards_baseline, policies, stats_list, efficiency = [], [], [], [], []
+            rewards, rewards_baseline, policies, efficiency = [], [], [], []
+            accumulator = APAccumulator()
             for batch_idx, (inputs, targets) in tqdm.tqdm(enumerate(trainloader), total=len(trainloader)):
 
                 f_ap = targets['f_ap']
-                f_ap = torch.cat(f_ap, dim=0).view([-1, 4])
+                f_ap = torch.stack(f_ap, 1)
 
                 c_ap = targets['c_ap']
-                c_ap = torch.cat(c_ap, dim=0).view([-1, 4])
+                c_ap = torch.stack(c_ap, 1)
 
                 f_stats = targets['f_stats']
                 c_stats = targets['c_stats']
 
                 f_ob = targets['f_ob']
-                f_ob = torch.cat(f_ob, dim=0).view([-1, 4])
+                f_ob = torch.stack(f_ob, 1)
                 c_ob = targets['c_ob']
-                c_ob = torch.cat(c_ob, dim=0).view([-1, 4])
+                c_ob = torch.stack(c_ob, 1)
 
-                self.buffer.append([inputs.numpy(), f_ap, c_ap, f_stats, c_stats, f_ob, c_ob])
+                self.buffer.push(inputs, f_ap, c_ap, f_ob, c_ob, f_stats, c_stats)  # batch_size samples
 
             pbar = tqdm.tqdm(range((epoch+1)*6))
             for i in pbar:
-                # if len(self.buffer)>= 100:
-                minibatch = random.sample(self.buffer, self.opt.step_batch_size)
-                # else:
-                # continue
-
-                minibatch = np.array(minibatch)
-
-                inputs, f_ap, c_ap = minibatch[:, 0].tolist(), minibatch[:, 1], minibatch[:, 2]
-                f_stats, c_stats = minibatch[:, -4], minibatch[:, -3]
-                f_ob, c_ob = minibatch[:, -2], minibatch[:, -1]
-
-                # inputs = Variable(inputs)
-                # if not self.opt.parallel:
-                inputs = torch.tensor(inputs).squeeze().cuda()
-                # Actions by the Agent
-                probs = F.sigmoid(self.agent.forward(inputs))
+                inputs, f_ap, c_ap, f_ob, c_ob, f_stats, c_stats = self.buffer.sample(self.opt.step_batch_size,
+                                                                                      self.device)
+                inputs = self.agent_inputs(inputs)
+
+                # Actions by the Agent, value by the critic
+                with autocast(self.device, self.precision):
+                    probs = F.sigmoid(self.agent.forward(inputs)).float()
+                    value = self.critic(inputs).float()
                 alpha_hp = np.clip(self.opt.alpha + epoch * 0.001, 0.6, 0.95)
                 probs = probs * alpha_hp + (1 - alpha_hp) * (1 - probs)
 
-                # Sample the policies from the Bernoulli distribution characterized by agent
+                # Sample K policies per image from the Bernoulli distribution characterized by agent
                 distr = Bernoulli(probs)
-                policy_sample = distr.sample()
+                policy_sample = distr.sample((self.opt.get('num_samples', 1),))  # [K, batch_size, num_actions]
 
                 # Test time policy - used as baseline policy in the training step
                 policy_map = probs.data.clone()
                 policy_map[policy_map < 0.5] = 0.0
                 policy_map[policy_map >= 0.5] = 1.0
-                policy_map = Variable(policy_map)
-
-                # Get the batch wise metrics
-                # f_p, c_p, f_r, c_r, f_ap, c_ap, f_loss, c_loss, f_ob, c_ob, f_stats, c_stats
 
-                # Find the reward for baseline and sampled policy
-                f_ap = [np.concatenate(x, axis=0) for x in zip(*f_ap)]
-                c_ap = [np.concatenate(x, axis=0) for x in zip(*c_ap)]
-                f_ob = [np.concatenate(x, axis=0) for x in zip(*f_ob)]
-                c_ob = [np.concatenate(x, axis=0) for x in zip(*c_ob)]
-
-                f_ap = torch.from_numpy(f_ap[0].reshape((-1, 4)))
-                c_ap = torch.from_numpy(c_ap[0].reshape((-1, 4)))
-                f_ob = torch.from_numpy(f_ob[0].reshape((-1, 4)))
-                c_ob = torch.from_numpy(c_ob[0].reshape((-1, 4)))
-                f_ob = f_ob.float()
-                c_ob = c_ob.float()
-
-                reward_map = utils_ete.compute_reward_sarod(f_ap, c_ap, f_ob, c_ob, policy_map.cpu().data, self.opt.beta, self.opt.sigma)
-                reward_sample = utils_ete.compute_reward_sarod(f_ap, c_ap, f_ob, c_ob, policy_sample.cpu().data, self.opt.beta,
-                                                         self.opt.sigma)
-                advantage = reward_sample.cuda().float() - reward_map.cuda().float()
+                # Find the reward for baseline and sampled policies in one batched call on the device
+                reward = utils_ete.compute_reward_sarod_batched(f_ap, c_ap, f_ob, c_ob,
+                                                                torch.cat((policy_map.unsqueeze(0), policy_sample)),
+                                                                self.opt.beta, self.opt.sigma)
+                reward_map, reward_sample = reward[0], reward[1:]
+                advantage = reward_sample - reward_map
 
                 # Find the loss for only the policy network
                 loss = distr.log_prob(policy_sample)
-                loss = loss * Variable(advantage).expand_as(policy_sample)
-                # loss = loss.expand_as(policy_sample)
+                loss = loss * advantage.expand_as(policy_sample)
                 loss = loss.mean()
-                # print('\1', sum(self.critic(inputs)))
-                # print('\1', sum(reward_map))
-                loss = loss + F.smooth_l1_loss(sum(self.critic(inputs)), sum(reward_map.cuda().float()))
+                loss = loss + F.smooth_l1_loss(sum(value), sum(reward_map))
 
                 self.optimizer_agent.zero_grad()
                 self.optimizer_critic.zero_grad()
-                loss.backward()
-                self.optimizer_agent.step()
-                self.optimizer_critic.step()
-
-                rewards.append(reward_sample.cpu())
-                rewards_baseline.append(reward_map.cpu())
-                policies.append(policy_sample.data.cpu())
-
-                for batch in range(self.opt.step_batch_size):
-                    for ind, policy_element in enumerate(policy_sample.cpu().data[batch]):
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer_agent)
+                self.scaler.step(self.optimizer_critic)
+                self.scaler.update()
+
+                rewards.append(reward_sample.view(-1, 1))
+                rewards_baseline.append(reward_map)
+                policies.append(policy_sample.view(-1, num_actions))
+
+                policy = policy_sample[0].cpu()  # first sample of every image for the AP and efficiency
+                for batch in range(len(f_stats)):
+                    for ind, policy_element in enumerate(policy[batch]):
                         efficiency.append(policy_element)
                         if i == 0:
                             for stats in c_stats[batch][ind]:
-                                stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0), torch.squeeze(stats[2], 0), stats[3]))
+                                accumulator.update(*stats)
                         elif i == 1:
                             for stats in f_stats[batch][ind]:
-                                stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0), torch.squeeze(stats[2], 0), stats[3]))
+                                accumulator.update(*stats)
 
-            cal_stats_list = [np.concatenate(x, 0) for x in zip(*stats_list)]
-            if len(cal_stats_list) and cal_stats_list[0].any():
-                p, r, ap, f1, ap_class = yoloutil.ap_per_class(*cal_stats_list)
-                p, r, ap50, ap = p[:, 0], r[:, 0], ap[:, 0], ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-                mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+            if accumulator.any():
+                mp, mr, map50, map = accumulator.summary()
                 # pbar.set_description(('\n{} Epoch {} Step - RL Train AP: {} '.format(epoch, i, map50)))
 
-            reward, sparsity, variance, policy_set = utils_ete.performance_stats(policies, rewards)
+            reward, sparsity, variance, policy_set = utils_ete.performance_stats([torch.cat(policies).cpu()],
+                                                                                 [torch.cat(rewards).cpu()])
 
             print('\n{} Epoch - RL Train mean AP: {} / Efficiency: {} '.format(epoch, map50, sum(efficiency)/len(efficiency)))
             print('Train: %d | Rw: %.6f | S: %.3f | V: %.3f | #: %d' % (epoch, reward, sparsity, variance, len(policy_set)))
@@ -203,6 +217,7 @@ class EfficientOD():
             }
             if self.epoch % 10 == 0:
                 torch.save(state, self.opt.cv_dir + '/ckpt_E_{}'.format(self.epoch))
+        return result  # epoch, reward, sparsity, variance, AP50, efficiency
 
     def eval(self, epoch, test_fine, test_coarse):
 
@@ -211,19 +226,21 @@ class EfficientOD():
 
         self.agent.eval()
 
-        testset = utils_ete.get_dataset(self.opt.img_size, self.test_fine, self.test_coarse, 'eval')
+        testset = utils_ete.get_dataset(self.opt.img_size, self.test_fine, self.test_coarse, 'eval',
+                                       image_cache=self.opt.get('image_cache'), store=self.store,
+                                       features=self.features)
         testloader = torchdata.DataLoader(testset, batch_size=self.opt.batch_size, shuffle=True,
                                           num_workers=self.opt.num_workers)
 
         p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
-        rewards, metrics, policies, set_labels, stats_list, efficiency = [], [], [], [], [], []
+        rewards, metrics, policies, set_labels, efficiency = [], [], [], [], []
+        accumulator = APAccumulator()
         for batch_idx, (inputs, targets) in tqdm.tqdm(enumerate(testloader), total=len(testloader)):
-            inputs = Variable(inputs, volatile=True)
-            # if not self.opt.parallel:
-            inputs = torch.tensor(inputs).cuda()
+            inputs = self.agent_inputs(inputs)
 
             # Actions by the Policy Network
-            probs = F.sigmoid(self.agent(inputs))
+            with inference_mode(), autocast(self.device, self.precision):
+                probs = F.sigmoid(self.agent(inputs)).float()
 
             # Sample the policy from the agents output
             policy = probs.data.clone()
@@ -231,21 +248,21 @@ class EfficientOD():
             policy[policy >= 0.5] = 1.0
             policy = Variable(policy)
 
-            # offset_fd, offset_cd = utils_ete.read_offsets(targets, num_actions)
+            # offset_fd, offset_cd = utils_ete.read_offsets(targets, num_actions, self.device)
             # f_p, c_p, f_r, c_r, f_ap, c_ap, f_loss, c_loss, f_ob, c_ob
             f_ap = targets['f_ap']
-            f_ap = torch.cat(f_ap, dim=0).view([-1, 4])
+            f_ap = torch.stack(f_ap, 1)
 
             c_ap = targets['c_ap']
-            c_ap = torch.cat(c_ap, dim=0).view([-1, 4])
+            c_ap = torch.stack(c_ap, 1)
 
             f_stats = targets['f_stats']
             c_stats = targets['c_stats']
 
             f_ob = targets['f_ob']
-            f_ob = torch.cat(f_ob, dim=0).view([-1, 4])
+            f_ob = torch.stack(f_ob, 1)
             c_ob = targets['c_ob']
-            c_ob = torch.cat(c_ob, dim=0).view([-1, 4])
+            c_ob = torch.stack(c_ob, 1)
 
             f_ob = f_ob.float()
             c_ob = c_ob.float()
@@ -260,21 +277,16 @@ class EfficientOD():
                 efficiency.append(i)
                 if i == 0:
                     for stats in c_stats[ind]:
-                        stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0),
-                                           torch.squeeze(stats[2], 0), stats[3]))
+                        accumulator.update(*stats)
                 elif i == 1:
                     for stats in f_stats[ind]:
-                        stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0),
-                                           torch.squeeze(stats[2], 0), stats[3]))
+                        accumulator.update(*stats)
 
 
         reward, sparsity, variance, policy_set = utils_ete.performance_stats(policies, rewards)
 
-        cal_stats_list = [np.concatenate(x, 0) for x in zip(*stats_list)]
-        if len(cal_stats_list) and cal_stats_list[0].any():
-            p, r, ap, f1, ap_class = yoloutil.ap_per_class(*cal_stats_list)
-            p, r, ap50, ap = p[:, 0], r[:, 0], ap[:, 0], ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-            mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+        if accumulator.any():
+            mp, mr, map50, map = accumulator.summary()
 
         print('{} Epoch - RL Eval AP: {} / Efficiency: {} '.format(epoch, map50, sum(efficiency)/len(efficiency)))
         print('RL Eval - Rw: %.4f | S: %.3f | V: %.3f | #: %d\n' % (reward, sparsity, variance, len(policy_set)))
@@ -282,6 +294,7 @@ class EfficientOD():
         result = epoch, reward.cpu().item(), sparsity.cpu().item(), variance.cpu().item(), map50, sum(efficiency)/len(efficiency)
         with open(self.opt.cv_dir+'/rl_eval.txt', 'a') as f:
             f.write(str(result)+'\n')
+        return result
 
         # # save the model --- agent
         # agent_state_dict = self.agent.module.state_dict() if self.opt.parallel else self.agent.state_dict()
@@ -293,47 +306,55 @@ class EfficientOD():
         # if self.epoch % 5 == 0:
         #     torch.save(state, self.opt.cv_dir+'/ckpt_E_%d_R_%.2E'%(self.epoch, reward))
 
-    def test(self, epoch, test_fine, test_coarse):
-
+    def test(self, epoch, test_fine, test_coarse, routing=None):
+        routing = routing or self.routing  # 'agent' or 'gate'
         self.test_fine = test_fine
         self.test_coarse = test_coarse
 
         self.agent.eval()
 
-        testset = utils_ete.get_dataset(self.opt.img_size, self.test_fine, self.test_coarse, 'eval')
+        testset = utils_ete.get_dataset(self.opt.img_size, self.test_fine, self.test_coarse, 'eval',
+                                       image_cache=self.opt.get('image_cache'), store=self.store,
+                                       features=self.features)
         testloader = torchdata.DataLoader(testset, batch_size=self.opt.batch_size, shuffle=True,
                                           num_workers=self.opt.num_workers)
 
         p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
-        rewards, metrics, policies, set_labels, stats_list, efficiency = [], [], [], [], [], []
+        rewards, metrics, policies, set_labels, efficiency = [], [], [], [], []
+        accumulator = APAccumulator()
         for batch_idx, (inputs, targets) in tqdm.tqdm(enumerate(testloader), total=len(testloader)):
-            inputs = Variable(inputs, volatile=True)
-            # if not self.opt.parallel:
-            inputs = torch.tensor(inputs).cuda()
-
-            # Actions by the Policy Network
-            probs = F.sigmoid(self.agent(inputs))
-
-            # Sample the policy from the agents output
-            policy = probs.data.clone()
-            policy[policy < 0.5] = 0.0
-            policy[policy >= 0.5] = 1.0
-            policy = Variable(policy)
+            if routing == 'gate':
+                # Actions by the gate on the coarse detections of every patch (of the first image, as the AP below)
+                confs = [np.concatenate([to_numpy(s[1]).ravel() for s in stats] + [np.zeros(0)])
+                         for stats in targets['c_stats']]
+                policy = utils_ete.gate_policy(confs, **self.gate).view(1, -1)
+            else:
+                inputs = self.agent_inputs(inputs)
+
+                # Actions by the Policy Network
+                with inference_mode(), autocast(self.device, self.precision):
+                    probs = F.sigmoid(self.agent(inputs)).float()
+
+                # Sample the policy from the agents output
+                policy = probs.data.clone()
+                policy[policy < 0.5] = 0.0
+                policy[policy >= 0.5] = 1.0
+                policy = Variable(policy)
 
             # f_p, c_p, f_r, c_r, f_ap, c_ap, f_loss, c_loss, f_ob, c_ob
             f_ap = targets['f_ap']
-            f_ap = torch.cat(f_ap, dim=0).view([-1, 4])
+            f_ap = torch.stack(f_ap, 1)
 
             c_ap = targets['c_ap']
-            c_ap = torch.cat(c_ap, dim=0).view([-1, 4])
+            c_ap = torch.stack(c_ap, 1)
 
             f_stats = targets['f_stats']
             c_stats = targets['c_stats']
 
             f_ob = targets['f_ob']
-            f_ob = torch.cat(f_ob, dim=0).view([-1, 4])
+            f_ob = torch.stack(f_ob, 1)
             c_ob = targets['c_ob']
-            c_ob = torch.cat(c_ob, dim=0).view([-1, 4])
+            c_ob = torch.stack(c_ob, 1)
 
             f_ob = f_ob.float()
             c_ob = c_ob.float()
@@ -348,119 +369,91 @@ class EfficientOD():
                 efficiency.append(i)
                 if i == 0:
                     for stats in c_stats[ind]:
-                        stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0),
-                                           torch.squeeze(stats[2], 0), stats[3]))
+                        accumulator.update(*stats)
                 elif i == 1:
                     for stats in f_stats[ind]:
-                        stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0),
-                                           torch.squeeze(stats[2], 0), stats[3]))
+                        accumulator.update(*stats)
 
         reward, sparsity, variance, policy_set = utils_ete.performance_stats(policies, rewards)
 
-        cal_stats_list = [np.concatenate(x, 0) for x in zip(*stats_list)]
-        if len(cal_stats_list) and cal_stats_list[0].any():
-            p, r, ap, f1, ap_class = yoloutil.ap_per_class(*cal_stats_list)
-            p, r, ap50, ap = p[:, 0], r[:, 0], ap[:, 0], ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-            mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+        if accumulator.any():
+            mp, mr, map50, map = accumulator.summary()
 
-        print('{} Epoch - RL Test AP: {} / Efficiency: {} '.format(epoch, map50, sum(efficiency)/len(efficiency)))
-        print('RL Test - Rw: %.4f | S: %.3f | V: %.3f | #: %d\n' % (reward, sparsity, variance, len(policy_set)))
+        name = 'RL Test' if routing == 'agent' else 'Gate Test'
+        print('{} Epoch - {} AP: {} / Efficiency: {} '.format(epoch, name, map50, sum(efficiency)/len(efficiency)))
+        print('%s - Rw: %.4f | S: %.3f | V: %.3f | #: %d\n' % (name, reward, sparsity, variance, len(policy_set)))
 
         result = epoch, reward.cpu().item(), sparsity.cpu().item(), variance.cpu().item(), map50, sum(efficiency)/len(efficiency)
-        with open(self.opt.cv_dir+'/rl_test.txt', 'a') as f:
+        with open(self.opt.cv_dir + ('/rl_test.txt' if routing == 'agent' else '/gate_test.txt'), 'a') as f:
             f.write(str(result)+'\n')
+        return result
+
+    def agent_inputs(self, inputs):
+        # Batch of agent inputs on the device: normalized if preprocessed to uint8, channels_last if set
+        inputs = inputs.to(self.device, non_blocking=True)
+        if self.store is not None:
+            inputs = utils_ete.normalize_inputs(inputs)
+        if self.channels_last:
+            inputs = inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    def engine(self, fine_detector, coarse_detector):
+        # Agent and both detectors held once by a SARODEngine for batched scene inference
+        if self.sarod_engine is None:
+            ema = [d.ema.ema.module if hasattr(d.ema.ema, 'module') else d.ema.ema for d in (fine_detector, coarse_detector)]
+            self.sarod_engine = SARODEngine(self.agent, ema[0], ema[1], img_size=self.opt.img_size,
+                                       fine_size=fine_detector.imgsz_test, coarse_size=coarse_detector.imgsz_test,
+                                       gate=self.gate if self.routing == 'gate' else None)
+        return self.sarod_engine
 
     def test_wip(self, fine_detector, coarse_detector):
 
         self.agent.eval()
-
-        testset = utils_ete.get_dataset_test(self.opt.img_size, img_path=self.opt.test_path)
-        testloader = torchdata.DataLoader(testset, batch_size=self.opt.batch_size, shuffle=True,
-                                          num_workers=self.opt.num_workers)
-
-        p, r, f1, mp, mr, map50, map, t0, t1, c_map50, f_map50 = 0., 0., 0., 0., 0., 0., 0., 0., 0., 0., 0.
-        stats_list, metrics, policies, set_labels, c_stats_list, f_stats_list, efficiency = [], [], [], [], [], [], []
-        for batch_idx, (inputs, label_path) in tqdm.tqdm(enumerate(testloader), total=len(testloader)):
-            inputs = Variable(inputs, volatile=True)
-            # if not self.opt.parallel:
-            inputs = torch.tensor(inputs).cuda()
-
-            # Actions by the Policy Network
-            probs = F.sigmoid(self.agent(inputs))
-
-            # Sample the policy from the agents output
-            policy = probs.data.clone()
-            policy[policy < 0.5] = 0.0
-            policy[policy >= 0.5] = 1.0
-            policy = Variable(policy)
-
-            for ind, i in enumerate(policy.cpu().data[0]):
-                efficiency.append(i)
-                if i == 0:
-                    c_stats = coarse_detector.test(inputs, label_path, ind)
-                    for c_stat in c_stats:
-                        # stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0),
-                        #                    torch.squeeze(stats[2], 0), stats[3]))
-                        c_stats_list.append(c_stat)
-                        stats_list.append(c_stat)
-                elif i == 1:
-                    f_stats = fine_detector.test(inputs, label_path, ind)
-                    for f_stat in f_stats:
-                        # stats_list.append((torch.squeeze(stats[0], 0), torch.squeeze(stats[1], 0),
-                        #                    torch.squeeze(stats[2], 0), stats[3]))
-                        f_stats_list.append(f_stat)
-                        stats_list.append(f_stat)
-
-            policies.append(policy.data)
-
-        cal_stats_list = [np.concatenate(x, 0) for x in zip(*stats_list)]
-        c_cal_stats_list = [np.concatenate(x, 0) for x in zip(*c_stats_list)]
-        f_cal_stats_list = [np.concatenate(x, 0) for x in zip(*f_stats_list)]
-        if len(cal_stats_list) and cal_stats_list[0].any():
-            p, r, ap, f1, ap_class = yoloutil.ap_per_class(*cal_stats_list)
-            p, r, ap50, ap = p[:, 0], r[:, 0], ap[:, 0], ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-            mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-        if len(c_cal_stats_list) and c_cal_stats_list[0].any():
-            c_p, c_r, c_ap, c_f1, c_ap_class = yoloutil.ap_per_class(*c_cal_stats_list)
-            c_p, c_r, c_ap50, c_ap = c_p[:, 0], c_r[:, 0], c_ap[:, 0], c_ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-            c_mp, c_mr, c_map50, c_map = c_p.mean(), c_r.mean(), c_ap50.mean(), c_ap.mean()
-        if len(f_cal_stats_list) and f_cal_stats_list[0].any():
-            f_p, f_r, f_ap, f_f1, f_ap_class = yoloutil.ap_per_class(*f_cal_stats_list)
-            f_p, f_r, f_ap50, f_ap = f_p[:, 0], f_r[:, 0], f_ap[:, 0], f_ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-            f_mp, f_mr, f_map50, f_map = f_p.mean(), f_r.mean(), f_ap50.mean(), f_ap.mean()
+        engine = self.engine(fine_detector, coarse_detector)
+
+        files = sorted(os.listdir(self.opt.test_path))
+        iouv = torch.linspace(0.5, 0.95, 10)  # iou vector for mAP@0.5:0.95
+        mp, mr, map50, map, c_map50, f_map50 = 0., 0., 0., 0., 0., 0.
+        accumulator, c_accumulator, f_accumulator, efficiency = APAccumulator(), APAccumulator(), APAccumulator(), []
+        for batch_idx in tqdm.tqdm(range(0, len(files), self.opt.batch_size)):
+            paths = [os.path.join(self.opt.test_path, f) for f in files[batch_idx:batch_idx + self.opt.batch_size]]
+            scenes = [cv2.imread(f) for f in paths]
+            for path, scene, (_, patches, policy) in zip(paths, scenes, engine(scenes)):
+                label_path = path.replace('images', 'labels').replace('.jpg', '.txt')
+                shape = (scene.shape[0] // engine.grid, scene.shape[1] // engine.grid)  # tile shape
+                for ind, (pred, i) in enumerate(zip(patches, policy.tolist())):
+                    efficiency.append(i)
+                    for stats in patch_statistics(pred, load_patch_labels(label_path, ind, shape), iouv):
+                        accumulator.update(*stats)
+                        (f_accumulator if i == 1 else c_accumulator).update(*stats)
+
+        if accumulator.any():
+            mp, mr, map50, map = accumulator.summary()
+        if c_accumulator.any():
+            c_mp, c_mr, c_map50, c_map = c_accumulator.summary()
+        if f_accumulator.any():
+            f_mp, f_mr, f_map50, f_map = f_accumulator.summary()
 
         # print('Fine Detector AP: {}'.format(f_map50))
         print('Coarse Detector AP: {} / Fine Detector AP: {}'.format(c_map50, f_map50))
         print('RL Test AP: {} / Efficiency: {} '.format(map50, sum(efficiency)/len(efficiency)))
 
-    def visualization(self, fine_detector, coarse_detector):
+    def visualization(self, fine_detector, coarse_detector, conf_thres=0.3):
 
         self.agent.eval()
-
-        testset = utils_ete.get_dataset_test(self.opt.img_size, img_path=self.opt.test_path)
-        testloader = torchdata.DataLoader(testset, batch_size=self.opt.batch_size, shuffle=True,
-                                          num_workers=self.opt.num_workers)
-
-        result = {}
-        for batch_idx, (inputs, label_path) in tqdm.tqdm(enumerate(testloader), total=len(testloader)):
-            inputs = Variable(inputs, volatile=True)
-            # if not self.opt.parallel:
-
-            inputs = torch.tensor(inputs).cuda()
-
-            # Actions by the Policy Network
-            probs = F.sigmoid(self.agent(inputs))
-
-            # Sample the policy from the agents output
-            policy = probs.data.clone()
-            policy[policy < 0.5] = 0.0
-            policy[policy >= 0.5] = 1.0
-            policy = Variable(policy)
-
-            for ind, i in enumerate(policy.cpu().data[0]):
-                # print('policy', ind, i)
-                if i == 0:
-                    coarse_detector.test(inputs, label_path, ind, i)
-
-                elif i == 1:
-                    fine_detector.test(inputs, label_path, ind, i)
+        engine = self.engine(fine_detector, coarse_detector)
+
+        out = 'image/visualization'
+        os.makedirs(out, exist_ok=True)
+        files = sorted(os.listdir(self.opt.test_path))
+        for batch_idx in tqdm.tqdm(range(0, len(files), self.opt.batch_size)):
+            names = files[batch_idx:batch_idx + self.opt.batch_size]
+            scenes = [cv2.imread(os.path.join(self.opt.test_path, f)) for f in names]
+            for name, scene, (det, _, policy) in zip(names, scenes, engine(scenes)):
+                h, w = scene.shape[0] // engine.grid, scene.shape[1] // engine.grid
+                for ind, i in enumerate(policy.tolist()):  # patch grid, red: fine, blue: coarse
+                    x, y = ind % engine.grid * w, ind // engine.grid * h
+                    cv2.rectangle(scene, (x, y), (x + w - 1, y + h - 1), (0, 0, 255) if i == 1 else (255, 0, 0), 2)
+                for *xyxy, conf, cls in det[det[:, 4] > conf_thres].tolist():
+                    yoloutil.plot_one_box(xyxy, scene, label='%.2f' % conf, color=(0, 255, 0), line_thickness=1)
+                cv2.imwrite(os.path.join(out, '{}_{}'.format(''.join(str(i) for i in policy.tolist()), name)), scene)
@@ -0,0 +1,151 @@
+import numpy as np
+import torch
+
+from EfficientObjectDetection.utils.ap_accumulator import to_numpy
+
+
+def ranges(start, count):
+    # concatenated np.arange(s, s + n) of every (s, n)
+    offset = np.cumsum(count) - count
+    return np.repeat(start - offset, count) + np.arange(count.sum(), dtype=np.int64)
+
+
+class ReplayBuffer():
+    """Ring buffer of agent training samples backed by fixed-shape tensors
+
+    Images are stored as image_dtype (fp16 for normalized inputs, uint8 for raw ones), AP and object counts as
+    float32 [N, num_actions]. The detector stats of a sample are variable-length: their rows are appended to a flat
+    stats store (correct bool [P, niou], conf and pred_cls float32 [P, 2], target_cls float32 [T]), one record per
+    (correct, conf, pred_cls, target_cls) tuple holds the offsets of its rows, and every slot the offsets of its
+    records. The store is compacted once the records of overwritten slots outnumber the live ones. The storage grows
+    by doubling up to capacity and stays in pageable memory; with pin_memory only the sampled batch is staged in
+    pinned memory for the copy to the device.
+    """
+    def __init__(self, capacity=20000, num_actions=4, image_dtype=torch.float16, pin_memory=False):
+        self.capacity = capacity
+        self.num_actions = num_actions
+        self.image_dtype = image_dtype
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.size = 0  # number of filled slots
+        self.pos = 0  # next slot to write
+        self.images = None  # allocated on the first push, grown by doubling up to capacity
+        self.metrics = None  # float32 [N, 4, num_actions]: f_ap, c_ap, f_ob, c_ob
+        self.slot_records = np.zeros((capacity, 2), dtype=np.int64)  # first record and number of records per slot
+        self.stats = None  # flat stats store, allocated on the first push
+        self.ends = {}  # filled rows of every array of the stats store
+        self.staging = None  # pinned buffer for sampled images, the only pinned memory
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, n, shape):
+        images = torch.empty((n,) + tuple(shape), dtype=self.image_dtype)
+        metrics = torch.empty((n, 4, self.num_actions), dtype=torch.float32)
+        if self.images is not None:  # keep the filled slots
+            images[:self.size] = self.images[:self.size]
+            metrics[:self.size] = self.metrics[:self.size]
+        self.images, self.metrics = images, metrics
+
+    def _append(self, name, x):
+        # appends the rows x to the stats array name, grown by doubling; returns the offset of the first row
+        a, end = self.stats[name], self.ends[name]
+        if end + len(x) > len(a):
+            self.stats[name] = np.empty((max(2 * len(a), end + len(x)),) + a.shape[1:], dtype=a.dtype)
+            self.stats[name][:end] = a[:end]
+        self.stats[name][end:end + len(x)] = x
+        self.ends[name] = end + len(x)
+        return end
+
+    def _push_stats(self, slot, f_stats, c_stats):
+        # stats of one sample, [num_actions][stats] lists of the fine and coarse detectors
+        records, correct, preds, targets = [], [], [], []
+        p, t = self.ends['preds'], self.ends['targets']
+        for d, windows in enumerate((f_stats, c_stats)):
+            for w, patches in enumerate(windows):
+                for stats in patches:
+                    c, conf, pred_cls, target_cls = (to_numpy(x) for x in stats)
+                    conf, pred_cls, target_cls = conf.ravel(), pred_cls.ravel(), target_cls.ravel()
+                    records.append((d, w, p, len(conf), t, len(target_cls)))
+                    correct.append(c.reshape(len(conf), self.stats['correct'].shape[1]))
+                    preds.append(np.stack((conf, pred_cls), 1))
+                    targets.append(target_cls)
+                    p, t = p + len(conf), t + len(target_cls)
+        if records:
+            self._append('correct', np.concatenate(correct, 0))
+            self._append('preds', np.concatenate(preds, 0))
+            self._append('targets', np.concatenate(targets, 0))
+        self.slot_records[slot] = self._append('records', np.array(records, dtype=np.int64).reshape(-1, 6)), \
+            len(records)
+
+    def _compact(self):
+        # drops the stats of overwritten slots: the live records, in slot order, and their rows to new arrays
+        start, count = self.slot_records[:, 0], self.slot_records[:, 1]
+        records = self.stats['records'][ranges(start, count)]
+        p, t = ranges(records[:, 2], records[:, 3]), ranges(records[:, 4], records[:, 5])
+        self.stats = {'correct': self.stats['correct'][p], 'preds': self.stats['preds'][p],
+                      'targets': self.stats['targets'][t], 'records': records}
+        self.ends = {k: len(v) for k, v in self.stats.items()}
+        records[:, 2] = np.cumsum(records[:, 3]) - records[:, 3]
+        records[:, 4] = np.cumsum(records[:, 5]) - records[:, 5]
+        self.slot_records[:, 0] = np.cumsum(count) - count
+
+    def push(self, inputs, f_ap, c_ap, f_ob, c_ob, f_stats, c_stats):
+        """
+        Args:
+            inputs: tensor, shape [batch_size, 3, H, W]
+            f_ap, c_ap, f_ob, c_ob: tensor, shape [batch_size, num_actions]
+            f_stats, c_stats: list of batch_size per-sample stats
+        """
+        n = inputs.shape[0]
+        if self.images is None or (len(self.images) < self.capacity and self.pos + n > len(self.images)):
+            self._allocate(min(max(2 * self.size, self.pos + n, 256), self.capacity), inputs.shape[1:])
+        if self.stats is None:
+            niou = next((s[0].shape[-1] for x in f_stats + c_stats for w in x for s in w), 10)
+            self.stats = {'correct': np.zeros((0, niou), dtype=bool), 'preds': np.zeros((0, 2), dtype=np.float32),
+                          'targets': np.zeros(0, dtype=np.float32), 'records': np.zeros((0, 6), dtype=np.int64)}
+            self.ends = {k: 0 for k in self.stats}
+
+        slots = (self.pos + torch.arange(n)) % self.capacity
+        self.images[slots] = inputs.to(self.image_dtype)
+        self.metrics[slots] = torch.stack((f_ap, c_ap, f_ob, c_ob), 1).float().view(n, 4, -1)
+        for j, s in enumerate(slots.tolist()):
+            self._push_stats(s, f_stats[j], c_stats[j])
+        if self.ends['records'] > 2 * self.slot_records[:, 1].sum() + 1024:
+            self._compact()
+
+        self.pos = (self.pos + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size, device=None):
+        """Samples batch_size distinct slots
+
+        Returns:
+            inputs (on device, float32), f_ap, c_ap, f_ob, c_ob (float32 [batch_size, num_actions]),
+            f_stats, c_stats (lists of batch_size per-sample [num_actions][stats] lists of views of the stats store)
+        """
+        idx = torch.randperm(self.size)[:batch_size]
+        n = len(idx)
+        if self.pin_memory:
+            if self.staging is None or len(self.staging) < n:
+                self.staging = torch.empty((n,) + self.images.shape[1:], dtype=self.image_dtype).pin_memory()
+            inputs = torch.index_select(self.images, 0, idx, out=self.staging[:n])
+        else:
+            inputs = self.images[idx]
+        metrics = self.metrics[idx]
+        if device is not None:
+            inputs = inputs.to(device, non_blocking=True)
+            metrics = metrics.to(device, non_blocking=True)
+        inputs = inputs.float()
+
+        f_ap, c_ap, f_ob, c_ob = metrics.unbind(1)
+        correct, preds, targets = self.stats['correct'], self.stats['preds'], self.stats['targets']
+        stats = [], []
+        for s in idx.tolist():
+            start, count = self.slot_records[s]
+            sample = [[] for _ in range(self.num_actions)], [[] for _ in range(self.num_actions)]
+            for d, w, p, n_pred, t, n_target in self.stats['records'][start:start + count].tolist():
+                sample[d][w].append((correct[p:p + n_pred], preds[p:p + n_pred, 0], preds[p:p + n_pred, 1],
+                                     targets[t:t + n_target]))
+            stats[0].append(sample[0])
+            stats[1].append(sample[1])
+        return inputs, f_ap, c_ap, f_ob, c_ob, stats[0], stats[1]
@@ -0,0 +1,70 @@
+# Helpers shared by the root benchmark and export scripts (benchmark.py, agent_cost.py, export_cascade.py, quantize.py,
+# compare_precision.py)
+import glob
+import os
+
+import torch
+
+from yolov5.models.experimental import attempt_load
+from yolov5.models.yolo import Model
+from yolov5.utils.torch_utils import time_synchronized
+from yolov5.utils.utils import box_iou
+from EfficientObjectDetection.utils.ap_accumulator import APAccumulator
+
+img_formats = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+
+def load_detector(weights, cfg, device):
+    # yolov5 detector from weights, or with random weights from cfg (same graph and cost)
+    if weights:
+        return attempt_load(weights, map_location=device)
+    with torch.no_grad():
+        model = Model(cfg, nc=1).to(device)
+    model.names = ['ship']  # HRSID
+    return model
+
+
+def image_files(source, n):
+    # first n images of a directory
+    files = sorted(f for f in glob.glob(os.path.join(source, '*.*')) if os.path.splitext(f)[-1].lower() in img_formats)[:n]
+    assert files, 'No images found in %s' % source
+    return files
+
+
+def latency(fn, inputs, n=20):
+    # mean latency (ms) of fn per input, over n passes on the inputs after one warm-up call
+    with torch.no_grad():
+        fn(inputs[0])
+        t = time_synchronized()
+        for _ in range(n):
+            for x in inputs:
+                fn(x)
+    return (time_synchronized() - t) / (n * len(inputs)) * 1E3
+
+
+def thop_gflops(model, x):
+    # GFLOPs of model(x) (thop, if installed)
+    try:
+        from thop import profile
+        return profile(model, inputs=(x,), verbose=False)[0] / 1E9 * 2
+    except:
+        return None
+
+
+def match(a, b, iou_thres=0.5):
+    # fraction of the detections a with a detection of b of the same class at IoU > iou_thres
+    if not len(a):
+        return 1.
+    if not len(b):
+        return 0.
+    iou = box_iou(a[:, :4], b[:, :4]) * (a[:, 5:6] == b[None, :, 5])
+    return float((iou.max(1)[0] > iou_thres).float().mean())
+
+
+def detector_map(results):
+    # mAP@0.5 of a detector over the per-patch results of test_rl.test() (yolov5.eval())
+    accumulator = APAccumulator()
+    for x in results:
+        for stats in x[7]:
+            accumulator.update(*stats)
+    return float(accumulator.summary()[2]) if accumulator.any() else 0.
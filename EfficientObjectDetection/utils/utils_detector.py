@@ -3,6 +3,8 @@ import tqdm
 import torch
 import numpy as np
 
+from yolov5.utils.matching import match_predictions
+
 
 def to_cpu(tensor):
     return tensor.detach().cpu()
@@ -176,42 +178,21 @@ def compute_ap(recall, precision):
     return ap
 
 def get_batch_statistics(outputs, targets, iou_threshold):
-    """ Compute true positives, predicted scores and predicted labels per sample """
-    batch_metrics = []
-    for sample_i in range(len(outputs)):
-
-        if outputs[sample_i] is None:
-            continue
-
-        output = outputs[sample_i]
-        pred_boxes = output[:, :4]
-        pred_scores = output[:, 4]
-        pred_labels = output[:, -1]
-
-        true_positives = np.zeros(pred_boxes.shape[0])
-
-        annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
-        if len(annotations):
-            detected_boxes = []
-            target_boxes = annotations[:, 1:]
-
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
-
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
-
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
-
-                iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores, pred_labels])
-    return batch_metrics
+    """ Compute true positives, predicted scores and predicted labels per sample, all samples matched at once """
+    samples = [i for i, output in enumerate(outputs) if output is not None]
+    if not samples:
+        return []
+    pred = torch.cat([outputs[i] for i in samples], 0)
+    n, m = [len(outputs[i]) for i in samples], len(targets)
+    sample = torch.repeat_interleave(torch.tensor(samples, device=pred.device), torch.tensor(n, device=pred.device))
+    targets = targets.to(pred.device)
+
+    # Any class target of the sample, for predictions of one of the sample target labels (IoU >= iou_threshold)
+    iou = bbox_iou(pred[:, :4].repeat_interleave(m, 0), targets[:, 2:].repeat(len(pred), 1)).view(len(pred), m)
+    true_positives = match_predictions(iou, sample, pred[:, -1], targets[:, 0], targets[:, 1],
+                                       torch.tensor([iou_threshold]), class_aware=False, inclusive=True)[:, 0]
+    true_positives = np.split(true_positives.cpu().numpy().astype(np.float64), np.cumsum(n)[:-1])
+    return [[tp, outputs[i][:, 4], outputs[i][:, -1]] for tp, i in zip(true_positives, samples)]
 
 def bbox_wh_iou(wh1, wh2):
     wh2 = wh2.t()
@@ -8,9 +8,13 @@ import json
 
 from EfficientObjectDetection.utils import utils_detector
 from EfficientObjectDetection.dataset.dataloader_ete import CustomDatasetFromImages, CustomDatasetFromImages_timetest, CustomDatasetFromImages_test
-from EfficientObjectDetection.constants import base_dir_groundtruth, base_dir_detections_cd, base_dir_detections_fd, base_dir_metric_cd, base_dir_metric_fd
+from EfficientObjectDetection.dataset.detection_store import DetectionStore
+from EfficientObjectDetection.constants import base_dir_groundtruth, detection_store_fd, detection_store_cd
 from EfficientObjectDetection.constants import num_windows, img_size_fd, img_size_cd
 
+imagenet_mean = [0.485, 0.456, 0.406]
+imagenet_std = [0.229, 0.224, 0.225]
+
 def save_args(__file__, args):
     shutil.copy('EfficientObjectDetection/' + os.path.basename(__file__), 'EfficientObjectDetection/'+ args.cv_dir)
     with open('EfficientObjectDetection/' + args.cv_dir+'/args.txt','w') as f:
@@ -29,10 +33,21 @@ def xywh2xyxy(x):
     y[:,3] = x[:, 1] + x[:, 3] / 2.
     return y
 
+_detection_stores = {}
+
+
+def detection_stores():
+    # fine and coarse DetectionStore, opened once per process
+    return tuple(_detection_stores.setdefault(f, DetectionStore(f)) for f in (detection_store_fd, detection_store_cd))
+
 def get_detected_boxes(policy, file_dirs, metrics, set_labels):
+    store_fd, store_cd = detection_stores()
+    image_ids = [os.path.basename(f_path[0]).rsplit('_', 1)[0] for f_path, _ in file_dirs]  # <image>_<window>.jpg
+    dets_fd, dets_cd = store_fd.read(image_ids)['detections'], store_cd.read(image_ids)['detections']
     for index, (f_path, c_path) in enumerate(file_dirs):
+        preds_fd, preds_cd = dets_fd[index], dets_cd[index]
         counter = 0
-        for i in range(4):
+        for i in range(len(f_path)):
             # ---------------- Read Ground Truth ----------------------------------
             outputs_all = []
             # gt_path = '{}/{}_{}_{}.txt'.format(base_dir_groundtruth, file_dir_st, xind, yind)
@@ -43,17 +58,13 @@ def get_detected_boxes(policy, file_dirs, metrics, set_labels):
                 targets[:, 2:] = xywh2xyxy(targets[:, 2:])
                 # ----------------- Read Detections -------------------------------
                 if policy[index, counter] == 1:
-                    preds_dir = '{}/{}_{}_{}.npy'.format(base_dir_detections_fd, file_dir_st, xind, yind)
+                    preds = preds_fd[i]
                     targets[:, 2:] *= img_size_fd
-                    if os.path.exists(preds_dir):
-                        preds = np.load(preds_dir).reshape([-1,7])
-                        outputs_all.append(torch.from_numpy(preds))
                 else:
-                    preds_dir = '{}/{}_{}_{}.npy'.format(base_dir_detections_cd, file_dir_st, xind, yind)
+                    preds = preds_cd[i]
                     targets[:, 2:] *= img_size_cd
-                    if os.path.exists(preds_dir):
-                        preds = np.load(preds_dir).reshape([-1,7])
-                        outputs_all.append(torch.from_numpy(preds))
+                if preds is not None:
+                    outputs_all.append(torch.from_numpy(preds))  # view of the store
                 set_labels += targets[:, 1].tolist()
                 metrics += utils_detector.get_batch_statistics(outputs_all, torch.from_numpy(targets), 0.5)
             else:
@@ -62,12 +73,11 @@ def get_detected_boxes(policy, file_dirs, metrics, set_labels):
 
     return metrics, set_labels
 
-def read_offsets(image_ids, num_actions):
-    offset_fd = torch.zeros((len(image_ids), num_actions)).cuda()
-    offset_cd = torch.zeros((len(image_ids), num_actions)).cuda()
-    for index, img_id in enumerate(image_ids):
-        offset_fd[index, :] = torch.from_numpy(np.load('{}/{}'.format(base_dir_metric_fd, os.path.splitext(img_id)[0]+'.npy')).flatten())
-        offset_cd[index, :] = torch.from_numpy(np.load('{}/{}'.format(base_dir_metric_cd, os.path.splitext(img_id)[0]+'.npy')).flatten())
+def read_offsets(image_ids, num_actions, device):
+    # window AP of the fine and coarse detectors on device, one batched read per store
+    store_fd, store_cd = detection_stores()
+    offset_fd = torch.from_numpy(store_fd.read(image_ids)['ap'][:, :num_actions]).to(device)
+    offset_cd = torch.from_numpy(store_cd.read(image_ids)['ap'][:, :num_actions]).to(device)
     return offset_fd, offset_cd
 
 def performance_stats(policies, rewards):
@@ -114,17 +124,63 @@ def compute_reward_sarod(f_ap, c_ap, f_ob, c_ob, policy, beta, sigma):
     return reward.float()
 
 
+def compute_reward_sarod_batched(f_ap, c_ap, f_ob, c_ob, policies, beta, sigma):
+    """
+    compute_reward_sarod for several policies per image at once, on the device of the inputs and without
+    modifying them
+    Args:
+        f_ap, c_ap, f_ob, c_ob: tensor, shape [batch_size, num_actions]
+        policies: tensor, shape [num_policies, batch_size, num_actions], binary-valued (0 or 1)
+        beta: scalar
+        sigma: scalar
+    Returns:
+        reward: tensor, shape [num_policies, batch_size, 1]
+    """
+    ap_diff = f_ap - (c_ap + 0.05)
+    reward_patch_diff = ap_diff * policies - ap_diff * (1 - policies)
+    reward_patch_acqcost = (policies.size(-1) - policies.sum(dim=-1)) / policies.size(-1)
+    r_penalty = torch.abs((f_ob <= 0).float() - policies)
+
+    reward_img = reward_patch_diff.sum(dim=-1) + 0.05 * r_penalty.sum(dim=-1) + 0.2 * reward_patch_acqcost
+    reward = reward_img.unsqueeze(-1)
+
+    return reward.float()
+
+
+def gate_policy(confs, gate='band', band=(0.1, 0.5), thres=1.):
+    """
+    Coarse-first routing without the agent: fine (1) for the patches whose coarse detections are uncertain
+    Args:
+        confs: per patch, scores of the coarse detections after NMS (tensor or array, None without detections)
+        gate: 'band', number of scores in [band[0], band[1]), or 'entropy', summed binary entropy (bits) of the scores
+        thres: a patch goes fine when its uncertainty reaches thres
+    Returns:
+        policy: tensor, shape [num_patches], binary-valued (0 or 1)
+    """
+    n = [0 if c is None else len(c) for c in confs]
+    c = torch.cat([torch.as_tensor(x).float().view(-1).cpu() for x in confs if x is not None] + [torch.zeros(0)])
+    if gate == 'band':
+        u = ((c >= band[0]) & (c < band[1])).float()
+    elif gate == 'entropy':
+        c = c.clamp(1E-6, 1 - 1E-6)
+        u = -(c * torch.log2(c) + (1 - c) * torch.log2(1 - c))
+    else:
+        raise ValueError('Unknown gate %s, band or entropy' % gate)
+    patch = torch.repeat_interleave(torch.arange(len(confs)), torch.tensor(n, dtype=torch.long))
+    return (torch.zeros(len(confs)).index_add_(0, patch, u) >= thres).float()
+
+
 def get_transforms(img_size):
-    mean = [0.485, 0.456, 0.406]
-    std = [0.229, 0.224, 0.225]
+    mean = imagenet_mean
+    std = imagenet_std
     transform_train = transforms.Compose([
-        transforms.Scale(img_size),
+        transforms.Resize(img_size),
         transforms.RandomCrop(img_size),
         transforms.ToTensor(),
         transforms.Normalize(mean, std)
     ])
     transform_test = transforms.Compose([
-        transforms.Scale(img_size),
+        transforms.Resize(img_size),
         transforms.CenterCrop(img_size),
         transforms.ToTensor(),
         transforms.Normalize(mean, std)
@@ -133,13 +189,22 @@ def get_transforms(img_size):
     return transform_train, transform_test
 
 
-def get_dataset(img_size, fine_data, coarse_data, task):
+def normalize_inputs(x):
+    # uint8 (or 0-255 float) agent inputs [batch_size, 3, H, W] to normalized float32, on the device of x
+    mean = x.new_tensor(imagenet_mean, dtype=torch.float32).view(1, -1, 1, 1) * 255
+    std = x.new_tensor(imagenet_std, dtype=torch.float32).view(1, -1, 1, 1) * 255
+    return (x.float() - mean) / std
+
+
+def get_dataset(img_size, fine_data, coarse_data, task, image_cache=None, store=None, features=False):
     # data: source_path, paths[i], p, r, ap50, loss_list[i].mean(), nl
     transform_train, transform_test = get_transforms(img_size)
     if task == 'train':
-        trainset = CustomDatasetFromImages(fine_data, coarse_data, transform_train)
+        trainset = CustomDatasetFromImages(fine_data, coarse_data, transform_train, image_cache=image_cache,
+                                           image_size=img_size, store=store, features=features)
     else:
-        trainset = CustomDatasetFromImages(fine_data, coarse_data, transform_test)
+        trainset = CustomDatasetFromImages(fine_data, coarse_data, transform_test, image_cache=image_cache,
+                                           image_size=img_size, store=store, features=features)
     return trainset
 
 def get_dataset_test(img_size, img_path):
@@ -163,8 +228,8 @@ def set_parameter_requires_grad(model, feature_extracting):
         for param in model.parameters():
             param.requires_grad = False
 
-def get_model(num_output):
-    agent = torchmodels.resnet34(pretrained=True)
+def get_model(num_output, pretrained=True):
+    agent = torchmodels.resnet34(pretrained=pretrained)
     set_parameter_requires_grad(agent, False)
     num_ftrs = agent.fc.in_features
     agent.fc = torch.nn.Linear(num_ftrs, num_output)
@@ -192,6 +257,32 @@ def ppo_model(num_output):
     return ppo
 
 
+class FeaturePolicy(nn.Module):
+    """Small head over the pooled coarse-detector features of every window of a scene
+
+    Input [batch_size, num_actions, channels] (test_rl(return_features=True) per patch). Every window is embedded,
+    the mean embedding of the scene is appended as context and one logit per window is returned, [batch_size,
+    num_actions]. With scene_output the context alone gives num_output values per scene (critic).
+    """
+    def __init__(self, channels, num_output=1, hidden=128, scene_output=False):
+        super(FeaturePolicy, self).__init__()
+        self.scene_output = scene_output
+        self.embed = nn.Sequential(nn.LayerNorm(channels), nn.Linear(channels, hidden), nn.ReLU(inplace=True))
+        self.out = nn.Sequential(nn.Linear(hidden if scene_output else 2 * hidden, hidden), nn.ReLU(inplace=True),
+                                 nn.Linear(hidden, num_output if scene_output else 1))
+
+    def forward(self, x):
+        e = self.embed(x.float())  # [batch_size, num_actions, hidden]
+        context = e.mean(1, keepdim=True)
+        if self.scene_output:
+            return self.out(context.squeeze(1))
+        return self.out(torch.cat((e, context.expand_as(e)), 2)).squeeze(2)
+
+
+def get_feature_model(channels, num_output, scene_output=False):
+    return FeaturePolicy(channels, num_output, scene_output=scene_output)
+
+
 class Critic(nn.Module):
     def __init__(self):
         super(Critic, self).__init__()
@@ -0,0 +1,58 @@
+import argparse
+
+import torch
+
+from yolov5.utils.torch_utils import model_info, select_device
+from EfficientObjectDetection.utils import utils_ete
+from EfficientObjectDetection.utils.utils_bench import load_detector, latency, thop_gflops
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', default='yolov5/models/yolov5x_custom.yaml', help='detector cfg, without weights')
+    parser.add_argument('--fine_weights', default='')
+    parser.add_argument('--coarse_weights', default='')
+    parser.add_argument('--img_size', type=int, default=480, help='ResNet-34 agent input size')
+    parser.add_argument('--fine_size', type=int, default=480)
+    parser.add_argument('--coarse_size', type=int, default=96)
+    parser.add_argument('--grid', type=int, default=2, help='windows per side')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--n', type=int, default=20, help='timed runs')
+    opt = parser.parse_args()
+    print(opt)
+
+    device = select_device(opt.device)
+    na = opt.grid ** 2
+    fine_model = load_detector(opt.fine_weights, opt.cfg, device).float().eval()
+    coarse_model = load_detector(opt.coarse_weights, opt.cfg, device).float().eval()
+    channels = sum(coarse_model.feature_channels())
+    resnet = utils_ete.get_model(na).to(device).eval()
+    head = utils_ete.get_feature_model(channels, na).to(device).eval()
+
+    # Cost per scene: params, GFLOPs, ms
+    rows = []
+    fine_p, _, fine_f = model_info(fine_model, img_size=opt.fine_size)
+    fine_t = latency(fine_model, [torch.zeros((na, 3, opt.fine_size, opt.fine_size), device=device)], opt.n)
+    coarse_p, _, coarse_f = model_info(coarse_model, img_size=opt.coarse_size)
+    coarse_t = latency(coarse_model, [torch.zeros((na, 3, opt.coarse_size, opt.coarse_size), device=device)], opt.n)
+    resnet_p, _, resnet_f = model_info(resnet, img_size=opt.img_size)
+    resnet_t = latency(resnet, [torch.zeros((1, 3, opt.img_size, opt.img_size), device=device)], opt.n)
+    x = torch.zeros((1, na, channels), device=device)
+    head_p, head_f, head_t = sum(p.numel() for p in head.parameters()), thop_gflops(head, x), latency(head, [x], opt.n)
+
+    mul = lambda f, k: f * k if f is not None else None
+    rows.append(('fine detector (%g patches @%g)' % (na, opt.fine_size), fine_p, mul(fine_f, na), fine_t))
+    rows.append(('coarse detector (%g patches @%g)' % (na, opt.coarse_size), coarse_p, mul(coarse_f, na), coarse_t))
+    rows.append(('ResNet-34 agent (scene @%g)' % opt.img_size, resnet_p, resnet_f, resnet_t))
+    rows.append(('feature agent head (%g x %g)' % (na, channels), head_p, head_f, head_t))
+
+    print(('%-36s' + '%14s' * 3) % ('model', 'params', 'GFLOPs', 'ms'))
+    for name, p, f, t in rows:
+        print(('%-36s%14g%14s%14.2f') % (name, p, '%.3g' % f if f is not None else '-', t))
+
+    # Routing overhead of each agent relative to the fine detector on every patch
+    if fine_f and resnet_f and head_f is not None:
+        print('Routing cost / all-fine cost: ResNet-34 %.1f%%, feature head %.4f%% (GFLOPs)' %
+              (100 * resnet_f / mul(fine_f, na), 100 * head_f / mul(fine_f, na)))
+    print('Routing cost / all-fine cost: ResNet-34 %.1f%%, feature head %.2f%% (latency)' %
+          (100 * resnet_t / fine_t, 100 * head_t / fine_t))
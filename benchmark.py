@@ -0,0 +1,242 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queues
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from yolov5.utils.torch_utils import model_info, select_device, time_synchronized, inference_mode, set_threads, \
+    prepare_model, warmup
+from yolov5.utils.utils import non_max_suppression_batched
+from EfficientObjectDetection.engine import SARODEngine
+from EfficientObjectDetection.utils import utils_ete
+from EfficientObjectDetection.utils.utils_bench import load_detector, image_files, thop_gflops
+
+
+def load_scenes(source, n):
+    # first n scenes of a directory, decoded once so that disk reads are not timed
+    files = image_files(source, n)
+    return files, [cv2.imread(f) for f in files]
+
+
+def peak_rss():
+    # peak resident set size of this process (MB)
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / 2 ** 20 if sys.platform == 'darwin' else r / 2 ** 10  # bytes on macOS, KB on Linux
+
+
+def sarod_engine(opt, device):
+    # Engine with both yolov5 detectors and the agent (random if no --rl_weights)
+    fine_model = load_detector(opt.fine_weights, opt.cfg, device).float()
+    coarse_model = load_detector(opt.coarse_weights, opt.cfg, device).float()
+    na = opt.grid ** 2
+    if opt.agent == 'features':
+        agent = utils_ete.get_feature_model(sum(coarse_model.feature_channels()), na)
+    else:
+        agent = utils_ete.get_model(na, pretrained=False)  # random or --rl_weights, same cost
+    if opt.rl_weights:
+        agent.load_state_dict(torch.load(opt.rl_weights, map_location=device)['agent'])
+    return SARODEngine(agent, fine_model, coarse_model, img_size=opt.img_size, fine_size=opt.fine_size,
+                       coarse_size=opt.coarse_size, grid=opt.grid, device=device, half=False if opt.fp32 else None,
+                       fuse=True)
+
+
+def build_system(name, opt, device):
+    """
+    Returns:
+        fn(scene) -> (number of detections, GFLOPs of this scene or None, fine patches or None), static info dict
+    """
+    na = opt.grid ** 2
+    if name == 'sarod':
+        engine = sarod_engine(opt, device)
+        flops = [model_info(m, img_size=s)[2] for m, s in engine.detectors]  # per patch, coarse and fine
+        if engine.features:
+            x = torch.zeros((1, na, sum(engine.detectors[0][0].feature_channels())), device=device)
+            agent_flops = thop_gflops(engine.agent, x)
+        else:
+            agent_flops = model_info(engine.agent, img_size=opt.img_size)[2]
+
+        def fn(scene):
+            det, _, policy = engine([scene])[0]
+            nf = int(policy.sum())
+            nc = na if engine.features else na - nf  # coarse patches, all of them for the feature agent
+            cost = agent_flops + nf * flops[1] + nc * flops[0] if None not in flops + [agent_flops] else None
+            return len(det), cost, nf
+        return fn, {'agent': opt.agent, 'agent_weights': opt.rl_weights or None}
+
+    if name in ('fine', 'coarse'):
+        # the detector alone, prepared as in SARODEngine, no agent
+        fine = name == 'fine'
+        size = opt.fine_size if fine else opt.coarse_size
+        model = load_detector(opt.fine_weights if fine else opt.coarse_weights, opt.cfg, device).float()
+        model, half, channels_last = prepare_model(model, device, False if opt.fp32 else None, fuse=True)
+        warmup(model, (1, 3, size, size), device, half, channels_last)
+        patch_flops = model_info(model, img_size=size)[2]
+        g = opt.grid
+
+        def fn(scene):
+            h, w = scene.shape[0] // g, scene.shape[1] // g
+            tiles = [scene[r * h:(r + 1) * h, c * w:(c + 1) * w] for r in range(g) for c in range(g)]  # as SAROD
+            img = torch.stack([SARODEngine.patch_tensor(t, size) for t in tiles]).to(device)
+            img = (img.half() if half else img.float()) / 255.0
+            img = img.contiguous(memory_format=torch.channels_last) if channels_last else img
+            with inference_mode():
+                output = non_max_suppression_batched(model(img)[0], conf_thres=opt.conf_thres, iou_thres=opt.iou_thres)
+            return sum(len(x) for x in output if x is not None), patch_flops * na if patch_flops else None, None
+        return fn, {'weights': (opt.fine_weights if fine else opt.coarse_weights) or None}
+
+    if name == 'yolov3':
+        sys.path.insert(0, 'Baseline_yolov3')  # the baseline imports its own top-level utils package
+        from models import Darknet
+        from utils.utils import non_max_suppression
+        model = Darknet(opt.yolov3_cfg, img_size=opt.yolov3_size).to(device)
+        if opt.yolov3_weights.endswith('.weights'):
+            model.load_darknet_weights(opt.yolov3_weights)
+        elif opt.yolov3_weights:
+            model.load_state_dict(torch.load(opt.yolov3_weights, map_location=device))
+        model.eval()
+        patch_flops = model_info(model, img_size=opt.yolov3_size)[2]
+        g = opt.grid
+
+        def fn(scene):
+            h, w = scene.shape[0] // g, scene.shape[1] // g
+            tiles = [scene[r * h:(r + 1) * h, c * w:(c + 1) * w] for r in range(g) for c in range(g)]  # as SAROD
+            img = torch.stack([SARODEngine.patch_tensor(t, opt.yolov3_size) for t in tiles]).to(device).float() / 255.0
+            with inference_mode():
+                output = non_max_suppression(model(img), opt.conf_thres, opt.iou_thres)
+            return sum(len(x) for x in output if x is not None), patch_flops * na if patch_flops else None, None
+        return fn, {'weights': opt.yolov3_weights or None}
+
+    if name.startswith('mmdet:'):
+        config, checkpoint = opt.mmdet[name[6:]]
+        sys.path.insert(0, 'Baseline_mmdetection')
+        from mmdet.apis import init_detector, inference_detector
+        model = init_detector(config, checkpoint or None, device=str(device))
+
+        def fn(scene):
+            result = inference_detector(model, scene)  # whole scene, resized by the config pipeline
+            result = result[0] if isinstance(result, tuple) else result  # (bbox, segm)
+            return sum(len(x) for x in result), None, None
+        return fn, {'config': config, 'weights': checkpoint or None}
+
+    raise ValueError('unknown system %s' % name)
+
+
+def run_system(name, opt, queue):
+    # Runs in its own process: peak RSS and imported packages are per system
+    try:
+        set_threads(opt.threads, opt.interop_threads)
+        device = select_device(opt.device)
+        _, scenes = load_scenes(opt.source, opt.images)
+        rss0 = peak_rss()
+        fn, info = build_system(name, opt, device)
+        for s in scenes[:opt.warmup]:
+            fn(s)
+
+        times, flops, fine, detections = [], [], [], 0
+        for _ in range(opt.repeat):
+            for s in scenes:
+                t = time_synchronized()
+                n, f, nf = fn(s)
+                times.append(time_synchronized() - t)
+                detections += n
+                flops.append(f)
+                fine.append(nf)
+
+        t = np.array(times) * 1E3  # ms
+        r = {'system': name, 'images': len(t), 'p50_ms': float(np.percentile(t, 50)),
+             'p95_ms': float(np.percentile(t, 95)), 'mean_ms': float(t.mean()),
+             'img_per_s': float(len(t) / t.sum() * 1E3),
+             'peak_rss_mb': peak_rss(), 'model_rss_mb': peak_rss() - rss0,
+             'gflops_per_image': float(np.mean(flops)) if None not in flops else None,
+             'detections_per_image': detections / len(t)}
+        if None not in fine:
+            r['fine_ratio'] = float(np.mean(fine)) / opt.grid ** 2
+        r.update(info)
+    except Exception as e:
+        r = {'system': name, 'error': '%s: %s' % (type(e).__name__, e)}
+    queue.put(r)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--source', default='data/test/images', help='scene directory')
+    parser.add_argument('--images', type=int, default=20, help='number of scenes replayed')
+    parser.add_argument('--repeat', type=int, default=1, help='passes over the scenes')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed scenes per system')
+    parser.add_argument('--systems', nargs='+', default=['fine', 'coarse', 'sarod', 'yolov3'],
+                        help='fine, coarse, sarod, yolov3 and the names given with --mmdet')
+    parser.add_argument('--cfg', default='yolov5/models/yolov5x_custom.yaml', help='yolov5 cfg used without weights')
+    parser.add_argument('--fine_weights', default='')
+    parser.add_argument('--coarse_weights', default='')
+    parser.add_argument('--rl_weights', default='', help='agent weights, a random agent is timed without them')
+    parser.add_argument('--agent', default='resnet34', choices=['resnet34', 'features'])
+    parser.add_argument('--img_size', type=int, default=480, help='agent input size')
+    parser.add_argument('--fine_size', type=int, default=480)
+    parser.add_argument('--coarse_size', type=int, default=96)
+    parser.add_argument('--grid', type=int, default=2, help='windows per side')
+    parser.add_argument('--yolov3_cfg', default='Baseline_yolov3/config/yolov3-custom480.cfg')
+    parser.add_argument('--yolov3_weights', default='', help='.weights or .pth, random weights if empty')
+    parser.add_argument('--yolov3_size', type=int, default=480)
+    parser.add_argument('--mmdet', nargs='*', default=[], help='name=config.py[,checkpoint.pth] mmdetection baselines')
+    parser.add_argument('--conf_thres', type=float, default=0.001)
+    parser.add_argument('--iou_thres', type=float, default=0.6)
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op CPU threads, 0 for the default')
+    parser.add_argument('--interop_threads', type=int, default=0, help='torch inter-op CPU threads, 0 for the default')
+    parser.add_argument('--fp32', action='store_true', help='no fp16 inference on CUDA')
+    parser.add_argument('--json', default='benchmark.json', help='report file')
+    opt = parser.parse_args()
+    mmdet = {}
+    for x in opt.mmdet:
+        name, files = x.split('=', 1)
+        config, checkpoint = (files.split(',', 1) + [''])[:2]
+        mmdet[name] = (config, checkpoint)
+        opt.systems.append('mmdet:' + name)
+    opt.mmdet = mmdet
+    print(opt)
+
+    # One process per system
+    ctx = multiprocessing.get_context('spawn')
+    report = []
+    for name in opt.systems:
+        queue = ctx.Queue()
+        p = ctx.Process(target=run_system, args=(name, opt, queue))
+        p.start()
+        while True:  # a result, or an error if the process died without one
+            try:
+                report.append(queue.get(timeout=5))
+                break
+            except queues.Empty:
+                if not p.is_alive():
+                    try:
+                        report.append(queue.get(timeout=1))
+                    except queues.Empty:
+                        report.append({'system': name, 'error': 'process exited with code %s' % p.exitcode})
+                    break
+        p.join()
+
+    # Print results
+    print(('%-16s' + '%10s' * 7) % ('system', 'images', 'p50 ms', 'p95 ms', 'img/s', 'RSS MB', 'GFLOPs', 'fine'))
+    for r in report:
+        if 'error' in r:
+            print('%-16s %s' % (r['system'], r['error']))
+            continue
+        print(('%-16s%10g' + '%10.1f' * 3 + '%10.0f%10s%10s') %
+              (r['system'], r['images'], r['p50_ms'], r['p95_ms'], r['img_per_s'], r['peak_rss_mb'],
+               '%.3g' % r['gflops_per_image'] if r['gflops_per_image'] is not None else '-',
+               '%.2f' % r['fine_ratio'] if 'fine_ratio' in r else '-'))
+    if opt.json:
+        with open(opt.json, 'w') as f:
+            json.dump({'config': vars(opt),
+                       'host': {'platform': platform.platform(), 'processor': platform.processor(),
+                                'torch': torch.__version__, 'threads': torch.get_num_threads()},
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'systems': report}, f, indent=2)
+        print('Results saved to %s' % opt.json)
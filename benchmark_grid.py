@@ -0,0 +1,118 @@
+import argparse
+import json
+from copy import deepcopy
+
+import numpy as np
+import torch
+from PIL import Image
+
+from yolov5 import test_rl
+from yolov5.models.experimental import attempt_load
+from yolov5.utils.datasets_rl import load_scene, patch_key, scene_path
+from yolov5.utils.torch_utils import select_device, time_synchronized
+from yolov5.utils.utils import check_img_size
+from EfficientObjectDetection.utils import utils_ete
+from EfficientObjectDetection.utils.ap_accumulator import APAccumulator
+
+
+def patch_cost(model, imgsz, device, n=10):
+    # GFLOPs (thop, if installed) and latency (ms) of one forward pass on an imgsz x imgsz patch
+    img = torch.zeros((1, 3, imgsz, imgsz), device=device)
+    img = img.half() if next(model.parameters()).dtype == torch.float16 else img
+    try:
+        from thop import profile
+        flops = profile(deepcopy(model), inputs=(img,), verbose=False)[0] / 1E9 * 2
+    except:
+        flops = None
+    with torch.no_grad():
+        model(img)  # warm up
+        t = time_synchronized()
+        for _ in range(n):
+            model(img)
+    return flops, (time_synchronized() - t) / n * 1E3
+
+
+def agent_policy(weights, scenes, grid, img_size, device):
+    # Greedy policy of an agent trained for this grid, per scene
+    agent = utils_ete.get_model(grid * grid)
+    agent.load_state_dict(torch.load(weights, map_location=device)['agent'])
+    agent.to(device).eval()
+    transform = utils_ete.get_transforms(img_size)[1]
+    policy = {}
+    with torch.no_grad():
+        for s in scenes:
+            x = transform(Image.fromarray(np.ascontiguousarray(load_scene(s)[:, :, ::-1])))[None].to(device)
+            policy[s] = (torch.sigmoid(agent(x))[0] >= 0.5).long().tolist()
+    return policy
+
+
+def evaluate(results, policy):
+    # AP of the per-patch stats picked by policy (1 fine, 0 coarse per patch)
+    accumulator = APAccumulator()
+    for fine, coarse, action in zip(*results, policy):
+        for stats in (fine if action else coarse)[7]:
+            accumulator.update(*stats)
+    return accumulator.summary()[2] if accumulator.any() else 0.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default='yolov5/data/HRSID_800_rl.yaml', help='data.yaml path')
+    parser.add_argument('--task', default='test', help="'val' or 'test' scenes")
+    parser.add_argument('--fine_weights', default='weights/fine.pt')
+    parser.add_argument('--coarse_weights', default='weights/coarse.pt')
+    parser.add_argument('--rl_weights', nargs='*', default=[], help='agent weights, one per grid')
+    parser.add_argument('--grids', nargs='+', type=int, default=[2, 3, 4])
+    parser.add_argument('--fine_size', type=int, default=480, help='fine patch size at 2x2, scaled by 2 / grid')
+    parser.add_argument('--coarse_size', type=int, default=96, help='coarse patch size at 2x2, scaled by 2 / grid')
+    parser.add_argument('--margin', type=float, default=0.05, help='AP margin of the fine detector in the reward')
+    parser.add_argument('--device', default='0', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--json', default='', help='write the table to this file')
+    opt = parser.parse_args()
+    print(opt)
+
+    device = select_device(opt.device)
+    fine_model = attempt_load(opt.fine_weights, map_location=device)
+    coarse_model = attempt_load(opt.coarse_weights, map_location=device)
+    gs = int(max(fine_model.stride.max(), coarse_model.stride.max()))
+    rl_weights = dict(zip(opt.grids, opt.rl_weights))
+
+    table = []
+    for grid in opt.grids:
+        # Same pixel budget per scene for every grid: patch sizes scale with the patch
+        fine_size = check_img_size(round(opt.fine_size * 2 / grid), gs)
+        coarse_size = check_img_size(round(opt.coarse_size * 2 / grid), gs)
+        kw = dict(batch_size=1, conf_thres=0.001, iou_thres=0.6, task=opt.task, scenes=True, grid=grid)
+        fine = sorted(test_rl.test(opt.data, imgsz=fine_size, model=fine_model, **kw), key=lambda x: patch_key(x[1]))
+        coarse = sorted(test_rl.test(opt.data, imgsz=coarse_size, model=coarse_model, **kw), key=lambda x: patch_key(x[1]))
+        assert [x[1] for x in fine] == [x[1] for x in coarse], 'fine and coarse patches differ'
+        f_flops, f_ms = patch_cost(fine_model, fine_size, device)
+        c_flops, c_ms = patch_cost(coarse_model, coarse_size, device)
+        n = len(fine)
+
+        policies = {'fine': [1] * n,
+                    'coarse': [0] * n,
+                    'oracle': [int(f[4] > c[4] + opt.margin) for f, c in zip(fine, coarse)]}  # reward sign
+        if grid in rl_weights:
+            scenes = [scene_path(x[1]) for x in fine]
+            policy = agent_policy(rl_weights[grid], sorted(set(scenes)), grid, 480, device)
+            policies['agent'] = [policy[s][patch_key(x[1])[1]] for s, x in zip(scenes, fine)]
+
+        for name, policy in policies.items():
+            nf = sum(policy)
+            cost = f_flops * nf + c_flops * (n - nf) if f_flops and c_flops else f_ms * nf + c_ms * (n - nf)
+            full = f_flops * n if f_flops and c_flops else f_ms * n
+            table.append({'grid': '%gx%g' % (grid, grid), 'policy': name, 'fine_size': fine_size,
+                          'coarse_size': coarse_size, 'patches': n, 'fine_ratio': nf / n, 'compute_saved': 1 - cost / full,
+                          'ms_per_scene': (f_ms * nf + c_ms * (n - nf)) / n * grid * grid,
+                          'map50': float(evaluate((fine, coarse), policy))})
+
+    # Print results
+    print(('%8s' * 3 + '%12s' * 5) % ('grid', 'policy', 'sizes', 'patches', 'fine', 'saved', 'ms/scene', 'mAP@.5'))
+    for x in table:
+        print(('%8s' * 3 + '%12g' + '%12.3g' * 4) % (x['grid'], x['policy'], '%g/%g' % (x['fine_size'], x['coarse_size']),
+                                                   x['patches'], x['fine_ratio'], x['compute_saved'], x['ms_per_scene'],
+                                                   x['map50']))
+    if opt.json:
+        with open(opt.json, 'w') as f:
+            json.dump(table, f, indent=2)
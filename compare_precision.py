@@ -0,0 +1,137 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import easydict
+import numpy as np
+import torch
+
+from yolov5.train_dt import yolov5
+from yolov5.utils.torch_utils import init_seeds, set_threads
+from EfficientObjectDetection.train_new_reward import EfficientOD
+from EfficientObjectDetection.utils.utils_bench import detector_map
+from EfficientObjectDetection.constants import num_windows
+
+
+def run(opt, precision):
+    # Detector and agent training from the same seeds and weights at one precision, val metrics of the last epoch
+    random.seed(0)
+    np.random.seed(0)
+    init_seeds(0)
+    save_path = os.path.join(opt.save_path, precision)
+
+    def detector_opts(img_size, weights, name):
+        opt_tr = easydict.EasyDict({
+            "cfg": opt.cfg,
+            "data": opt.data,
+            "hyp": '',
+            "epochs": opt.epochs,
+            "batch_size": opt.detector_batch_size,
+            "img_size": [img_size, img_size],
+            "rect": False,
+            "resume": False,
+            "nosave": False,
+            "notest": True,
+            "noautoanchor": True,
+            "evolve": False,
+            "bucket": '',
+            "cache_images": True,
+            "weights": weights,
+            "name": '%s_%s' % (name, precision),
+            "device": opt.device,
+            "multi_scale": False,
+            "single_cls": True,
+            "sync_bn": False,
+            "local_rank": -1,
+            "precision": precision
+        })
+        opt_eval = easydict.EasyDict({
+            "data": opt.rl_data,
+            "batch_size": 1,
+            "conf_thres": 0.001,
+            "iou_thres": 0.6,  # for NMS
+            "grid": num_windows,
+            "half": False  # the detectors are compared on their training precision only
+        })
+        return opt_tr, opt_eval
+
+    fine_detector = yolov5(*detector_opts(opt.fine_size, opt.h_detector_weight, 'fine'))
+    coarse_detector = yolov5(*detector_opts(opt.coarse_size, opt.l_detector_weight, 'coarse'))
+    fine_detector.main(opt.epochs)
+    coarse_detector.main(opt.epochs)
+
+    EfficientOD_opt = easydict.EasyDict({
+        "gpu_id": opt.device,
+        "lr": 1e-3,
+        "cv_dir": save_path,
+        "batch_size": 1,
+        "step_batch_size": opt.step_batch_size,
+        "img_size": opt.agent_size,
+        "epoch_step": 20,
+        "max_epochs": opt.epochs,
+        "num_workers": 0,
+        "parallel": False,
+        "alpha": 0.8,
+        "beta": 0.1,
+        "sigma": 0.5,
+        "load": opt.rl_weight,
+        "precision": precision
+    })
+    init_seeds(0)
+    rl_agent = EfficientOD(EfficientOD_opt)
+
+    t = time.time()
+    for e in range(opt.epochs):
+        rl_agent.train(e, fine_detector.eval('train'), coarse_detector.eval('train'))
+    t = time.time() - t
+    eval_fine, eval_coarse = fine_detector.eval('val'), coarse_detector.eval('val')
+    _, reward, sparsity, _, map50, efficiency = rl_agent.eval(opt.epochs - 1, eval_fine, eval_coarse)
+    return {'precision': precision, 'fine_map50': detector_map(eval_fine),
+            'coarse_map50': detector_map(eval_coarse), 'reward': float(reward), 'rl_map50': float(map50),
+            'efficiency': float(efficiency), 'train_s': t}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--precision', default='bf16', choices=['fp16', 'bf16'], help='compared against fp32')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--detector_batch_size', type=int, default=32)
+    parser.add_argument('--step_batch_size', type=int, default=100)
+    parser.add_argument('--cfg', default='yolov5/models/yolov5x_custom.yaml')
+    parser.add_argument('--data', default='yolov5/data/HRSID_800_od.yaml', help='detector training data')
+    parser.add_argument('--rl_data', default='yolov5/data/HRSID_800_rl.yaml', help='patches of the agent')
+    parser.add_argument('--fine_size', type=int, default=480)
+    parser.add_argument('--coarse_size', type=int, default=96)
+    parser.add_argument('--agent_size', type=int, default=480)
+    parser.add_argument('--h_detector_weight', default=' ')
+    parser.add_argument('--l_detector_weight', default=' ')
+    parser.add_argument('--rl_weight', default=None)
+    parser.add_argument('--device', default='0', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op CPU threads, 0 for the default')
+    parser.add_argument('--map_tol', type=float, default=0.01, help='max mAP@0.5 drop against fp32')
+    parser.add_argument('--reward_tol', type=float, default=0.05, help='max RL reward drop against fp32')
+    parser.add_argument('--save_path', default='save/precision')
+    parser.add_argument('--json', default='', help='report file')
+    opt = parser.parse_args()
+    set_threads(opt.threads)
+    print(opt)
+
+    report = [run(opt, 'fp32'), run(opt, opt.precision)]
+
+    # Print results, drops against fp32
+    ref, r = report
+    keys = ('fine_map50', 'coarse_map50', 'rl_map50', 'reward', 'efficiency', 'train_s')
+    print(('%-10s' + '%14s' * len(keys)) % (('precision',) + keys))
+    for x in report:
+        print(('%-10s' + '%14.4g' * len(keys)) % ((x['precision'],) + tuple(x[k] for k in keys)))
+    checks = {'fine_map50': opt.map_tol, 'coarse_map50': opt.map_tol, 'rl_map50': opt.map_tol,
+              'reward': opt.reward_tol}
+    failed = [k for k, tol in checks.items() if ref[k] - r[k] > tol]
+    print('%s vs fp32: %s' % (opt.precision, 'FAIL (%s)' % ', '.join(failed) if failed else 'PASS'))
+    if opt.json:
+        with open(opt.json, 'w') as f:
+            json.dump({'config': vars(opt), 'systems': report, 'failed': failed}, f, indent=2)
+    if failed:
+        raise SystemExit(1)
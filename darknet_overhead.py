@@ -0,0 +1,110 @@
+"""Per-iteration overhead of the YOLOv3 baseline host syncs: Darknet outputs and training metrics
+
+Times Darknet training iterations (forward, backward, step) and inference batches (forward, NMS) with
+    legacy: outputs copied to the host by every forward and the 13 metrics of every YOLO layer read with .item() after
+            every training forward, as before
+    device: outputs kept on the device, metrics accumulated on the device and read once per --log_interval iterations
+    off:    outputs kept on the device, no metrics
+
+Usage:
+    $ python darknet_overhead.py --device 0 --cfg Baseline_yolov3/config/yolov3-custom480.cfg --img_size 480
+"""
+import argparse
+import json
+import sys
+
+import torch
+
+from yolov5.utils.torch_utils import select_device, time_synchronized
+
+sys.path.insert(0, 'Baseline_yolov3')  # the baseline imports its own top-level utils package
+from models import Darknet
+from utils.utils import non_max_suppression
+
+
+def random_targets(batch_size, n, nc, device):
+    # (sample, class, x, y, w, h) normalized targets, n per image
+    xy = torch.rand(batch_size * n, 2) * 0.8 + 0.1
+    wh = torch.rand(batch_size * n, 2) * 0.1 + 0.02
+    i = torch.arange(batch_size).repeat_interleave(n)[:, None].float()
+    return torch.cat((i, torch.randint(0, nc, (batch_size * n, 1)).float(), xy, wh), 1).to(device)
+
+
+def train_step(model, optimizer, imgs, targets, mode, i, log_interval):
+    loss, outputs = model(imgs, targets)
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+    if mode == 'legacy':
+        outputs.cpu()  # to_cpu() of every forward
+        for yolo in model.yolo_layers:  # one .item() per metric and layer
+            yolo.metrics = {k: v.item() for k, v in zip(yolo.metric_names, yolo.metric_sum)}
+            yolo.metric_sum, yolo.metric_count = None, 0
+    elif mode == 'device' and (i + 1) % log_interval == 0:
+        model.log_metrics()
+
+
+def inference_step(model, imgs, mode, conf_thres, nms_thres):
+    with torch.no_grad():
+        outputs = model(imgs)
+        if mode == 'legacy':
+            outputs = outputs.cpu()  # to_cpu() of every forward, NMS on the host
+        return non_max_suppression(outputs, conf_thres, nms_thres)
+
+
+def timed(fn, n, warmup):
+    for i in range(warmup):
+        fn(i)
+    t = time_synchronized()
+    for i in range(n):
+        fn(i)
+    return (time_synchronized() - t) / n * 1E3  # ms
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', default='Baseline_yolov3/config/yolov3-custom480.cfg')
+    parser.add_argument('--img_size', type=int, default=480)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--targets', type=int, default=10, help='random targets per training image')
+    parser.add_argument('--iterations', type=int, default=20, help='timed iterations per mode')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--log_interval', type=int, default=10, help='training iterations per metrics read (device)')
+    parser.add_argument('--conf_thres', type=float, default=0.5, help='NMS of the inference batches')
+    parser.add_argument('--nms_thres', type=float, default=0.5)
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--json', default='', help='report file')
+    opt = parser.parse_args()
+    print(opt)
+
+    device = select_device(opt.device)
+    torch.manual_seed(0)
+    model = Darknet(opt.cfg, img_size=opt.img_size).to(device)
+    nc = model.yolo_layers[0].num_classes
+    optimizer = torch.optim.Adam(model.parameters())
+    imgs = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size, device=device)
+    targets = random_targets(opt.batch_size, opt.targets, nc, device)
+
+    report = {}
+    for mode in ('legacy', 'device', 'off'):
+        model.track_metrics(mode != 'off')
+        model.train()
+        train_ms = timed(lambda i: train_step(model, optimizer, imgs, targets, mode, i, opt.log_interval),
+                         opt.iterations, opt.warmup)
+        model.eval()
+        inference_ms = timed(lambda i: inference_step(model, imgs, mode, opt.conf_thres, opt.nms_thres),
+                             opt.iterations, opt.warmup)
+        report[mode] = {'train_ms': train_ms, 'inference_ms': inference_ms}
+    model.track_metrics(False)
+
+    # Print results
+    print('\n%-8s%14s%14s' % ('mode', 'train ms/it', 'infer ms/it'))
+    for mode, r in report.items():
+        print('%-8s%14.2f%14.2f' % (mode, r['train_ms'], r['inference_ms']))
+    legacy = report['legacy']
+    print('overhead removed vs legacy: train %.2f ms/it (device metrics), %.2f ms/it (off), inference %.2f ms/it'
+          % (legacy['train_ms'] - report['device']['train_ms'], legacy['train_ms'] - report['off']['train_ms'],
+             legacy['inference_ms'] - report['device']['inference_ms']))
+    if opt.json:
+        with open(opt.json, 'w') as f:
+            json.dump({'config': vars(opt), 'device': str(device), 'modes': report}, f, indent=2)
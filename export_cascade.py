@@ -0,0 +1,144 @@
+"""Exports the SAROD cascade (agent, routing, both detectors, NMS, scene merging) as one TorchScript and ONNX graph
+
+Checks the exported graphs against the eager module (parity), the module against SARODEngine (agreement), and
+compares their CPU latency.
+
+Usage:
+    $ python export_cascade.py --rl_weights save/ckpt_E_100 --fine_weights weights/fine.pt \
+        --coarse_weights weights/coarse.pt --source data/test/images
+"""
+import argparse
+import inspect
+import os
+
+import cv2
+import numpy as np
+import torch
+
+from yolov5.utils.torch_utils import select_device, set_threads
+from EfficientObjectDetection.cascade import SARODCascade
+from EfficientObjectDetection.engine import SARODEngine
+from EfficientObjectDetection.utils import utils_ete
+from EfficientObjectDetection.utils.utils_bench import load_detector, image_files, latency, match
+
+
+def same(a, b, tol=1E-2):
+    # fraction of the detections a with an identical one (within tol) in b, order-independent (conf ties)
+    if not len(a) or not len(b):
+        return float(len(a) == len(b))
+    return float((torch.cdist(a.float(), b.float(), p=float('inf')).min(1)[0] < tol).float().mean())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rl_weights', default='', help='agent weights, random without')
+    parser.add_argument('--fine_weights', default='')
+    parser.add_argument('--coarse_weights', default='')
+    parser.add_argument('--cfg', default='yolov5/models/yolov5x_custom.yaml', help='yolov5 cfg used without weights')
+    parser.add_argument('--agent', default='resnet34', choices=['resnet34', 'features'])
+    parser.add_argument('--img_size', type=int, default=480, help='agent input size')
+    parser.add_argument('--fine_size', type=int, default=480)
+    parser.add_argument('--coarse_size', type=int, default=96)
+    parser.add_argument('--grid', type=int, default=2, help='windows per side')
+    parser.add_argument('--scene_size', nargs=2, type=int, default=[800, 800], help='scene height, width')
+    parser.add_argument('--conf_thres', type=float, default=0.001)
+    parser.add_argument('--iou_thres', type=float, default=0.6)
+    parser.add_argument('--source', default='data/test/images', help='scenes of the parity and latency checks')
+    parser.add_argument('--images', type=int, default=10, help='number of scenes checked')
+    parser.add_argument('--repeat', type=int, default=1, help='timed passes over the scenes')
+    parser.add_argument('--parity', type=float, default=0.98, help='min fraction of identical detections')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op CPU threads, 0 for the default')
+    parser.add_argument('--output', default='weights/sarod_cascade', help='*.torchscript.pt and *.onnx prefix')
+    opt = parser.parse_args()
+    print(opt)
+    set_threads(opt.threads)
+
+    # Engine and cascade, fp32 on CPU
+    device = select_device('cpu')
+    fine_model = load_detector(opt.fine_weights, opt.cfg, device).float()
+    coarse_model = load_detector(opt.coarse_weights, opt.cfg, device).float()
+    na = opt.grid ** 2
+    if opt.agent == 'features':
+        agent = utils_ete.get_feature_model(sum(coarse_model.feature_channels()), na)
+    else:
+        agent = utils_ete.get_model(na)
+    if opt.rl_weights:
+        agent.load_state_dict(torch.load(opt.rl_weights, map_location=device)['agent'])
+    engine = SARODEngine(agent, fine_model, coarse_model, img_size=opt.img_size, fine_size=opt.fine_size,
+                         coarse_size=opt.coarse_size, grid=opt.grid, conf_thres=opt.conf_thres,
+                         iou_thres=opt.iou_thres, device=device, half=False, channels_last=False, fuse=True)
+    cascade = SARODCascade(engine, opt.scene_size).eval()
+
+    files = image_files(opt.source, opt.images)
+    scenes = [cv2.resize(cv2.imread(f), tuple(opt.scene_size[::-1])) for f in files]
+    inputs = [torch.from_numpy(s) for s in scenes]
+    os.makedirs(os.path.dirname(opt.output) or '.', exist_ok=True)
+
+    # TorchScript export, traced: the routing is tensor ops only
+    with torch.no_grad():
+        eager = [cascade(x) for x in inputs]
+    print('\nStarting TorchScript export with torch %s...' % torch.__version__)
+    f = opt.output + '.torchscript.pt'
+    with torch.no_grad():
+        ts = torch.jit.trace(cascade, inputs[0], check_trace=False)
+    ts.save(f)
+    ts = torch.jit.load(f)
+    print('TorchScript export success, saved as %s' % f)
+    systems = {'torchscript': lambda x: ts(x)}
+
+    # ONNX export, run by ONNX Runtime on CPU
+    try:
+        import onnx
+        import onnxruntime
+
+        print('\nStarting ONNX export with onnx %s...' % onnx.__version__)
+        f = opt.output + '.onnx'
+        kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+        with torch.no_grad():
+            torch.onnx.export(cascade, inputs[0], f, opset_version=opt.opset, input_names=['scene'],
+                              output_names=['detections', 'policy'], **kwargs)
+        onnx.checker.check_model(onnx.load(f))
+        session = onnxruntime.InferenceSession(f, providers=['CPUExecutionProvider'])
+        systems['onnxruntime'] = lambda x: [torch.from_numpy(y) for y in session.run(None, {'scene': x.numpy()})]
+        print('ONNX export success, saved as %s' % f)
+    except Exception as e:
+        print('ONNX export failure: %s' % e)
+
+    # Parity of the exported graphs with the eager module: same policy, same detections. Scores tied up to
+    # float rounding may be ordered (NMS, max_det) differently by ONNX Runtime kernels
+    print(('\n%-14s' + '%12s' * 3) % ('graph', 'policy', 'detections', 'identical'))
+    failed = []
+    for name, fn in systems.items():
+        same_policy, same_n, identical = 0, 0, []
+        for x, (det, policy) in zip(inputs, eager):
+            with torch.no_grad():
+                d, p = fn(x)
+            same_policy += bool((p == policy).all())
+            same_n += len(d) == len(det)
+            identical.append(min(same(det, d), same(d, det)))
+        print(('%-14s' + '%12s' * 2 + '%12.3f') % (name, '%g/%g' % (same_policy, len(inputs)),
+                                                   '%g/%g' % (same_n, len(inputs)), np.mean(identical)))
+        if same_policy < len(inputs) or np.mean(identical) < opt.parity:
+            failed.append(name)
+
+    # Agreement of the module with the python pipeline (SARODEngine), which resizes with PIL/cv2 instead
+    agree, recall, precision = [], [], []
+    for s, (det, policy) in zip(scenes, eager):
+        det_e, _, policy_e = engine([s])[0]
+        agree.append(float((policy_e == policy).float().mean()))
+        recall.append(match(det_e[det_e[:, 4] > 0.1], det))
+        precision.append(match(det[det[:, 4] > 0.1], det_e))
+    print('\nvs SARODEngine: policy agreement %.3f, detections (conf > 0.1) found %.3f / matched %.3f at IoU 0.5' %
+          (np.mean(agree), np.mean(recall), np.mean(precision)))
+
+    # Latency per scene
+    print(('\n%-14s%12s') % ('system', 'ms'))
+    systems = {'SARODEngine': lambda s: engine([s]), 'eager module': lambda x: cascade(x), **systems}
+    with torch.no_grad():
+        for name, fn in systems.items():
+            print('%-14s%12.1f' % (name, latency(fn, scenes if name == 'SARODEngine' else inputs, n=opt.repeat)))
+
+    print('\nParity %s' % ('FAIL (%s)' % ', '.join(failed) if failed else 'PASS'))
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,140 @@
+"""INT8 post-training static quantization of the coarse detector and the agent, for CPU inference
+
+Calibrates on a sample of HRSID patches (detector) and scenes (agent), then reports the AP of the coarse detector,
+the routing decisions and scene detections of the SAROD pipeline, and the CPU latency, INT8 against fp32.
+
+Usage:
+    $ python quantize.py --coarse_weights weights/coarse.pt --fine_weights weights/fine.pt --rl_weights save/ckpt_E_100
+"""
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+import yolov5.test_rl as test_rl
+from yolov5.utils.quantization import QuantizedModel, quantize_fx, quantization_engine
+from yolov5.utils.torch_utils import select_device, set_threads
+from EfficientObjectDetection.engine import SARODEngine
+from EfficientObjectDetection.utils import utils_ete
+from EfficientObjectDetection.utils.utils_bench import load_detector, image_files, latency, match, detector_map
+
+
+def batches(x, batch_size):
+    # list of tensors to a list of stacked batches
+    return [torch.stack(x[i:i + batch_size]) for i in range(0, len(x), batch_size)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--coarse_weights', default='')
+    parser.add_argument('--fine_weights', default='', help='fine detector of the pipeline, kept fp32')
+    parser.add_argument('--rl_weights', default='', help='agent weights, random without')
+    parser.add_argument('--cfg', default='yolov5/models/yolov5x_custom.yaml', help='yolov5 cfg used without weights')
+    parser.add_argument('--agent', default='resnet34', choices=['resnet34', 'features'])
+    parser.add_argument('--img_size', type=int, default=480, help='agent input size')
+    parser.add_argument('--fine_size', type=int, default=480)
+    parser.add_argument('--coarse_size', type=int, default=96)
+    parser.add_argument('--grid', type=int, default=2, help='windows per side')
+    parser.add_argument('--calib_patches', default='data/rl_ver/train/images', help='detector calibration patches')
+    parser.add_argument('--calib_scenes', default='data/train/images', help='agent calibration scenes')
+    parser.add_argument('--calib_images', type=int, default=256, help='calibration patches, a quarter as scenes')
+    parser.add_argument('--data', default='yolov5/data/HRSID_800_rl.yaml', help='patches of the AP check')
+    parser.add_argument('--task', default='test', help='train, val or test split of --data')
+    parser.add_argument('--source', default='data/test/images', help='scenes of the routing check')
+    parser.add_argument('--images', type=int, default=100, help='number of scenes checked')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op CPU threads, 0 for the default')
+    parser.add_argument('--save', default='', help='prefix of the traced INT8 models, *_coarse.pt and *_agent.pt')
+    parser.add_argument('--json', default='', help='report file')
+    opt = parser.parse_args()
+    print(opt)
+    set_threads(opt.threads)
+
+    # fp32 models, CPU only: quantized kernels have no CUDA backend
+    device = select_device('cpu')
+    print('Quantized engine: %s' % quantization_engine())
+    fine_model = load_detector(opt.fine_weights, opt.cfg, device).float().eval()
+    coarse_model = load_detector(opt.coarse_weights, opt.cfg, device).float().eval()
+    coarse_model.fuse()
+    na = opt.grid ** 2
+    if opt.agent == 'features':
+        agent = utils_ete.get_feature_model(sum(coarse_model.feature_channels()), na)
+    else:
+        agent = utils_ete.get_model(na)
+    if opt.rl_weights:
+        agent.load_state_dict(torch.load(opt.rl_weights, map_location=device)['agent'])
+    agent.eval()
+
+    # Calibration: letterboxed patches for the detector, test transformed scenes for the agent
+    files = image_files(opt.calib_patches, opt.calib_images)
+    x = [SARODEngine.patch_tensor(cv2.imread(f), opt.coarse_size).float() / 255.0 for f in files]
+    print('Calibrating the coarse detector on %g patches...' % len(x))
+    coarse_int8 = QuantizedModel(coarse_model, batches(x, opt.batch_size))
+    if opt.agent == 'features':  # the FeaturePolicy MLP is small, it routes on the INT8 detector features
+        agent_int8 = agent
+    else:
+        transform = utils_ete.get_transforms(opt.img_size)[1]
+        files = image_files(opt.calib_scenes, max(opt.calib_images // na, 1))
+        x = [transform(Image.open(f).convert('RGB')) for f in files]
+        print('Calibrating the agent on %g scenes...' % len(x))
+        agent_int8 = quantize_fx(agent, batches(x, opt.batch_size))
+
+    # AP of the coarse detector on the patches of --data
+    report = {}
+    for name, model in (('fp32', coarse_model), ('int8', coarse_int8)):
+        results = test_rl.test(opt.data, batch_size=1, imgsz=opt.coarse_size, model=model, task=opt.task,
+                               grid=opt.grid, half=False, channels_last=False)
+        report[name] = {'coarse_map50': detector_map(results)}
+
+    # Routing decisions and scene detections of the pipeline, INT8 coarse detector and agent against fp32
+    engines = {name: SARODEngine(a, fine_model, m, img_size=opt.img_size, fine_size=opt.fine_size,
+                                 coarse_size=opt.coarse_size, grid=opt.grid, device=device, half=False,
+                                 channels_last=False)
+               for name, a, m in (('fp32', agent, coarse_model), ('int8', agent_int8, coarse_int8))}
+    files = image_files(opt.source, opt.images)
+    agree, same, found, matched = [], [], [], []
+    for f in files:
+        (det, _, policy), (det_q, _, policy_q) = (engines[k]([f])[0] for k in ('fp32', 'int8'))
+        agree.append(float((policy == policy_q).float().mean()))
+        same.append(bool((policy == policy_q).all()))
+        found.append(match(det[det[:, 4] > 0.1], det_q))
+        matched.append(match(det_q[det_q[:, 4] > 0.1], det))
+    report['int8'].update({'policy_agreement': float(np.mean(agree)), 'same_policy': float(np.mean(same)),
+                           'detections_found': float(np.mean(found)), 'detections_matched': float(np.mean(matched))})
+
+    # CPU latency of the quantized models and of the pipeline per scene
+    scenes = [cv2.imread(f) for f in files[:10]]
+    for name, a, m in (('fp32', agent, coarse_model), ('int8', agent_int8, coarse_int8)):
+        report[name]['coarse_ms'] = latency(m, [torch.rand(na, 3, opt.coarse_size, opt.coarse_size)])
+        if opt.agent == 'resnet34':
+            report[name]['agent_ms'] = latency(a, [torch.rand(1, 3, opt.img_size, opt.img_size)])
+        report[name]['sarod_ms'] = latency(lambda s: engines[name]([s]), scenes, n=1)
+
+    # Print results
+    keys = [k for k in ('coarse_map50', 'coarse_ms', 'agent_ms', 'sarod_ms') if k in report['fp32']]
+    print(('\n%-8s' + '%14s' * len(keys)) % (('model',) + tuple(keys)))
+    for name, r in report.items():
+        print(('%-8s' + '%14.4g' * len(keys)) % ((name,) + tuple(r[k] for k in keys)))
+    r = report['int8']
+    print('speedup %s' % ' '.join('%s %.2fx' % (k, report['fp32'][k] / r[k]) for k in keys if k.endswith('_ms')))
+    print('int8 vs fp32: mAP@0.5 %+.4f, policy agreement %.3f (same policy %.3f), detections (conf > 0.1) found '
+          '%.3f / matched %.3f at IoU 0.5' % (r['coarse_map50'] - report['fp32']['coarse_map50'],
+                                              r['policy_agreement'], r['same_policy'], r['detections_found'],
+                                              r['detections_matched']))
+
+    # Save
+    if opt.save:
+        os.makedirs(os.path.dirname(opt.save) or '.', exist_ok=True)
+        with torch.no_grad():
+            x = torch.zeros(1, 3, opt.coarse_size, opt.coarse_size)
+            torch.jit.trace(coarse_int8, x, check_trace=False).save(opt.save + '_coarse.pt')
+            if opt.agent == 'resnet34':
+                torch.jit.trace(agent_int8, torch.zeros(1, 3, opt.img_size, opt.img_size)).save(opt.save + '_agent.pt')
+        print('INT8 TorchScript models saved as %s_*.pt' % opt.save)
+    if opt.json:
+        with open(opt.json, 'w') as f:
+            json.dump({'config': vars(opt), 'systems': report}, f, indent=2)
@@ -6,6 +6,10 @@ import argparse
 
 from yolov5.train_dt import *
 from EfficientObjectDetection.train_new_reward import *
+from EfficientObjectDetection.constants import num_windows
+from yolov5.utils.image_cache import ImageCache
+from yolov5.utils.torch_utils import set_threads, is_parallel
+from yolov5.utils.parallel import run_jobs, Timeline
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -15,11 +19,36 @@ if __name__ == '__main__':
     parser.add_argument('--test_epoch', type=int, default=10)
     parser.add_argument('--eval_epoch', type=int, default=2)
     parser.add_argument('--step_batch_size', type=int, default=100)
+    parser.add_argument('--num_policy_samples', type=int, default=1, help='policies sampled per image and step')
     parser.add_argument('--save_path', default='save')
     parser.add_argument('--rl_weight', default=None)
     parser.add_argument('--h_detector_weight', default=' ')
     parser.add_argument('--l_detector_weight', default=' ')
+    parser.add_argument('--result_cache', default='', help='directory of the cached per-patch detector results, with --freeze_detectors')
+    parser.add_argument('--scenes', action='store_true', help='tile full scenes on the fly instead of reading pre-cut patches')
+    parser.add_argument('--freeze_detectors', action='store_true', help='train the agent only')
+    parser.add_argument('--image_cache', default='', help='directory of the shared decoded-image cache')
+    parser.add_argument('--image_cache_gb', type=float, default=4, help='image cache budget (GB)')
+    parser.add_argument('--agent_store', default='', help='directory of the preprocessed uint8 agent inputs')
+    parser.add_argument('--agent', default='resnet34', choices=['resnet34', 'features'],
+                        help='policy network on the scene image or on the coarse-detector features')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op CPU threads, 0 for the default')
+    parser.add_argument('--interop_threads', type=int, default=0, help='torch inter-op CPU threads, 0 for the default')
+    parser.add_argument('--fp32', action='store_true', help='no fp16 detector inference on CUDA')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='autocast mixed precision of detector and agent training (bf16 also on CPU)')
+    parser.add_argument('--gate', default='', choices=['', 'band', 'entropy'],
+                        help='also test the coarse-first routing gated by the uncertainty of the coarse detections')
+    parser.add_argument('--gate_band', nargs=2, type=float, default=[0.1, 0.5], help='score band of the band gate')
+    parser.add_argument('--gate_thres', type=float, default=1., help='boxes in the band or entropy bits sending a patch fine')
+    parser.add_argument('--concurrent_detectors', action='store_true', help='run the fine and coarse detector phases concurrently')
     opt = parser.parse_args()
+    if opt.result_cache and not opt.freeze_detectors:  # keyed by the weights, which change every epoch
+        print('--result_cache needs fixed detector weights (--freeze_detectors), disabled')
+        opt.result_cache = ''
+    set_threads(opt.threads, opt.interop_threads)
+    image_cache = ImageCache(opt.image_cache, sizes=(480, 96), budget=opt.image_cache_gb * 2 ** 30) \
+        if opt.image_cache else None  # shared by the fine, coarse and agent loaders
 
     fine_opt_tr = easydict.EasyDict({
         "cfg": "yolov5/models/yolov5x_custom.yaml",
@@ -42,14 +71,20 @@ if __name__ == '__main__':
         "multi_scale": False,
         "single_cls": True,
         "sync_bn": False,
-        "local_rank": -1
+        "local_rank": -1,
+        "precision": opt.precision
     })
 
     fine_opt_eval = easydict.EasyDict({
         "data": "yolov5/data/HRSID_800_rl.yaml",
         "batch_size": 1,
         "conf_thres": 0.001,
-        "iou_thres": 0.6  # for NMS
+        "iou_thres": 0.6,  # for NMS
+        "result_cache": opt.result_cache,
+        "scenes": opt.scenes,
+        "grid": num_windows,
+        "half": False if opt.fp32 else None,
+        "image_cache": image_cache
     })
 
     coarse_opt_tr = easydict.EasyDict({
@@ -73,14 +108,21 @@ if __name__ == '__main__':
         "multi_scale": False,
         "single_cls": True,
         "sync_bn": False,
-        "local_rank": -1
+        "local_rank": -1,
+        "precision": opt.precision
     })
 
     coarse_opt_eval = easydict.EasyDict({
         "data": "yolov5/data/HRSID_800_rl.yaml",
         "batch_size": 1,
         "conf_thres": 0.001,
-        "iou_thres": 0.6  # for NMS
+        "iou_thres": 0.6,  # for NMS
+        "result_cache": opt.result_cache,
+        "scenes": opt.scenes,
+        "grid": num_windows,
+        "half": False if opt.fp32 else None,
+        "image_cache": image_cache,
+        "return_features": opt.agent == 'features'
     })
 
     EfficientOD_opt = easydict.EasyDict({
@@ -89,6 +131,7 @@ if __name__ == '__main__':
         "cv_dir": opt.save_path,
         "batch_size": 1,
         "step_batch_size": opt.step_batch_size,
+        "num_samples": opt.num_policy_samples,
         "img_size": 480,
         "epoch_step": 20,
         "max_epochs": opt.epochs,
@@ -97,35 +140,53 @@ if __name__ == '__main__':
         "alpha": 0.8,
         "beta": 0.1,
         "sigma": 0.5,
-        "load": opt.rl_weight
+        "load": opt.rl_weight,
+        "image_cache": image_cache,
+        "agent_store": opt.agent_store,
+        "agent": opt.agent,
+        "precision": opt.precision,
+        "routing": 'gate' if opt.gate else 'agent',  # of EfficientOD.engine(), test() takes both
+        "gate": opt.gate or 'band',
+        "gate_band": opt.gate_band,
+        "gate_thres": opt.gate_thres
     })
 
 
     fine_detector = yolov5(fine_opt_tr, fine_opt_eval)
     coarse_detector = yolov5(coarse_opt_tr, coarse_opt_eval)
-    rl_agent = EfficientOD(EfficientOD_opt)
 
     epochs = opt.epochs
 
     fine_detector.main(epochs)
     coarse_detector.main(epochs)
 
+    if opt.agent == 'features':  # input of the feature agent, the coarse model only exists after main()
+        model = coarse_detector.model.module if is_parallel(coarse_detector.model) else coarse_detector.model
+        EfficientOD_opt.feature_channels = sum(model.feature_channels())
+    rl_agent = EfficientOD(EfficientOD_opt)
+
+    detectors = {'fine': fine_detector, 'coarse': coarse_detector}
+    timeline = Timeline(os.path.join(opt.save_path, 'timeline.txt'))
+
+    def detector_phase(e, phase, fn):
+        # fn(detector) for both detectors, concurrently with --concurrent_detectors
+        results, times = run_jobs({k: (lambda d=d: fn(d)) for k, d in detectors.items()},
+                                  concurrent=opt.concurrent_detectors, device=fine_detector.device)
+        timeline.log(e, phase, times)
+        return results['fine'], results['coarse']
+
     for e in range(epochs):
-        fine_detector.train(e)
-        coarse_detector.train(e)
-        fine_eval_results = fine_detector.eval('train')
-        coarse_eval_results = coarse_detector.eval('train')
+        def train_eval(detector):
+            if not opt.freeze_detectors:
+                detector.train(e)
+            return detector.eval('train')
+        fine_eval_results, coarse_eval_results = detector_phase(e, 'train', train_eval)
         rl_agent.train(e, fine_eval_results, coarse_eval_results)
         if e % opt.eval_epoch == 0:
-            eval_fine = fine_detector.eval('val')
-            eval_coarse = coarse_detector.eval('val')
+            eval_fine, eval_coarse = detector_phase(e, 'val', lambda d: d.eval('val'))
             rl_agent.eval(e, eval_fine, eval_coarse)
         if e % opt.test_epoch == 0:
-            test_fine = fine_detector.eval('test')
-            test_coarse = coarse_detector.eval('test')
-            rl_agent.test(e, test_fine, test_coarse)
-
-
-
-
-
+            test_fine, test_coarse = detector_phase(e, 'test', lambda d: d.eval('test'))
+            rl_agent.test(e, test_fine, test_coarse, routing='agent')
+            if opt.gate:  # same patches routed by the gate
+                rl_agent.test(e, test_fine, test_coarse, routing='gate')
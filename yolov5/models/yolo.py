@@ -35,7 +35,7 @@ class Detect(nn.Module):
                 y = x[i].sigmoid()
                 y[..., 0:2] = (y[..., 0:2] * 2. - 0.5 + self.grid[i].to(x[i].device)) * self.stride[i]  # xy
                 y[..., 2:4] = (y[..., 2:4] * 2) ** 2 * self.anchor_grid[i]  # wh
-                z.append(y.view(bs, -1, self.no))
+                z.append(y.view(bs, self.na * ny * nx, self.no))  # explicit size, bs may be 0
 
         return x if self.training else (torch.cat(z, 1), x)
 
@@ -79,7 +79,7 @@ class Model(nn.Module):
         self.info()
         print('')
 
-    def forward(self, x, augment=False, profile=False):
+    def forward(self, x, augment=False, profile=False, features=False):
         if augment:
             img_size = x.shape[-2:]  # height, width
             s = [0.83, 0.67]  # scales
@@ -96,9 +96,9 @@ class Model(nn.Module):
             y[2][..., :4] /= s[1]  # scale
             return torch.cat(y, 1), None  # augmented inference, train
         else:
-            return self.forward_once(x, profile)  # single-scale inference, train
+            return self.forward_once(x, profile, features)  # single-scale inference, train
 
-    def forward_once(self, x, profile=False):
+    def forward_once(self, x, profile=False, features=False):
         y, dt = [], []  # outputs
         for m in self.model:
             if m.f != -1:  # if not from previous layer
@@ -121,6 +121,8 @@ class Model(nn.Module):
 
         if profile:
             print('%.1fms total' % sum(dt))
+        if features:  # also return the Detect() input maps (P3-P5 head outputs, kept in self.save)
+            return x, [y[j] for j in self.model[-1].f]
         return x
 
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
@@ -146,7 +148,7 @@ class Model(nn.Module):
     def fuse(self):  # fuse model Conv2d() + BatchNorm2d() layers
         # print('Fusing layers... ', end='')
         for m in self.model.modules():
-            if type(m) is Conv:
+            if type(m) is Conv and m.bn is not None:  # not fused yet, e.g. by attempt_load()
                 m.conv = torch_utils.fuse_conv_and_bn(m.conv, m.bn)  # update conv
                 m.bn = None  # remove batchnorm
                 m.forward = m.fuseforward  # update forward
@@ -156,6 +158,9 @@ class Model(nn.Module):
     def info(self):  # print model information
         torch_utils.model_info(self)
 
+    def feature_channels(self):  # channels of the maps returned by forward(features=True)
+        return [m.in_channels for m in self.model[-1].m]
+
 
 def parse_model(d, ch):  # model_dict, input_channels(3)
     print('\n%3s%18s%3s%10s  %-40s%-30s' % ('', 'from', 'n', 'params', 'module', 'arguments'))
@@ -3,6 +3,7 @@ import json
 
 from yolov5.models.experimental import *
 from yolov5.utils.datasets import *
+from yolov5.utils.matching import match_predictions
 
 
 def test(data,
@@ -137,33 +138,10 @@ def test(data,
                                   'bbox': [round(x, 3) for x in b],
                                   'score': round(p[4], 5)})
 
-            # Assign all predictions as incorrect
-            correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
-            if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
-                # target boxes
-                tbox = xywh2xyxy(labels[:, 1:5]) * whwh
-
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero().view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero().view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(pred[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        for j in (ious > iouv[0]).nonzero():
-                            d = ti[i[j]]  # detected target
-                            if d not in detected:
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
+            # Greedy unique assignment of the predictions to the targets, for every iou threshold
+            tbox = xywh2xyxy(labels[:, 1:5]) * whwh  # target boxes
+            correct = match_predictions(box_iou(pred[:, :4], tbox), pred.new_zeros(len(pred)), pred[:, 5],
+                                        labels.new_zeros(nl), labels[:, 0], iouv)
 
             # Append statistics (correct, conf, pcls, tcls)
             stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
@@ -394,33 +372,11 @@ def test_rl(inputs,
             # Clip boxes to image bounds
             clip_coords(pred, (height, width))
 
-            # Assign all predictions as incorrect
-            correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
-            if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
-                # target boxes
-                tbox = xywh2xyxy(labels[:, 1:5]) * whwh
-
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero().view(-1)  # prediction indices
-                    pi = (cls == pred[:, 5]).nonzero().view(-1)  # target indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(pred[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        for j in (ious > iouv[0]).nonzero():
-                            d = ti[i[j]]  # detected target
-                            if d not in detected:
-                                detected.append(d)
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
+            # Greedy unique assignment of the predictions to the targets, for every iou threshold
+            tbox = xywh2xyxy(labels[:, 1:5]) * whwh  # target boxes
+            correct = match_predictions(box_iou(pred[:, :4], tbox), pred.new_zeros(len(pred)), pred[:, 5],
+                                        labels.new_zeros(nl), labels[:, 0], iouv)
+
             # Append statistics (correct, conf, pcls, tcls)
             stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
 
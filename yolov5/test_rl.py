@@ -15,8 +15,9 @@ from yolov5.models.experimental import attempt_load
 from yolov5.utils.datasets_rl import create_dataloader
 from yolov5.utils.general_rl import (coco80_to_coco91_class, check_file, check_img_size, scale_coords, xyxy2xywh,
                                      clip_coords, plot_images, xywh2xyxy, box_iou, output_to_target)
-from yolov5.utils.utils import compute_loss, non_max_suppression, ap_per_class
-from yolov5.utils.torch_utils import select_device, time_synchronized
+from yolov5.utils.utils import compute_loss, non_max_suppression_batched, ap_per_class
+from yolov5.utils.matching import match_predictions
+from yolov5.utils.torch_utils import select_device, time_synchronized, inference_mode, prepare_model, warmup
 
 
 def test(data,
@@ -34,9 +35,19 @@ def test(data,
          save_dir='',
          merge=False,
          save_txt=False,
-         task='train'):
+         task='train',
+         cache=None,
+         scenes=False,
+         grid=2,
+         image_cache=None,
+         return_features=False,
+         half=None,
+         channels_last=None,
+         fuse=False):
     # Initialize/load model and set device
     result_list = []
+    if return_features:  # pooled features are appended to every result tuple, they are not cached
+        cache = None
 
     training = model is not None
     # print('detector-eval function 확인 - model:', model)
@@ -64,13 +75,12 @@ def test(data,
         # if device.type != 'cpu' and torch.cuda.device_count() > 1:
         #     model = nn.DataParallel(model)
 
-    # Half
-    half = device.type != 'cpu'  # half precision only supported on CUDA
-    if half:
-        model.half()
+    # Half on CUDA, channels_last on CPU unless set, fused Conv2d() + BatchNorm2d() (on a copy of a training model)
+    if fuse and training:
+        model = copy.deepcopy(model)
+    model, half, channels_last = prepare_model(model, device, half=half, channels_last=channels_last, fuse=fuse)
 
     # Configure
-    model.eval()
     with open(data) as f:
         data = yaml.load(f, Loader=yaml.FullLoader)  # model dict
     nc = 1 if single_cls else int(data['nc'])  # number of classes
@@ -79,8 +89,7 @@ def test(data,
 
     # Dataloader
     # if not training:
-    img = torch.zeros((1, 3, imgsz, imgsz), device=device)  # init img
-    _ = model(img.half() if half else img) if device.type != 'cpu' else None  # run once
+    warmup(model, (1, 3, imgsz, imgsz), device, half, channels_last)  # run once
     if task == 'val':
         path = data['val']
     elif task == 'train':
@@ -90,172 +99,157 @@ def test(data,
     # path = data['val'] if task == 'val' else data['train']  # path to val/test images
     # path = data['train'] # path to val/test images
     # print('path', path)
-    dataloader = create_dataloader(path, imgsz, batch_size, model.stride.max(),
-                                   augment=False, cache=False, pad=0.5, rect=True)[0]
+    if scenes:  # full scenes tiled on the fly, <root>/<split>/images instead of <root>/rl_ver/<split>/images
+        path = data.get(task + '_scenes', path.replace('rl_ver' + os.sep, ''))
+    select = None
+    if cache is not None:  # ResultCache, only run the images with a missing or stale patch result
+        cache.bind(model, imgsz, conf_thres, iou_thres, merge)
+        select = lambda files: any(cache.stale(f) for f in files)
+    if dataloader is None:
+        dataloader, dataset = create_dataloader(path, imgsz, batch_size, model.stride.max(), augment=False,
+                                                cache=False, pad=0.5, rect=True, select=select, scenes=scenes,
+                                                grid=grid, image_cache=image_cache)
+    else:  # passed-in dataloader, used as is
+        dataset = dataloader.dataset
 
     seen = 0
     names = model.names if hasattr(model, 'names') else model.module.names
     coco91class = coco80_to_coco91_class()
     # s = ('%20s' + '%12s' * 7) % ('Class', 'Images', 'Targets', 'P', 'R', 'mAP@.5', 'mAP@.5:.95', 'number of object')
-    p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
+    p, r, f1, mp, mr, map50, map = 0., 0., 0., 0., 0., 0., 0.
+    t_load, t_inf, t_loss, t_nms, t_stats = 0., 0., 0., 0., 0.  # per-stage timings
     loss = torch.zeros(3, device=device)
     total_stats = []
-    for batch_i, (img_list, targets_list, paths_list, shapes_list) in enumerate(tqdm(dataloader)):
-        # print('\npaths_list', paths_list)
-        # print('\ntargets_list', targets_list)
-
-        # index_stats = []
-        for number in range(batch_size):
-            jdict, ap, ap_class = [], [], []
-            img = img_list[number]  # 4, c, h, w
-            targets = targets_list[targets_list[:, 0] == number, 1:]  # [x, 6] (6: img patch number, class number, bounding box corrd)
-            # print('\ntargets', targets)
+    t = time_synchronized()
+    for batch_i, (img_list, targets_list, paths_list, shapes_list, *_) in enumerate(tqdm(dataloader)):
+        # Stack every patch of every image in the batch, patch k belongs to image k // na
+        bs, na, _, height, width = img_list.shape  # images, patches per image, channels, height, width
+        img = img_list.to(device, non_blocking=True).view(bs * na, -1, height, width)
+        img = img.half() if half else img.float()  # uint8 to fp16/32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        img = img.contiguous(memory_format=torch.channels_last) if channels_last else img
+        targets = targets_list.to(device)
+        targets = torch.cat((targets[:, :1] * na + targets[:, 1:2], targets[:, 2:]), 1)  # [x, 6] (patch, class, xywh)
+        whwh = torch.Tensor([width, height, width, height]).to(device)
+        t_load += time_synchronized() - t
+
+        # Disable gradients
+        with inference_mode():
+            # Run model once on all patches
+            t = time_synchronized()
+            if return_features:  # global average pooled Detect() input maps per patch, for the feature agent
+                (inf_out, train_out), features = model(img, augment=augment, features=True)
+                features = torch.cat([x.float().mean((2, 3)) for x in features], 1).half().cpu()
+            else:
+                inf_out, train_out = model(img, augment=augment)  # inference and training outputs
+            t_inf += time_synchronized() - t
+
+            # Compute loss per patch on slices of the batched training output
+            t = time_synchronized()
+            patch_loss = [0.] * (bs * na)
+            if training and not hasattr(model, 'hyp'):  # no loss hyperparameters, the loss is unknown rather than 0
+                if batch_i == 0:
+                    print('WARNING: model has no hyp, patch loss reported as nan')
+                patch_loss = [float('nan')] * (bs * na)
+            elif training:
+                train_out = [x.float() for x in train_out]
+                loss_list = []
+                for k in range(bs * na):
+                    target_forloss = targets[targets[:, 0] == k]
+                    target_forloss[:, 0] = 0
+                    loss = compute_loss([x[k:k + 1] for x in train_out], target_forloss, model)[1][:3]  # GIoU, obj, cls
+                    loss_list.append(loss)
+                patch_loss = torch.stack(loss_list).mean(1).tolist()
+            t_loss += time_synchronized() - t
+
+            # Run NMS once on all patches
+            t = time_synchronized()
+            output = non_max_suppression_batched(inf_out, conf_thres=conf_thres, iou_thres=iou_thres, merge=merge)
+            t_nms += time_synchronized() - t
+        output = [x.clone() if x is not None else None for x in output]  # inference tensors are read-only outside
+
+        # Statistics per patch
+        t = time_synchronized()
+        for k, pred in enumerate(output):
+            if pred is not None:
+                # Append to text file
+                if save_txt:
+                    number, i = divmod(k, na)
+                    paths, shapes = paths_list[number], shapes_list[number]
+                    gn = torch.tensor(shapes[i][0])[[1, 0, 1, 0]]  # normalization gain whwh
+                    txt_path = str(out / Path(paths[i]).stem)
+                    pred[:, :4] = scale_coords(img[k].shape[1:], pred[:, :4], shapes[i][0], shapes[i][1])  # to original
+                    for *xyxy, conf, cls in pred:
+                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
+                        with open(txt_path + '.txt', 'a') as f:
+                            f.write(('%g ' * 5 + '\n') % (cls, *xywh))  # label format
+
+                # Clip boxes to image bounds
+                clip_coords(pred, (height, width))
+
+        # Match the predictions of all patches to their targets at once
+        n = [0 if pred is None else len(pred) for pred in output]
+        pred_all = torch.cat([pred for pred in output if pred is not None] + [torch.zeros((0, 6), device=device)])
+        pred_patch = torch.repeat_interleave(torch.arange(len(output), device=device), torch.tensor(n, device=device))
+        tbox = xywh2xyxy(targets[:, 2:6]) * whwh  # target boxes
+        correct_list = match_predictions(box_iou(pred_all[:, :4], tbox), pred_patch, pred_all[:, 5], targets[:, 0],
+                                         targets[:, 1], iouv).split(n)
+
+        for k, pred in enumerate(output):
+            number, i = divmod(k, na)  # image index in batch, patch index in image
             paths = paths_list[number]
             shapes = shapes_list[number]
-
-            img = img.to(device, non_blocking=True)
-            img = img.half() if half else img.float()  # uint8 to fp16/32
-            img /= 255.0  # 0 - 255 to 0.0 - 1.0
-            targets = targets.to(device)
-            nb, _, height, width = img.shape  # 4, channels, height, width
-            whwh = torch.Tensor([width, height, width, height]).to(device)
-
-            # Disable gradients
-            with torch.no_grad():
-                # Run model
-                t = time_synchronized()
-                inf_out_list = []
-                train_out_list = []
-                for i in range(4):
-                    inf_out, train_out = model(img[i].unsqueeze(0), augment=augment)  # inference and training outputs
-                    inf_out_list.append(inf_out)
-                    train_out_list.append(train_out)
-                t0 += time_synchronized() - t
-
-                # Compute loss
-                if training:  # if model has loss hyperparameters
-                    loss_list = []
-                    for i in range(4):
-                        target_forloss = torch.zeros(targets[targets[:, 0]==i, :].shape, device=device)
-                        target_forloss[:, 0] = 0
-                        target_forloss[:, 1:] = targets[targets[:, 0]==i, 1:]
-                        # print('\ntarget_forloss', target_forloss)
-                        # loss += compute_loss([x.float() for x in train_out], targets, model)[1][:3]  # GIoU, obj, cls
-                        loss = compute_loss([x.float() for x in train_out_list[i]], target_forloss, model)[1][:3]  # GIoU, obj, cls
-                        loss_list.append(loss)
-
-                # Run NMS
-                t = time_synchronized()
-                output_list = []
-                for i in range(4):
-                    output = non_max_suppression(inf_out_list[i], conf_thres=conf_thres, iou_thres=iou_thres, merge=merge)
-                    output_list.append(output)
-                t1 += time_synchronized() - t
-                # print('\noutput_list', output_list)
-
-            # Statistics per image
-            nl_patch = []
-
-            for i in range(4):
-                p, r, f1, mp, mr, map50, map, t0, t1 = 0., 0., 0., 0., 0., 0., 0., 0., 0.
-                stats, ap_class = [], []
-                for si, pred in enumerate(output_list[i]):
-                    # print('\noutput_list[i]', output_list[i])
-                    # print('\nsi', si)
-                    # print('\npred', pred)
-                    labels = targets[targets[:, 0] == i, 1:]
-                    nl = len(labels)
-                    # print('\nlabels', labels)
-                    tcls = labels[:, 0].tolist() if nl else []  # target class
-                    seen += 1
-
-                    if pred is None:
-                        if len(labels):
-                            stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
-                            total_stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
-                        continue
-
-                    # Append to text file
-                    if save_txt:
-                        gn = torch.tensor(shapes[si][0])[[1, 0, 1, 0]]  # normalization gain whwh
-                        txt_path = str(out / Path(paths[si]).stem)
-                        pred[:, :4] = scale_coords(img[si].shape[1:], pred[:, :4], shapes[si][0], shapes[si][1])  # to original
-                        for *xyxy, conf, cls in pred:
-                            print('\ncls:\n', cls)
-                            print('\n&xyxy:\n', *xyxy)
-                            xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                            with open(txt_path + '.txt', 'a') as f:
-                                f.write(('%g ' * 5 + '\n') % (cls, *xywh))  # label format
-
-                    # Clip boxes to image bounds
-                    clip_coords(pred, (height, width))
-
-                    # Append to pycocotools JSON dictionary
-                    if save_json:
-                        # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
-                        image_id = Path(paths[si]).stem
-                        box = pred[:, :4].clone()  # xyxy
-                        scale_coords(img[si].shape[1:], box, shapes[si][0], shapes[si][1])  # to original shape
-                        box = xyxy2xywh(box)  # xywh
-                        box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
-                        for p, b in zip(pred.tolist(), box.tolist()):
-                            jdict.append({'image_id': int(image_id) if image_id.isnumeric() else image_id,
-                                          'category_id': coco91class[int(p[5])],
-                                          'bbox': [round(x, 3) for x in b],
-                                          'score': round(p[4], 5)})
-
-                    # Assign all predictions as incorrect
-                    correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
-                    # print('\ncorrect', correct)
-                    if nl:
-                        detected = []  # target indices
-                        tcls_tensor = labels[:, 0]
-
-                        # target boxes
-                        # print('\nlabels.shape\n', labels.shape)
-                        tbox = xywh2xyxy(labels[:, 1:5]) * whwh
-                        # print('\ntbox', tbox)
-
-                        # Per target class
-                        for cls in torch.unique(tcls_tensor):
-                            ti = (cls == tcls_tensor).nonzero(as_tuple=False).view(-1)  # prediction indices
-                            pi = (cls == pred[:, 5]).nonzero(as_tuple=False).view(-1)  # target indices
-                            # print('\nti', ti)
-                            # print('\npi', pi)
-
-                            # Search for detections
-                            if pi.shape[0]:
-                                # Prediction to target ious
-                                ious, ii = box_iou(pred[pi, :4], tbox[ti]).max(1)  # best ious, indices
-                                # print('\nious', ious)
-                                # print('\nii', ii)
-
-                                # Append detections
-                                for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                                    # print('\nious > iouv[0]', ious > iouv[0])
-                                    d = ti[ii[j]]  # detected target
-                                    # print('\nti[ii[j]]', ti[ii[j]])
-                                    if d not in detected:
-                                        if len(detected) != len(labels):
-                                            detected.append(d)
-                                            correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                        # if len(detected) == nl:  # all targets already located in image
-                                        #     break
-
-                    # Append statistics (correct, conf, pcls, tcls)
-                    stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
-                    total_stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
-                #
-                # print(len(stats))
-                # result_stats = copy.deepcopy(stats)
-
-                temp = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
-                if len(temp) and temp[0].any():
-                    p, r, ap, f1, ap_class = ap_per_class(*temp)
-                    p, r, ap50, ap = p[:, 0], r[:, 0], ap[:, 0], ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
-                    mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-                source_path = paths[i].split(os.sep)[-1][:-6]
-                result_list.append((source_path, paths[i], mp, mr, float(map50), loss_list[i].mean().detach().cpu().item(), nl, stats))
+            jdict, ap, ap_class = [], [], []
+            p, r, f1, mp, mr, map50, map = 0., 0., 0., 0., 0., 0., 0.
+            stats = []
+            labels = targets[targets[:, 0] == k, 1:]
+            nl = len(labels)
+            tcls = labels[:, 0].tolist() if nl else []  # target class
+            seen += 1
+
+            if pred is None:
+                if nl:
+                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
+            else:
+                # Append to pycocotools JSON dictionary
+                if save_json:
+                    # [{"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}, ...
+                    image_id = Path(paths[i]).stem
+                    box = pred[:, :4].clone()  # xyxy
+                    scale_coords(img[k].shape[1:], box, shapes[i][0], shapes[i][1])  # to original shape
+                    box = xyxy2xywh(box)  # xywh
+                    box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
+                    for p, b in zip(pred.tolist(), box.tolist()):
+                        jdict.append({'image_id': int(image_id) if image_id.isnumeric() else image_id,
+                                      'category_id': coco91class[int(p[5])],
+                                      'bbox': [round(x, 3) for x in b],
+                                      'score': round(p[4], 5)})
+
+                # Greedy unique assignment to the targets of the patch, for every iou threshold
+                correct = correct_list[k]
+
+                # Append statistics (correct, conf, pcls, tcls)
+                stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+            total_stats += stats
+
+            temp = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
+            if len(temp) and temp[0].any():
+                p, r, ap, f1, ap_class = ap_per_class(*temp)
+                p, r, ap50, ap = p[:, 0], r[:, 0], ap[:, 0], ap.mean(1)  # [P, R, AP@0.5, AP@0.5:0.95]
+                mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
+            source_path = os.path.splitext(os.path.basename(paths[i]))[0].rsplit('_', 1)[0]  # <name>_<patch>.jpg
+            result_list.append((source_path, paths[i], mp, mr, float(map50), patch_loss[k], nl, stats) +
+                               ((features[k],) if return_features else ()))
+        t_stats += time_synchronized() - t
+        t = time_synchronized()
+
+    if cache is not None:  # merge the new results with the cached ones, in dataset order
+        for x in result_list:
+            cache.put(x)
+        cache.flush()
+        result_list = [cache.get(f) for files in dataset.img_files for f in files if f in cache]
+        total_stats = [s for x in result_list for s in x[7]]
+        print('%g/%g patch results reused from %s' % (len(result_list) - seen, len(result_list), cache.dir))
 
     total_temp = [np.concatenate(x, 0) for x in zip(*total_stats)]
 
@@ -270,6 +264,14 @@ def test(data,
     print('{} result - precison: {}'.format(imgsz, mp))
     print('{} result - recall: {}'.format(imgsz, mr))
 
+    if image_cache is not None:
+        print('Image cache: %(hits)g hits, %(misses)g misses, %(evictions)g evictions, %(used)g/%(slots)g slots' %
+              image_cache.stats())
+
+    # Print speeds
+    s = tuple(x / max(seen, 1) * 1E3 for x in (t_load, t_inf, t_loss, t_nms, t_stats)) + (imgsz, imgsz)
+    print('Speed: %.1f/%.1f/%.1f/%.1f/%.1f ms load/inference/loss/NMS/statistics per %gx%g patch' % s)
+
     save_path = 'save/' + task + '_' + str(imgsz) + '_results.txt'
     with open(save_path, 'a') as f:
         f.write(str(map50)+' '+str(mp)+' '+str(mr)+'\n')
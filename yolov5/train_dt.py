@@ -14,15 +14,9 @@ from yolov5.models.yolo import Model
 from yolov5.utils import google_utils
 from yolov5.utils.datasets import *
 from yolov5.utils.utils import *
+from yolov5.utils.result_cache import ResultCache
 from yolov5.models.experimental import *
 
-mixed_precision = True
-try:  # Mixed precision training https://github.com/NVIDIA/apex
-    from apex import amp
-except:
-    print('Apex recommended for faster mixed precision training: https://github.com/NVIDIA/apex')
-    mixed_precision = False  # not installed
-
 class yolov5():
 
     def __init__(self, opt_tr, opt_eval):
@@ -34,6 +28,7 @@ class yolov5():
         self.last = self.wdir + 'last.pt'
         self.best = self.wdir + 'best.pt'
         self.results_file = 'results.txt'
+        self.result_cache = ResultCache(opt_eval.result_cache) if opt_eval.get('result_cache') else None
 
         # Hyperparameters
         self.hyp = {'optimizer': 'SGD',  # ['adam', 'SGD', None] if none, default is SGD
@@ -168,9 +163,9 @@ class yolov5():
 
             del ckpt
 
-        # Mixed precision training https://github.com/NVIDIA/apex
-        if mixed_precision:
-            self.model, self.optimizer = amp.initialize(self.model, self.optimizer, opt_level='O1', verbosity=0)
+        # Mixed precision training: 'fp16' (scaled losses) or 'bf16' autocast, also on CPU
+        self.precision = self.opt.get('precision', 'fp32')
+        self.scaler = torch_utils.grad_scaler(self.device, self.precision)
 
         # Scheduler https://arxiv.org/pdf/1812.01187.pdf
         self.lf = lambda x: (((1 + math.cos(x * math.pi / self.epochs)) / 2) ** 1.0) * 0.8 + 0.2  # cosine
@@ -224,6 +219,8 @@ class yolov5():
         self.model.gr = 1.0  # giou loss ratio (obj_loss = 1.0 or giou)
         self.model.class_weights = labels_to_class_weights(self.dataset.labels, self.nc).to(self.device)  # attach class weights
         self.model.names = self.names
+        if self.ema:  # loss attributes for the evaluation of the EMA, also when train() never updates it
+            self.ema.update_attr(self.model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride'])
 
         # Class frequency
         if rank in [-1, 0]:
@@ -315,10 +312,11 @@ class yolov5():
                         imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
 
                 # Forward
-                pred = self.model(imgs)
+                with torch_utils.autocast(self.device, self.precision):
+                    pred = self.model(imgs)
 
-                # Loss
-                loss, loss_items = compute_loss(pred, targets.to(self.device), self.model)  # scaled by batch_size
+                    # Loss
+                    loss, loss_items = compute_loss(pred, targets.to(self.device), self.model)  # scaled by batch_size
                 if rank != -1:
                     loss *= self.opt.world_size  # gradient averaged between devices in DDP mode
                 if not torch.isfinite(loss):
@@ -326,15 +324,12 @@ class yolov5():
                     return self.results
 
                 # Backward
-                if mixed_precision:
-                    with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    loss.backward()
+                self.scaler.scale(loss).backward()
 
                 # Optimize
                 if ni % self.accumulate == 0:
-                    self.optimizer.step()
+                    self.scaler.step(self.optimizer)  # skipped on inf/nan gradients
+                    self.scaler.update()
                     self.optimizer.zero_grad()
                     if self.ema is not None:
                         self.ema.update(self.model)
@@ -446,7 +441,11 @@ class yolov5():
         results = test_rl.test(data=self.opt_eval.data, batch_size=self.opt_eval.batch_size, imgsz=self.imgsz_test,
                                conf_thres=self.opt_eval.conf_thres, iou_thres=self.opt_eval.iou_thres,
                                model=self.ema.ema.module if hasattr(self.ema.ema, 'module') else self.ema.ema,
-                               task=task)
+                               task=task, cache=self.result_cache, scenes=self.opt_eval.get('scenes', False),
+                               grid=self.opt_eval.get('grid', 2), image_cache=self.opt_eval.get('image_cache'),
+                               return_features=self.opt_eval.get('return_features', False),
+                               half=self.opt_eval.get('half'), channels_last=self.opt_eval.get('channels_last'),
+                               fuse=self.opt_eval.get('fuse', self.device.type == 'cpu'))
 
         return results
 
@@ -474,9 +473,7 @@ class yolov5():
         self.device = torch_utils.select_device(self.opt.device, apex=False, batch_size=self.opt.batch_size)
         self.opt.total_batch_size = self.opt.batch_size
         self.opt.world_size = 1
-        if self.device.type == 'cpu':
-            mixed_precision = False
-        elif self.opt.local_rank != -1:
+        if self.opt.local_rank != -1:
             # DDP mode
             assert torch.cuda.device_count() > self.opt.local_rank
             torch.cuda.set_device(self.opt.local_rank)
@@ -15,9 +15,11 @@ from torch.utils.data import Dataset
 from tqdm import tqdm
 
 from yolov5.utils.general_rl import xyxy2xywh, xywh2xyxy, torch_distributed_zero_first
+from yolov5.utils.label_index import LabelIndex
 
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.dng']
+scene_formats = img_formats + ['.npy']
 vid_formats = ['.mov', '.avi', '.mp4', '.mpg', '.mpeg', '.m4v', '.wmv', '.mkv']
 
 # Get orientation exif tag
@@ -47,26 +49,33 @@ def exif_size(img):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      local_rank=-1, world_size=1):
+                      local_rank=-1, world_size=1, select=None, scenes=False, grid=2, image_cache=None):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache.
     with torch_distributed_zero_first(local_rank):
-        dataset = LoadImagesAndLabels(path, imgsz, batch_size,
-                                      augment=augment,  # augment images
-                                      hyp=hyp,  # augmentation hyperparameters
-                                      rect=rect,  # rectangular training
-                                      cache_images=cache,
-                                      stride=int(stride),
-                                      pad=pad)
+        if scenes:  # full scenes tiled on the fly instead of pre-cut patches
+            dataset = LoadScenesAndLabels(path, imgsz, batch_size, grid=grid)
+        else:
+            dataset = LoadImagesAndLabels(path, imgsz, batch_size,
+                                          augment=augment,  # augment images
+                                          hyp=hyp,  # augmentation hyperparameters
+                                          rect=rect,  # rectangular training
+                                          cache_images=cache,
+                                          stride=int(stride),
+                                          pad=pad,
+                                          grid=grid,
+                                          image_cache=image_cache)
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, 8])  # number of workers
     train_sampler = torch.utils.data.distributed.DistributedSampler(dataset) if local_rank != -1 else None
+    if select is not None:  # only load the images whose patch files pass select(files)
+        train_sampler = [i for i, files in enumerate(dataset.img_files) if select(files)]
     dataloader = torch.utils.data.DataLoader(dataset,
                                              batch_size=batch_size,
                                              num_workers=nw,
                                              sampler=train_sampler,
                                              pin_memory=True,
-                                             collate_fn=LoadImagesAndLabels.collate_fn,
+                                             collate_fn=dataset.collate_fn,
                                              drop_last=True
                                              )
     return dataloader, dataset
@@ -293,7 +302,7 @@ class LoadStreams:  # multiple IP or RTSP cameras
 # path = 'X:/media/data2/dataset/SSDD/800/ICPR_800/rl_ver/test/images'
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, grid=2, image_cache=None):
         try:
             f = []  # image files
             for p in path if isinstance(path, list) else [path]:
@@ -308,8 +317,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 else:
                     raise Exception('%s does not exist' % p)
             self.img_files = sorted(
-                [x.replace('/', os.sep) for x in f if os.path.splitext(x)[-1].lower() in img_formats])
-            self.img_files = np.asarray(self.img_files).reshape((-1, 4)).tolist()
+                [x.replace('/', os.sep) for x in f if os.path.splitext(x)[-1].lower() in img_formats], key=patch_key)
+            self.img_files = np.asarray(self.img_files).reshape((-1, grid * grid)).tolist()  # grid x grid patches per scene
 
         except Exception as e:
             raise Exception('Error loading data from %s: %s\nSee %s' % (path, e, help_url))
@@ -321,6 +330,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         self.n = n  # number of images
         self.batch = bi  # batch index of image
+        self.image_cache = image_cache  # shared ImageCache of decoded, letterboxed patches
         self.img_size = img_size
         self.augment = augment
         self.hyp = hyp
@@ -335,15 +345,9 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         for i in self.img_files:
             self.label_files.append([x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt') for x in i])
 
-        # Check cache
-        cache_path = str(Path(self.label_files[0][0]).parent) + '.cache'  # cached labels
-
-        # if os.path.isfile(cache_path):
-        #     cache = torch.load(cache_path)  # load
-        #     if cache['hash'] != get_hash(self.label_files + self.img_files):  # dataset changed
-        #         cache = self.cache_labels(cache_path)  # re-cache
-        # else:
-        cache = self.cache_labels(cache_path)  # cache
+        # Check cache, only new or changed files are scanned
+        cache_path = str(Path(self.label_files[0][0]).parent) + '.index'  # label/shape index
+        cache = LabelIndex(cache_path).update(sum(self.img_files, []), sum(self.label_files, []))
 
         # Get labels
         self.labels = []
@@ -449,42 +453,6 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         #         gb += self.imgs[i].nbytes
         #         pbar.desc = 'Caching images (%.1fGB)' % (gb / 1E9)
 
-    def cache_labels(self, path='labels.cache'):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for (img, label) in pbar:
-            for i in range(4):
-                try:
-                    l = []
-                    image = Image.open(img[i])
-                    image.verify()  # PIL verify
-                    # _ = io.imread(img)  # skimage verify (from skimage import io)
-                    shape = exif_size(image)  # image size
-                    assert (shape[0] > 9) & (shape[1] > 9), 'image size <10 pixels'
-                    if os.path.isfile(label[i]):
-                        with open(label[i], 'r') as f:
-                            l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)  # labels
-                    if len(l) == 0:
-                        l = np.zeros((0, 5), dtype=np.float32)
-                    x[img[i]] = [l, shape]
-                except Exception as e:
-                    x[img[i]] = None
-                    print('WARNING: %s: %s' % (img[i], e))
-
-        hash_files = []
-        for i in self.label_files:
-            for j in i:
-                hash_files.append(j)
-        for i in self.img_files:
-            for j in i:
-                hash_files.append(j)
-        x['hash'] = get_hash(hash_files)
-
-        torch.save(x, path)  # save for next time
-
-        return x
-
     def __len__(self):
         return len(self.img_files)
 
@@ -515,21 +483,28 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         # Load image
         # img, (h0, w0), (h, w) = load_image(self, index)
-        imgs, sizes_original, sizes_resized = load_image(self, index)
-
-        # Letterbox
-        shape = self.img_size  # final letterboxed shape
-        img_list = []
-        ratio_list = []
-        pad_list = []
-        for i in imgs:
-            img, ratio, pad = letterbox(i, shape, auto=False, scaleup=self.augment)
-            img_list.append(img)
-            ratio_list.append(ratio)
-            pad_list.append(pad)
+        cached = None
+        if self.image_cache is not None and not self.augment:  # letterboxed patches from the shared cache
+            cached = [self.image_cache.get(f, self.img_size) for f in self.img_files[index]]
+        if cached and all(cached):
+            img_list, sizes_original, sizes_resized, ratio_list, pad_list = [list(x) for x in zip(*cached)]
+            imgs, ratio = img_list, ratio_list[-1]
+        else:
+            imgs, sizes_original, sizes_resized = load_image(self, index)
+
+            # Letterbox
+            shape = self.img_size  # final letterboxed shape
+            img_list = []
+            ratio_list = []
+            pad_list = []
+            for i in imgs:
+                img, ratio, pad = letterbox(i, shape, auto=False, scaleup=self.augment)
+                img_list.append(img)
+                ratio_list.append(ratio)
+                pad_list.append(pad)
 
         shapes_list = []
-        for i in range(4):
+        for i in range(len(imgs)):
             (h0, w0) = sizes_original[i]
             (h, w) = sizes_resized[i]
             pad = pad_list[i]
@@ -569,7 +544,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             #     labels = cutout(img, labels)
 
         nL_list = []
-        for i in range(4):
+        for i in range(len(imgs)):
             nL = len(labels_list[i])  # number of labels
             nL_list.append(nL)
             if nL:
@@ -591,7 +566,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         #             labels[:, 1] = 1 - labels[:, 1]
 
         labels_out_list = []
-        for i in range(4):
+        for i in range(len(imgs)):
             labels_out = torch.zeros((nL_list[i], 7))
             if len(labels_list[i]):
                 labels_out[:, 2:] = torch.from_numpy(labels_list[i])
@@ -601,12 +576,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels_out_list.append(labels_out)
 
         # Convert
-        for i in range(4):
+        for i in range(len(imgs)):
             img_list[i] = img_list[i][:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
             img_list[i] = np.ascontiguousarray(img_list[i])
 
-        [torch.from_numpy(img_list[i]) for i in range(4)]
-
         # return torch.from_numpy(img_list), labels_out_list, self.img_files[index], shapes
         return torch.from_numpy(np.asarray(img_list)), torch.cat(labels_out_list, 0), self.img_files[index], shapes_list
 
@@ -618,6 +591,75 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         return torch.stack(img, 0), torch.cat(label, 0), path, shapes
 
+
+class LoadScenesAndLabels(LoadImagesAndLabels):  # tiles full-resolution scenes on the fly, for testing
+    def __init__(self, path, img_size=640, batch_size=16, grid=2, min_size=2):
+        # Scenes in <root>/<split>/images (jpg, png, tif or (H, W, 3) uint8 .npy), labels in <root>/<split>/labels
+        try:
+            f = []  # scene files
+            for p in path if isinstance(path, list) else [path]:
+                p = str(Path(p))  # os-agnostic
+                parent = str(Path(p).parent) + os.sep
+                if os.path.isfile(p):  # file
+                    with open(p, 'r') as t:
+                        t = t.read().splitlines()
+                        f += [x.replace('./', parent) if x.startswith('./') else x for x in t]  # local to global path
+                elif os.path.isdir(p):  # folder
+                    f += glob.iglob(p + os.sep + '*.*')
+                else:
+                    raise Exception('%s does not exist' % p)
+            self.scene_files = sorted([x.replace('/', os.sep) for x in f if os.path.splitext(x)[-1].lower() in scene_formats])
+        except Exception as e:
+            raise Exception('Error loading data from %s: %s\nSee %s' % (path, e, help_url))
+
+        n = len(self.scene_files)
+        assert n > 0, 'No images found in %s. See %s' % (path, help_url)
+        self.n = n
+        self.img_size = img_size
+        self.grid = grid
+        self.min_size = min_size  # minimum box width and height (pixels) left in a tile
+        self.augment = False
+        self.img_files = [patch_paths(x, grid) for x in self.scene_files]  # virtual patch paths, named as pre-cut ones
+        self.label_files = [x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt') for x in self.scene_files]
+
+        # Scene labels, normalized class xywh
+        cache_path = str(Path(self.label_files[0]).parent) + '.index'  # label/shape index
+        cache = LabelIndex(cache_path).update(self.scene_files, self.label_files)
+        self.labels = [cache[x][0] if cache[x] else np.zeros((0, 5), dtype=np.float32) for x in self.scene_files]
+
+    def __getitem__(self, index):
+        scene = load_scene(self.scene_files[index])  # single decode for all patches of the scene
+        h0, w0 = scene.shape[0] // self.grid, scene.shape[1] // self.grid  # tile hw
+        r = self.img_size / max(h0, w0)  # resize tile to img_size
+        shape = self.img_size  # final letterboxed shape
+
+        img_list, labels_out_list, shapes_list = [], [], []
+        for i, labels in enumerate(tile_labels(self.labels[index], scene.shape[:2], self.grid, self.min_size)):
+            y, x = divmod(i, self.grid)
+            img = np.ascontiguousarray(scene[y * h0:(y + 1) * h0, x * w0:(x + 1) * w0])
+            if r != 1:
+                interp = cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR
+                img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+            h, w = img.shape[:2]
+            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=False)
+            shapes_list.append(((h0, w0), ((h / h0, w / w0), pad)))  # for COCO mAP rescaling
+
+            # Normalized tile xywh to normalized letterboxed xywh
+            labels_out = torch.zeros((len(labels), 7))
+            if len(labels):
+                l = labels.copy()
+                l[:, [1, 3]] *= ratio[0] * w / img.shape[1]
+                l[:, [2, 4]] *= ratio[1] * h / img.shape[0]
+                l[:, 1] += pad[0] / img.shape[1]
+                l[:, 2] += pad[1] / img.shape[0]
+                labels_out[:, 2:] = torch.from_numpy(l)
+                labels_out[:, 1] = i
+            labels_out_list.append(labels_out)
+            img_list.append(img[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, to 3x416x416
+
+        return torch.from_numpy(np.ascontiguousarray(img_list)), torch.cat(labels_out_list, 0), \
+            self.img_files[index], shapes_list
+
     # Ancillary functions --------------------------------------------------------------------------------------------------
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
@@ -638,6 +680,51 @@ def load_image(self, index):
         imgs.append(img), sizes_original.append((h0, w0)), sizes_resized.append(img.shape[:2])
     return imgs, sizes_original, sizes_resized  # img, hw_original, hw_resized
 
+
+def load_scene(path):
+    # loads 1 full-resolution BGR scene, .npy arrays are memory-mapped (only the tiles read are paged in)
+    if os.path.splitext(path)[-1].lower() == '.npy':
+        img = np.load(path, mmap_mode='r')
+    else:
+        img = cv2.imread(path)  # BGR, 8-bit (also for tif)
+    assert img is not None, 'Image Not Found ' + path
+    return img if img.ndim == 3 else cv2.cvtColor(np.asarray(img), cv2.COLOR_GRAY2BGR)
+
+
+def patch_paths(scene, grid=2):
+    # Virtual patch paths of a scene tiled on the fly: <root>/<split>/images/<name><ext> to
+    # <root>/rl_ver/<split>/images/<name>_<i><ext>, i.e. the paths of the pre-cut patches
+    p = Path(scene)
+    d = p.parent.parent.parent / 'rl_ver' / p.parent.parent.name / p.parent.name
+    return [str(d / ('%s_%g%s' % (p.stem, i, p.suffix))) for i in range(grid ** 2)]
+
+
+def patch_key(path):
+    # Sort key of a patch path: scene part, then the numeric patch index (P0000_10.jpg after P0000_9.jpg)
+    stem, ext = os.path.splitext(path)
+    stem, i = stem.rsplit('_', 1) if '_' in os.path.basename(stem) else (stem, '')
+    return stem, int(i) if i.isdigit() else -1, i
+
+
+def scene_path(patch):
+    # Scene of a (virtual or pre-cut) patch path, inverse of patch_paths()
+    p = Path(patch)
+    d = p.parent.parent.parent.parent / p.parent.parent.name / p.parent.name
+    return str(d / (p.stem.rsplit('_', 1)[0] + p.suffix))
+
+
+def tile_labels(labels, shape, grid=2, min_size=2):
+    # Clips normalized class xywh scene labels to the grid x grid tiles (row-major) and renormalizes them per tile
+    h, w = shape[0] // grid, shape[1] // grid  # tile hw
+    box = xywh2xyxy(labels[:, 1:5]) * [shape[1], shape[0], shape[1], shape[0]]  # scene pixels
+    offsets = np.stack(np.meshgrid(np.arange(grid) * w, np.arange(grid) * h), -1).reshape(-1, 1, 2)  # tile xy
+    b = box[None] - np.tile(offsets, 2)  # tile pixels (tiles, n, 4)
+    b[..., [0, 2]] = b[..., [0, 2]].clip(0, w)
+    b[..., [1, 3]] = b[..., [1, 3]].clip(0, h)
+    keep = (b[..., 2] - b[..., 0] > min_size) & (b[..., 3] - b[..., 1] > min_size)  # (tiles, n)
+    b = xyxy2xywh(b.reshape(-1, 4)).reshape(b.shape) / [w, h, w, h]
+    return [np.concatenate((labels[k, :1], b[t, k]), 1).astype(np.float32) for t, k in enumerate(keep)]
+
     # else:
     #     return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
 
@@ -0,0 +1,135 @@
+# Decoded, letterboxed images shared by the fine/coarse detector and agent dataloaders of all processes
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from yolov5.utils.datasets_rl import letterbox
+
+try:
+    import fcntl  # inter-process lock (POSIX)
+except ImportError:
+    fcntl = None
+
+
+def path_key(path):
+    # non-zero int64 key of a file path
+    return int.from_bytes(hashlib.sha1(os.path.abspath(path).encode()).digest()[:8], 'little', signed=True) or 1
+
+
+def resize_letterbox(img, size):
+    # resize (as datasets_rl.load_image) and letterbox (auto=False, scaleup=False) a BGR image to size x size
+    h0, w0 = img.shape[:2]
+    r = size / max(h0, w0)
+    if r != 1:
+        img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR)
+    return letterbox(img, size, auto=False, scaleup=False)[0]
+
+
+class ImageCache:
+    """Images decoded once and kept letterboxed at every configured size, in memory-mapped files under root
+
+    Every slot holds one image at all sizes (uint8 BGR HWC, as datasets_rl.letterbox returns them). The slot table
+    (path key, last use, original hw) and the hit/miss/eviction counters live in a shared memory-mapped array,
+    guarded by a file lock, so DataLoader workers and detectors in other processes share one cache. Least recently
+    used slots are evicted once budget bytes are filled. get() copies the image out of its slot under the lock, so
+    a slot reused by another process afterwards does not change it. flock() locks belong to the open file, so the
+    lock file is reopened in every process (forked DataLoader workers included).
+    """
+    def __init__(self, root='save/image_cache', sizes=(480, 96), budget=4 * 2 ** 30):
+        self.sizes = tuple(sorted(set(sizes), reverse=True))
+        self.nslots = max(int(budget // sum(3 * s * s for s in self.sizes)), 1)
+        self.root = os.path.join(root, '%s_%g' % ('-'.join(str(s) for s in self.sizes), self.nslots))
+        self.open()
+
+    def open(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.open_lock()
+        with self.locked():
+            self.meta = self.memmap('meta', np.int64, (self.nslots + 1, 4))  # [hits, misses, tick, evictions], [key, tick, h0, w0]
+            self.data = {s: self.memmap(str(s), np.uint8, (self.nslots, s, s, 3)) for s in self.sizes}
+
+    def memmap(self, name, dtype, shape):
+        f = os.path.join(self.root, name + '.bin')
+        if not os.path.isfile(f) or os.path.getsize(f) != np.dtype(dtype).itemsize * np.prod(shape):
+            np.memmap(f, dtype=dtype, mode='w+', shape=shape).flush()  # zero-filled
+        return np.memmap(f, dtype=dtype, mode='r+', shape=shape)
+
+    def open_lock(self):
+        # thread lock and inter-process lock file of this process
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.lock_file = open(os.path.join(self.root, 'lock'), 'a+')
+
+    @contextmanager
+    def locked(self):
+        if self.pid != os.getpid():  # forked: the inherited lock file would not exclude the parent and siblings
+            self.open_lock()
+        with self.lock:
+            if fcntl:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def __getstate__(self):  # reopened in DataLoader workers
+        return {k: v for k, v in self.__dict__.items() if k not in ('lock', 'lock_file', 'meta', 'data')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def find(self, key):
+        i = np.flatnonzero(self.meta[1:, 0] == key)
+        return int(i[0]) if len(i) else None
+
+    def touch(self, slot):
+        self.meta[0, 2] += 1
+        self.meta[slot + 1, 1] = self.meta[0, 2]
+
+    def get(self, path, size):
+        """
+        Returns:
+            img (size, size, 3) BGR copy, (h0, w0), (h, w), ratio, pad as load_image + letterbox, None if size is not cached
+        """
+        if size not in self.data:
+            return None
+        key = path_key(path)
+        with self.locked():
+            slot = self.find(key)
+            if slot is not None:
+                self.meta[0, 0] += 1  # hit
+                self.touch(slot)
+                return self.item(slot, size)
+
+        # Miss: decode and letterbox outside the lock
+        img = cv2.imread(path)  # BGR
+        assert img is not None, 'Image Not Found ' + path
+        pyramid = {s: resize_letterbox(img, s) for s in self.sizes}
+        with self.locked():
+            slot = self.find(key)
+            if slot is None:  # not inserted by another process meanwhile
+                slot = int(np.argmin(self.meta[1:, 1]))  # least recently used (or empty) slot
+                self.meta[0, 3] += self.meta[slot + 1, 0] != 0  # eviction
+                self.meta[slot + 1, [0, 2, 3]] = key, img.shape[0], img.shape[1]
+                for s in self.sizes:
+                    self.data[s][slot] = pyramid[s]
+            self.meta[0, 1] += 1  # miss
+            self.touch(slot)
+            return self.item(slot, size)
+
+    def item(self, slot, size):
+        h0, w0 = (int(x) for x in self.meta[slot + 1, 2:])
+        r = size / max(h0, w0)
+        h, w = (int(h0 * r), int(w0 * r)) if r != 1 else (h0, w0)  # resized hw
+        return self.data[size][slot].copy(), (h0, w0), (h, w), (1.0, 1.0), ((size - w) / 2, (size - h) / 2)
+
+    def stats(self):
+        hits, misses, _, evictions = self.meta[0].tolist()
+        return {'hits': hits, 'misses': misses, 'evictions': evictions, 'slots': self.nslots,
+                'used': int((self.meta[1:, 0] != 0).sum()), 'hit_rate': hits / max(hits + misses, 1)}
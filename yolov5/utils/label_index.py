@@ -0,0 +1,140 @@
+# Persistent index of the image shapes and labels of the RL datasets
+import json
+import os
+import struct
+import tempfile
+from multiprocessing.pool import Pool
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+def file_stat(path):
+    # (mtime_ns, size) of a file, (0, -1) if missing
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return 0, -1
+
+
+def scan_file(files):
+    # Verify one image and read its label file, returns shape (w, h) and labels, or None and a warning
+    from yolov5.utils.datasets_rl import exif_size
+    img, label = files
+    try:
+        if os.path.splitext(img)[-1].lower() == '.npy':  # memory-mapped (H, W, 3) scene
+            shape = np.load(img, mmap_mode='r').shape[1::-1]
+        else:
+            image = Image.open(img)
+            image.verify()  # PIL verify
+            shape = exif_size(image)  # image size
+        assert (shape[0] > 9) & (shape[1] > 9), 'image size <10 pixels'
+        l = np.zeros((0, 5), dtype=np.float32)
+        if os.path.isfile(label):
+            with open(label, 'r') as f:
+                l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32).reshape(-1, 5)  # labels
+        return shape, l, None
+    except Exception as e:
+        return None, None, 'WARNING: %s: %s' % (img, e)
+
+
+class LabelIndex:
+    """Image shapes and labels of a set of image/label files, kept in one memory-mapped file
+
+    Layout: magic, header length, JSON header (image paths, array shapes), int64 records [n, 8] (image mtime_ns,
+    image size, label mtime_ns, label size, width, height, label offset, label count; count -1 for a corrupt
+    image), float32 labels [m, 5]. update() rescans only the files whose mtime or size changed, in a process pool.
+    """
+    magic = b'LBLIDX01'
+    ncol = 8
+
+    def __init__(self, path, workers=8):
+        self.path = path
+        self.workers = workers
+        self.load()
+
+    def load(self):
+        self.files, self.records, self.labels = {}, np.zeros((0, self.ncol), dtype=np.int64), np.zeros((0, 5), np.float32)
+        try:
+            with open(self.path, 'rb') as f:
+                assert f.read(8) == self.magic
+                n = struct.unpack('<Q', f.read(8))[0]
+                header = json.loads(f.read(n).decode())
+        except Exception:  # missing, old or damaged index, rebuilt by update()
+            return
+        o = 16 + n  # array offset
+        nf, nl = header['shape']
+        self.files = {p: i for i, p in enumerate(header['files'])}
+        if nf:
+            self.records = np.memmap(self.path, dtype='<i8', mode='r', offset=o, shape=(nf, self.ncol))
+        if nl:
+            self.labels = np.memmap(self.path, dtype='<f4', mode='r', offset=o + nf * self.ncol * 8, shape=(nl, 5))
+
+    def update(self, img_files, label_files):
+        # Scan the new and changed files and rewrite the index if anything changed
+        signatures = {}
+        for img, label in zip(img_files, label_files):
+            signatures[img] = file_stat(img) + file_stat(label)
+        stale = [(img, label) for img, label in zip(img_files, label_files)
+                 if img not in self.files or tuple(self.records[self.files[img], :4]) != signatures[img]]
+        if not stale:
+            return self
+
+        # Scan, in parallel for more than a few files
+        nw = min(os.cpu_count() or 1, self.workers) if len(stale) > 64 else 0
+        desc = 'Scanning images (%g new or changed)' % len(stale)
+        if nw > 1:
+            with Pool(nw) as pool:
+                scanned = list(tqdm(pool.imap(scan_file, stale, chunksize=32), desc=desc, total=len(stale)))
+        else:
+            scanned = [scan_file(x) for x in tqdm(stale, desc=desc)]
+
+        # Merge with the unchanged entries
+        entries = {p: self[p] for p in self.files}  # path: [labels, shape] or None
+        for (img, _), (shape, l, msg) in zip(stale, scanned):
+            entries[img] = [l, shape] if msg is None else None
+            if msg:
+                print(msg)
+        self.save(entries, signatures)
+        return self
+
+    def save(self, entries, signatures):
+        files = list(entries)
+        records = np.zeros((len(files), self.ncol), dtype=np.int64)
+        labels, offset = [], 0
+        for i, p in enumerate(files):
+            records[i, :4] = signatures[p] if p in signatures else self.records[self.files[p], :4]
+            if entries[p] is None:
+                records[i, 7] = -1
+                continue
+            l, shape = entries[p]
+            records[i, 4:] = shape[0], shape[1], offset, len(l)
+            labels.append(np.asarray(l, dtype=np.float32).reshape(-1, 5))
+            offset += len(l)
+        labels = np.concatenate(labels, 0) if labels else np.zeros((0, 5), np.float32)
+
+        header = json.dumps({'files': files, 'shape': [len(files), len(labels)]}).encode()
+        header += b' ' * (-(16 + len(header)) % 64)  # align the arrays to 64 bytes
+        self.records, self.labels = None, None  # release memory maps before replacing the file
+        # unique temporary file: concurrent builders of the same index (--concurrent_detectors) each replace the
+        # index atomically with a complete file
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path) or '.', prefix=os.path.basename(self.path),
+                                         suffix='.tmp', delete=False) as f:
+            f.write(self.magic + struct.pack('<Q', len(header)) + header)
+            f.write(records.astype('<i8').tobytes())
+            f.write(labels.astype('<f4').tobytes())
+        os.chmod(f.name, 0o644)  # readable like the former index, not 0600 as created
+        os.replace(f.name, self.path)
+        self.load()
+
+    def __contains__(self, img):
+        return img in self.files
+
+    def __getitem__(self, img):
+        # [labels (n, 5) class xywh, shape (w, h)] of an image, None if it failed verification
+        r = self.records[self.files[img]]
+        if r[7] < 0:
+            return None
+        return [self.labels[r[6]:r[6] + r[7]], (int(r[4]), int(r[5]))]
@@ -0,0 +1,42 @@
+# Prediction to ground truth matching of the evaluators, vectorized over a whole batch of patches (torch only)
+import torch
+
+
+def match_predictions(iou, pred_patch, pred_cls, target_patch, target_cls, iouv, class_aware=True, inclusive=False):
+    """Greedy unique assignment of predictions to targets, for all patches of a batch and all IoU thresholds at once
+
+    Every prediction takes its best target (highest IoU, first on ties) among the targets of its patch, of its class if
+    class_aware (yolov5 test) or of any class if its class is one of the patch target classes (yolov3
+    get_batch_statistics). It is a true positive if that IoU passes iouv[0] and no earlier prediction (lower row,
+    predictions are in decreasing confidence per patch) took the same target, then for every threshold of iouv.
+    Args:
+        iou: (n, m) IoU of every prediction with every target of the batch
+        pred_patch, pred_cls: (n,) patch index and class of every prediction
+        target_patch, target_cls: (m,) patch index and class of every target
+        iouv: (niou,) IoU thresholds
+        inclusive: IoU >= threshold instead of IoU > threshold
+    Returns:
+        correct (n, niou) bool
+    """
+    n = iou.shape[0]
+    correct = torch.zeros((n, len(iouv)), dtype=torch.bool, device=iou.device)
+    if not n or not iou.shape[1]:
+        return correct
+    iouv = iouv.to(iou.device)
+    same_patch = pred_patch[:, None] == target_patch[None]
+    same_cls = pred_cls[:, None] == target_cls[None]
+    if class_aware:
+        ious, j = torch.where(same_patch & same_cls, iou, -iou.new_ones(())).max(1)  # best target of the class
+        eligible = torch.ones_like(ious, dtype=torch.bool)
+    else:
+        ious, j = torch.where(same_patch, iou, -iou.new_ones(())).max(1)  # best target of any class
+        eligible = (same_patch & same_cls).any(1)  # prediction class among the patch target classes
+    i = ((ious >= iouv[0] if inclusive else ious > iouv[0]) & eligible).nonzero(as_tuple=False).view(-1)
+
+    # First prediction of every target only: sort by (target, prediction row), keep the first of each target
+    i = i[torch.argsort(j[i] * n + i)]
+    first = torch.ones_like(i, dtype=torch.bool)
+    first[1:] = j[i][1:] != j[i][:-1]
+    i = i[first]
+    correct[i] = ious[i, None] >= iouv if inclusive else ious[i, None] > iouv
+    return correct
@@ -0,0 +1,70 @@
+# Concurrent execution of independent detector phases (e.g. the fine and coarse yolov5 instances of train.py)
+import os
+import threading
+import time
+
+import torch
+
+
+def run_jobs(jobs, concurrent=True, device=None):
+    """Runs the callables {name: fn} and returns {name: result}, {name: (start, end)}
+
+    Concurrent jobs run in one thread each. On CUDA every job gets its own stream so kernels of different jobs can
+    overlap (the heavy work releases the GIL); on CPU the intra-op thread pool is split between the jobs for the
+    duration of the call. The first exception raised by a job is re-raised once all jobs have finished.
+    """
+    results, times, errors = {}, {}, []
+    cuda = torch.cuda.is_available() and (device is None or torch.device(device).type != 'cpu')
+
+    def run(name, fn):
+        stream = torch.cuda.Stream() if cuda and concurrent else None
+        t = time.time()
+        try:
+            with torch.cuda.stream(stream):  # no-op for None
+                results[name] = fn()
+            if stream is not None:
+                stream.synchronize()
+        except BaseException as e:
+            errors.append(e)
+        times[name] = (t, time.time())
+
+    if not concurrent or len(jobs) < 2:
+        for name, fn in jobs.items():
+            run(name, fn)
+    else:
+        nt = torch.get_num_threads()
+        if not cuda:
+            torch.set_num_threads(max(nt // len(jobs), 1))  # partition CPU threads
+        threads = [threading.Thread(target=run, args=(name, fn), name=name) for name, fn in jobs.items()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        torch.set_num_threads(nt)
+
+    if errors:
+        raise errors[0]
+    return results, times
+
+
+class Timeline():
+    """Per phase start/end of every job and the overlap achieved, printed and appended to file"""
+    def __init__(self, file=None):
+        self.file = file
+        self.t0 = time.time()
+        if file:
+            os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+
+    def log(self, epoch, phase, times):
+        start, end = min(t[0] for t in times.values()), max(t[1] for t in times.values())
+        busy = sum(t[1] - t[0] for t in times.values())  # sum of job durations
+        wall = end - start
+        overlap = busy - wall  # time saved over running the jobs one after another
+        s = ''.join(' | %s %.1f-%.1fs' % (k, t[0] - self.t0, t[1] - self.t0) for k, t in times.items())
+        s = 'Epoch %g %-6s wall %.1fs busy %.1fs overlap %.1fs (%.0f%%)' % \
+            (epoch, phase, wall, busy, overlap, 100 * overlap / max(busy, 1e-9)) + s
+        print(s)
+        if self.file:
+            with open(self.file, 'a') as f:
+                f.write(s + '\n')
+        return overlap
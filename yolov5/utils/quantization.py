@@ -0,0 +1,76 @@
+# Post-training static INT8 quantization (FX graph mode) for CPU inference of the yolov5 Model body and the agent
+import copy
+
+import torch
+import torch.nn as nn
+
+from yolov5.models.yolo import Detect
+
+
+def quantization_engine():
+    # select the quantized CPU backend: x86 (torch>=1.13), fbgemm, or qnnpack on ARM
+    engines = torch.backends.quantized.supported_engines
+    engine = next(e for e in ('x86', 'fbgemm', 'qnnpack') if e in engines)
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def quantize_fx(model, calibration, skip=()):
+    """INT8 copy of an eval model: observers calibrated on the calibration batches, then converted
+
+    Args:
+        model: float nn.Module, traced by torch.fx
+        calibration: iterable of input batches
+        skip: module classes kept float and not traced (their inputs are dequantized)
+    Returns:
+        quantized torch.fx.GraphModule
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = quantization_engine()
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    for m in skip:
+        qconfig_mapping.set_object_type(m, None)
+    batches = iter(calibration)
+    x = next(batches)
+    model = copy.deepcopy(model).float().eval()  # Conv2d() + BatchNorm2d() are fused by prepare_fx
+    model = prepare_fx(model, qconfig_mapping, (x,), PrepareCustomConfig().set_non_traceable_module_classes(list(skip)))
+    with torch.no_grad():
+        model(x)
+        for x in batches:
+            model(x)
+    return convert_fx(model)
+
+
+class ModelBody(nn.Module):
+    # Model.forward_once(features=True) as a traceable forward(x): Detect() output and its input maps
+    def __init__(self, model):
+        super(ModelBody, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_once(x, features=True)
+
+
+class QuantizedModel(nn.Module):
+    """yolov5 Model with an INT8 body (Focus, Conv, BottleneckCSP, SPP, ...) and the float Detect() head
+
+    Called like Model: model(img) returns (inference output, training output), model(img, features=True) also the
+    Detect() input maps. Quantized ops run on CPU only.
+    """
+    def __init__(self, model, calibration):
+        super(QuantizedModel, self).__init__()
+        self.body = quantize_fx(ModelBody(model), calibration, skip=(Detect,))
+        self.stride, self.nc = model.stride, model.model[-1].nc
+        self.names = getattr(model, 'names', ['item'] * self.nc)
+        self.channels = model.feature_channels()
+
+    def forward(self, x, augment=False, profile=False, features=False):
+        assert not augment, 'augmented inference is not quantized'
+        x, feats = self.body(x.float())
+        return (x, feats) if features else x
+
+    def feature_channels(self):
+        return self.channels
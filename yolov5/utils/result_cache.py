@@ -0,0 +1,133 @@
+# Persistent cache of the per-patch detector results consumed by the RL agent
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from yolov5.utils.datasets_rl import scene_path
+
+
+def model_hash(model):
+    # sha1 of a model state_dict (names and values)
+    h = hashlib.sha1()
+    for k, v in model.state_dict().items():
+        h.update(k.encode())
+        h.update(v.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def file_signature(path):
+    # [mtime_ns, size] of a patch image and of its label file (0, 0 if missing)
+    if not os.path.isfile(path) and os.path.isfile(scene_path(path)):  # virtual patch of a scene tiled on the fly
+        path = scene_path(path)
+    s = []
+    for f in (path, path.replace('images', 'labels').replace(os.path.splitext(path)[-1], '.txt')):
+        st = os.stat(f) if os.path.isfile(f) else None
+        s += [st.st_mtime_ns, st.st_size] if st else [0, 0]
+    return s
+
+
+class ResultCache:
+    """On-disk cache of the test_rl result tuples (source, path, p, r, ap50, loss, nl, stats)
+
+    Entries live under root/<key>, where key hashes the model state_dict, image size and NMS thresholds, and are
+    reused as long as the patch image and label files are unchanged. Arrays are stored as .npy and memory-mapped.
+    Meant for fixed detector weights (--freeze_detectors): weights that change every epoch never hit and cost one
+    state_dict hash per evaluation. Only the keep most recently bound keys are kept on disk.
+    """
+    names = ('scalars', 'has_stats', 'pred_offsets', 'correct', 'conf', 'pcls', 'tcls_offsets', 'tcls')
+
+    def __init__(self, root='save/result_cache', keep=4):
+        self.root = root
+        self.keep = keep  # key directories kept, e.g. the fine and coarse detectors of the last two runs
+        self.dir = None
+        self.rows, self.new = {}, {}  # path: (row, signature, source), path: result tuple
+
+    def bind(self, model, imgsz, conf_thres, iou_thres, merge=False):
+        # Select the entries matching this model and evaluation settings
+        s = '%s %g %g %g %s' % (model_hash(model), imgsz, conf_thres, iou_thres, merge)
+        d = os.path.join(self.root, hashlib.sha1(s.encode()).hexdigest()[:16])
+        if d != self.dir:
+            self.dir, self.new = d, {}
+            self.load()
+        self.prune()
+        return self
+
+    def prune(self):
+        # Remove the key directories bound least recently, beyond the keep most recent (the bound one included)
+        os.makedirs(self.dir, exist_ok=True)
+        os.utime(self.dir)  # last bound
+        dirs = [os.path.join(self.root, d) for d in os.listdir(self.root)]
+        dirs = sorted((d for d in dirs if os.path.isdir(d) and d != self.dir), key=os.path.getmtime, reverse=True)
+        for d in dirs[self.keep - 1:]:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def load(self):
+        self.rows, self.arrays = {}, {}
+        f = os.path.join(self.dir, 'index.json')
+        if os.path.isfile(f):
+            with open(f) as fi:
+                index = json.load(fi)
+            self.rows = {p: (i, s, src) for i, (p, s, src) in enumerate(zip(index['paths'], index['signatures'],
+                                                                             index['sources']))}
+            self.arrays = {k: np.load(os.path.join(self.dir, k + '.npy'), mmap_mode='r') for k in self.names}
+
+    def stale(self, path):
+        return path not in self.rows or self.rows[path][1] != file_signature(path)
+
+    def __contains__(self, path):
+        return path in self.new or path in self.rows
+
+    def get(self, path):
+        if path in self.new:
+            return self.new[path]
+        i, _, source = self.rows[path]
+        a = self.arrays
+        p, r, ap50, loss, nl = a['scalars'][i].tolist()
+        stats = []
+        if a['has_stats'][i]:
+            j0, j1 = a['pred_offsets'][i:i + 2]
+            k0, k1 = a['tcls_offsets'][i:i + 2]
+            stats.append((torch.tensor(a['correct'][j0:j1]), torch.tensor(a['conf'][j0:j1]),
+                          torch.tensor(a['pcls'][j0:j1]), a['tcls'][k0:k1].tolist()))
+        return source, path, p, r, ap50, loss, int(nl), stats
+
+    def put(self, result):
+        self.new[result[1]] = result
+
+    def flush(self):
+        # Rewrite the arrays with the reused and the recomputed entries
+        if not self.new:
+            return
+        paths = [p for p in self.rows if p not in self.new] + list(self.new)
+        results = [self.get(p) for p in paths]
+        scalars = np.array([x[2:7] for x in results], dtype=np.float64).reshape(-1, 5)
+        has_stats = np.array([len(x[7]) > 0 for x in results], dtype=bool)
+        stats = [x[7][0] for x in results if len(x[7])]
+        npred = [len(x[7][0][1]) if len(x[7]) else 0 for x in results]
+        ntcls = [len(x[7][0][3]) if len(x[7]) else 0 for x in results]
+        arrays = {'scalars': scalars,
+                  'has_stats': has_stats,
+                  'pred_offsets': np.concatenate(([0], np.cumsum(npred))).astype(np.int64),
+                  'correct': np.concatenate([s[0].numpy() for s in stats] + [np.zeros((0, 10), bool)], 0),
+                  'conf': np.concatenate([s[1].numpy() for s in stats] + [np.zeros(0)]).astype(np.float32),
+                  'pcls': np.concatenate([s[2].numpy() for s in stats] + [np.zeros(0)]).astype(np.float32),
+                  'tcls_offsets': np.concatenate(([0], np.cumsum(ntcls))).astype(np.int64),
+                  'tcls': np.array([c for s in stats for c in s[3]], dtype=np.float32)}
+        index = {'paths': paths,
+                 'signatures': [file_signature(p) for p in paths],
+                 'sources': [x[0] for x in results]}
+
+        os.makedirs(self.dir, exist_ok=True)
+        self.arrays = {}  # release memory maps before replacing the files
+        for k, v in arrays.items():
+            np.save(os.path.join(self.dir, k + '.tmp.npy'), v)
+            os.replace(os.path.join(self.dir, k + '.tmp.npy'), os.path.join(self.dir, k + '.npy'))
+        with open(os.path.join(self.dir, 'index.tmp.json'), 'w') as f:
+            json.dump(index, f)
+        os.replace(os.path.join(self.dir, 'index.tmp.json'), os.path.join(self.dir, 'index.json'))
+        self.new = {}
+        self.load()
@@ -1,6 +1,7 @@
 import math
 import os
 import time
+from contextlib import nullcontext
 from copy import deepcopy
 
 import torch
@@ -52,6 +53,69 @@ def time_synchronized():
     return time.time()
 
 
+def inference_mode():
+    # torch.inference_mode() where available (torch>=1.9), torch.no_grad() before
+    return torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+
+
+def set_threads(intra=0, inter=0):
+    # CPU intra-op and inter-op thread counts, 0 keeps the default
+    if intra:
+        torch.set_num_threads(intra)
+    if inter:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError:  # can only be set once, before any inter-op parallel work
+            print('WARNING: inter-op threads already set to %g' % torch.get_num_interop_threads())
+
+
+def prepare_model(model, device, half=None, channels_last=None, fuse=False):
+    """Eval model for device: fp16 on CUDA, channels_last on CPU unless set, Conv2d() + BatchNorm2d() fused if fuse
+
+    Returns:
+        model, half, channels_last (inputs should match the last two)
+    """
+    half = device.type != 'cpu' if half is None else half
+    channels_last = device.type == 'cpu' if channels_last is None else channels_last
+    if fuse and hasattr(model, 'fuse'):
+        model.fuse()
+    model = model.to(device).eval()
+    if half:
+        model.half()
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model, half, channels_last
+
+
+def warmup(model, shape, device, half=False, channels_last=False, n=1):
+    # n passes on a zero input, e.g. to select kernels and allocate buffers before timing
+    x = torch.zeros(shape, device=device)
+    x = x.half() if half else x
+    x = x.contiguous(memory_format=torch.channels_last) if channels_last and x.dim() == 4 else x
+    with inference_mode():
+        for _ in range(n):
+            model(x)
+
+
+def autocast(device, precision='fp32'):
+    # mixed precision context for 'fp16' or 'bf16' (also on CPU), nothing for 'fp32'
+    if precision == 'fp32':
+        return nullcontext()
+    dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+    if hasattr(torch, 'autocast'):  # torch>=1.10
+        return torch.autocast(device.type, dtype=dtype)
+    assert device.type != 'cpu' and precision == 'fp16', 'torch<1.10 only autocasts fp16 on CUDA'
+    return torch.cuda.amp.autocast()
+
+
+def grad_scaler(device, precision='fp32'):
+    # loss scaling for fp16 only, bf16 has the fp32 exponent range. Disabled scalers pass scale() and step() through
+    enabled = precision == 'fp16'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):  # torch>=2.3, any device
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device.type != 'cpu')
+
+
 def is_parallel(model):
     # is model is parallel with DP or DDP
     return type(model) in (nn.parallel.DataParallel, nn.parallel.DistributedDataParallel)
@@ -118,8 +182,8 @@ def fuse_conv_and_bn(conv, bn):
         return fusedconv
 
 
-def model_info(model, verbose=False):
-    # Plots a line-by-line description of a PyTorch model
+def model_info(model, verbose=False, img_size=640):
+    # Plots a line-by-line description of a PyTorch model, returns parameters, gradients and GFLOPS at img_size
     n_p = sum(x.numel() for x in model.parameters())  # number parameters
     n_g = sum(x.numel() for x in model.parameters() if x.requires_grad)  # number gradients
     if verbose:
@@ -131,12 +195,16 @@ def model_info(model, verbose=False):
 
     try:  # FLOPS
         from thop import profile
-        flops = profile(deepcopy(model), inputs=(torch.zeros(1, 3, 64, 64),), verbose=False)[0] / 1E9 * 2
-        fs = ', %.1f GFLOPS' % (flops * 100)  # 640x640 FLOPS
+        p = next(model.parameters())
+        flops = profile(deepcopy(model), inputs=(torch.zeros(1, 3, 64, 64, device=p.device, dtype=p.dtype),),
+                        verbose=False)[0] / 1E9 * 2
+        flops *= (img_size / 64) ** 2  # img_size x img_size FLOPS
+        fs = ', %.1f GFLOPS' % flops
     except:
-        fs = ''
+        flops, fs = None, ''
 
     # print('Model Summary: %g layers, %g parameters, %g gradients%s' % (len(list(model.parameters())), n_p, n_g, fs))
+    return n_p, n_g, flops
 
 
 def load_classifier(name='resnet101', n=2):
@@ -691,6 +691,176 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False,
     return output
 
 
+def non_max_suppression_batched(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False):
+    """Performs Non-Maximum Suppression (NMS) on a whole batch with a single torchvision call
+
+    Same settings and output as non_max_suppression(), without the per-image python loop.
+    Returns:
+         list of detections with shape: nx6 (x1, y1, x2, y2, conf, cls), None for images without detections
+    """
+    if prediction.dtype is torch.float16:
+        prediction = prediction.float()  # to FP32
+
+    bs, nc = prediction.shape[0], prediction.shape[2] - 5  # batch size, number of classes
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_det = 300  # maximum number of detections per image
+    redundant = True  # require redundant detections
+    multi_label = nc > 1  # multiple labels per box
+    output = [None] * bs
+
+    # Candidates of all images, b holds the image index of every row
+    b, a = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    x = prediction[b, a]  # (n, 5 + nc) copy
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=False).t()
+        x, b = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        k = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[k], b[k]
+
+    # Filter by class
+    if classes:
+        k = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[k], b[k]
+
+    if not x.shape[0]:
+        return output
+
+    # Batched NMS, boxes are offset by class and grouped by image
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
+    i = torchvision.ops.boxes.batched_nms(boxes, scores, b, iou_thres)  # sorted by decreasing score
+
+    # Group kept boxes by image (keeping score order) and limit detections per image
+    i = i[torch.argsort(b[i] * len(i) + torch.arange(len(i), device=i.device))]
+    n = torch.bincount(b[i], minlength=bs)  # kept boxes per image
+    rank = torch.arange(len(i), device=i.device) - (torch.cumsum(n, 0) - n)[b[i]]
+    i = i[rank < max_det]
+
+    if merge:  # Merge NMS (boxes merged using weighted mean), for images with 1 < n < 3E3 candidates
+        nb = torch.bincount(b, minlength=bs)  # candidates per image
+        m = ((nb > 1) & (nb < 3E3))[b[i]]
+        if m.any():
+            im = i[m]
+            iou = (box_iou(boxes[im], boxes) > iou_thres) & (b[im, None] == b[None])  # iou matrix within image
+            weights = iou * scores[None]  # box weights
+            x[im, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+            if redundant:
+                k = torch.ones_like(m)
+                k[m] = iou.sum(1) > 1  # require redundancy
+                i = i[k]
+
+    n = torch.bincount(b[i], minlength=bs).tolist()
+    for xi, xo in enumerate(x[i].split(n)):
+        if n[xi]:
+            output[xi] = xo
+    return output
+
+
+def scene_nms(x, b, tile, ns=1, iou_thres=0.6, merge=False, agnostic=False, seam=4.):
+    """Performs NMS across the patch seams of whole scenes, for all scenes of a batch at once
+
+    Boxes of adjacent patches ending within seam pixels of their shared border, and overlapping by more than iou_thres
+    along it, are parts of one object cut by the seam: every part is replaced by its union with the parts next to it
+    (all 4 parts of an object on a grid corner). Then a single class-aware NMS runs per scene, which also keeps one of
+    the identical unions, merge=True for weighted mean boxes.
+    Args:
+        x: detections (n, 6) (x1, y1, x2, y2, conf, cls) in scene pixels
+        b: scene index (n,) of every detection, in [0, ns)
+        tile: patch (n, 4) (x1, y1, x2, y2) of every detection in scene pixels
+        ns: number of scenes
+    Returns:
+         kept detections (m, 6) and their scene index (m,), by scene and decreasing conf
+    """
+    max_wh = 4096  # (pixels) class offset
+
+    # Seam fusion, on the detections near a patch border only, compared within their scene: (ns, k) detection indices
+    e = ((x[:, :2] - tile[:, :2] < seam) | (tile[:, 2:] - x[:, 2:4] < seam)).any(1).nonzero(as_tuple=True)[0]
+    # (+1, 0 is a far away sentinel box that pads every scene)
+    if ns == 1:
+        group = e[None] + 1
+    else:
+        n = torch.bincount(b[e], minlength=ns)
+        group = torch.zeros((ns, int(n.max()) if len(e) else 0), dtype=torch.long, device=x.device)
+        group[b[e], torch.arange(len(e), device=x.device) - (torch.cumsum(n, 0) - n)[b[e]]] = e + 1
+    group = torch.cat((group, group.new_zeros((ns, 1))), 1)  # never empty
+    xe, te = (torch.cat((y.new_full((1, y.shape[1]), -1E6), y), 0)[group] for y in (x, tile))  # (ns, k, 6), (ns, k, 4)
+    inter = torch.min(xe[:, :, None, 2:4], xe[:, None, :, 2:4]) - torch.max(xe[:, :, None, :2], xe[:, None, :, :2])
+    wh = xe[..., 2:4] - xe[..., :2]
+    overlap = inter / torch.min(wh[:, :, None], wh[:, None]).clamp(min=1E-6)  # along x, y (negative gap if apart)
+    row, col = te[:, :, None, 1] == te[:, None, :, 1], te[:, :, None, 0] == te[:, None, :, 0]  # same patch row, col
+    g = ~(row & col) & (inter > -seam).all(3) & (~row | (overlap[..., 1] > iou_thres)) & \
+        (~col | (overlap[..., 0] > iou_thres))  # (ns, k, k) parts of one object
+    if not agnostic:
+        g &= xe[:, :, None, 5] == xe[:, None, :, 5]
+    k = torch.ones_like(group).cumsum(1)
+    g |= k[:, :, None] == k[:, None]  # and itself
+    big = (~g).float()[..., None] * 1E9
+    fused = torch.cat(((xe[:, None, :, :2] + big).min(2)[0], (xe[:, None, :, 2:4] - big).max(2)[0],
+                       (xe[:, None, :, 4:5] - big).max(2)[0], xe[..., 5:6]), 2)  # union box, best conf
+    m = group.view(-1) > 0  # not padding
+    x = x.index_copy(0, group.view(-1)[m] - 1, fused.view(-1, 6)[m])
+
+    # Batched NMS, boxes are grouped by scene and class
+    idx = b if agnostic else b * max_wh + x[:, 5].long()
+    i = torchvision.ops.boxes.batched_nms(x[:, :4], x[:, 4], idx, iou_thres)  # sorted by decreasing score
+    if merge:  # Merge NMS (boxes merged using weighted mean) within scene and class
+        iou = (box_iou(x[i, :4], x[:, :4]) > iou_thres) & (idx[i, None] == idx[None])  # iou matrix
+        weights = iou * x[None, :, 4]  # box weights
+        x = x.index_copy(0, i, torch.cat((torch.mm(weights, x[:, :4]) / weights.sum(1, keepdim=True), x[i, 4:]), 1))
+    i = i[torch.argsort(b[i] + (1 - x[i, 4]) / 2)]  # by scene and decreasing conf
+    return x[i], b[i]
+
+
+def merge_scene_detections(output, shapes, img_shape=None, grid=2, iou_thres=0.6, merge=False, agnostic=False,
+                           seam=4.):
+    """Maps the patch detections of whole scenes to scene pixels and suppresses duplicates across patch seams
+
+    Patches are grid x grid tiles of a scene, row-major as the dataloaders and SARODEngine stack them. Every patch is
+    scaled back with its letterbox metadata and offset by its tile in one vectorized pass, then scene_nms() runs once
+    on the batch.
+    Args:
+        output: list of patch detections (n, 6) in letterboxed pixels or None, grid ** 2 per scene
+        shapes: per patch (h0, w0), ratio_pad as the dataloaders, ((gain, gain), (padw, padh)) or None for the
+            letterbox of (h0, w0) into img_shape (as scale_coords)
+        img_shape: letterboxed patch (height, width), used when ratio_pad is None
+    Returns:
+         list of detections (n, 6) (x1, y1, x2, y2, conf, cls) in scene pixels, one per scene
+    """
+    na = grid ** 2
+    ns = len(output) // na  # number of scenes
+    n = [0 if x is None else len(x) for x in output]
+    if not sum(n):
+        return [torch.zeros((0, 6)) for _ in range(ns)]
+    x = torch.cat([x for x in output if x is not None], 0).float()
+    p = torch.repeat_interleave(torch.arange(len(output), device=x.device), torch.tensor(n, device=x.device))
+
+    # Gain, padding, size and offset in the scene of every patch
+    meta = []
+    for k, ((h0, w0), ratio_pad) in enumerate(shapes):
+        if ratio_pad is None:
+            gain = min(img_shape[0] / h0, img_shape[1] / w0)  # gain  = old / new
+            pad = (img_shape[1] - w0 * gain) / 2, (img_shape[0] - h0 * gain) / 2  # wh padding
+        else:
+            gain, pad = ratio_pad[0][0], ratio_pad[1]
+        r, c = divmod(k % na, grid)  # patch row, column
+        meta.append([gain, pad[0], pad[1], w0, h0, c * w0, r * h0])
+    gain, padw, padh, w0, h0, ox, oy = torch.tensor(meta, device=x.device)[p].t()
+    zero = torch.zeros_like(gain)
+    offset = torch.stack((ox, oy, ox, oy), 1)
+    box = torch.min(((x[:, :4] - torch.stack((padw, padh, padw, padh), 1)) / gain[:, None]).clamp(min=0),
+                    torch.stack((w0, h0, w0, h0), 1)) + offset  # scale_coords, clip_coords, to scene
+
+    x, b = scene_nms(torch.cat((box, x[:, 4:]), 1), p // na, offset + torch.stack((zero, zero, w0, h0), 1), ns,
+                     iou_thres=iou_thres, merge=merge, agnostic=agnostic, seam=seam)
+    return list(x.split(torch.bincount(b, minlength=ns).tolist()))
+
+
 def strip_optimizer(f='weights/best.pt'):  # from utils.utils import *; strip_optimizer()
     # Strip optimizer from *.pt files for lighter files (reduced by 1/2 size)
     x = torch.load(f, map_location=torch.device('cpu'))